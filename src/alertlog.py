@@ -0,0 +1,348 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+
+from serverlog import logger
+
+# Durable, append-only log of alerts, so clients that were away get what
+# they missed when they reconnect.
+#
+#   - append() only assigns a sequence number and queues the record; a writer
+#     thread encodes everything queued so far, writes it with one write() and
+#     one fsync() (group commit), so disk latency never reaches the broadcast
+#     path and a burst costs one fsync per batch, not per alert
+#   - records are JSON lines in segment files named after their first
+#     sequence number; a segment is closed once it reaches segment_bytes
+#   - retention drops whole segments, oldest first, beyond retention_bytes or
+#     older than retention_seconds (never the one being written)
+#   - cursors map a client identity to the last sequence number it was
+#     given; they are saved next to the segments by the writer thread
+#   - replay() reads on its own thread, waits until the range it was asked
+#     for is durable, and hands the records to a callback
+# A torn record at the end of the last segment (crash mid-write) is cut off
+# when the log is opened again. A batch that fails to write (disk full, EIO)
+# is cut off the same way and retried every WRITE_RETRY_INTERVAL; meanwhile
+# appends keep queueing up to max_pending and replays get what is durable.
+
+LOG_SEGMENT_BYTES = 16 * 1024 * 1024
+LOG_RETENTION_BYTES = 256 * 1024 * 1024
+LOG_RETENTION_SECONDS = 7 * 24 * 3600
+LOG_MAX_PENDING = 100000  # Records waiting for the writer; beyond that the oldest are dropped
+CURSOR_SAVE_INTERVAL = 1.0  # Seconds between cursor file writes
+WRITE_RETRY_INTERVAL = 1.0  # Seconds between attempts while writes fail
+REPLAY_WAIT = 5.0  # Seconds a replay waits for its records to be written
+SEGMENT_SUFFIX = '.log'
+
+
+class Segment:
+    __slots__ = ('first_seq', 'path', 'size', 'last_ts')
+
+    def __init__(self, first_seq, path, size=0, last_ts=0.0):
+        self.first_seq = first_seq
+        self.path = path
+        self.size = size
+        self.last_ts = last_ts
+
+
+class AlertLog:
+    def __init__(self, directory, segment_bytes=LOG_SEGMENT_BYTES, retention_bytes=LOG_RETENTION_BYTES,
+                 retention_seconds=LOG_RETENTION_SECONDS, fsync=True, max_pending=LOG_MAX_PENDING):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.retention_bytes = retention_bytes
+        self.retention_seconds = retention_seconds
+        self.fsync = fsync
+        self.max_pending = max_pending
+        os.makedirs(directory, exist_ok=True)
+
+        self.cond = threading.Condition()
+        self.pending = deque()  # (seq, ts, record) not written yet
+        self.last_seq = 0       # Last sequence number handed out
+        self.durable_seq = 0    # Last sequence number on disk (fsynced)
+        self.closed = False
+        self.segments = []
+        self.file = None
+
+        # Stats
+        self.appended = 0
+        self.dropped = 0
+        self.batches = 0
+        self.fsyncs = 0
+        self.bytes_written = 0
+        self.write_errors = 0
+        self.failing = False  # The last write failed
+
+        self.cursors = {}
+        self.cursors_dirty = False
+        self.cursor_path = os.path.join(directory, 'cursors.json')
+        self._recover()
+
+        self.replays = deque()
+        self.writer = threading.Thread(target=self._write_loop, name='alert-log-writer', daemon=True)
+        self.writer.start()
+        self.reader = threading.Thread(target=self._replay_loop, name='alert-log-reader', daemon=True)
+        self.reader.start()
+
+    def append(self, record):
+        # Hot path: no I/O and no encoding. record must not change afterwards.
+        with self.cond:
+            self.last_seq += 1
+            seq = self.last_seq
+            self.pending.append((seq, time.time(), record))
+            if len(self.pending) > self.max_pending:
+                self.pending.popleft()
+                self.dropped += 1
+            self.appended += 1
+            self.cond.notify_all()
+        return seq
+
+    def cursor(self, identity):
+        with self.cond:
+            return self.cursors.get(identity)
+
+    def set_cursor(self, identity, seq):
+        with self.cond:
+            self.cursors[identity] = seq
+            self.cursors_dirty = True
+
+    def replay(self, after, upto, match, callback):
+        # Calls callback([(seq, record), ...]) on the reader thread with the
+        # records after..upto (inclusive) for which match(record) holds
+        with self.cond:
+            self.replays.append((after, upto, match, callback))
+            self.cond.notify_all()
+
+    def wait_durable(self, seq, timeout=None):
+        with self.cond:
+            return self.cond.wait_for(lambda: self.durable_seq >= seq or self.closed, timeout)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.writer.join(timeout=5)
+        self.reader.join(timeout=5)
+
+    def stats(self):
+        with self.cond:
+            return {
+                'appended': self.appended,
+                'durable_seq': self.durable_seq,
+                'pending': len(self.pending),
+                'dropped': self.dropped,
+                'batches': self.batches,
+                'fsyncs': self.fsyncs,
+                'bytes_written': self.bytes_written,
+                'write_errors': self.write_errors,
+                'segments': len(self.segments),
+            }
+
+    def _write_loop(self):
+        last_cursor_save = time.monotonic()
+        while True:
+            with self.cond:
+                # Woken by appends; cursors are saved at most once per interval
+                self.cond.wait_for(lambda: self.pending or self.closed, timeout=CURSOR_SAVE_INTERVAL)
+                batch = list(self.pending)
+                self.pending.clear()
+                closed = self.closed
+            if batch:
+                try:
+                    self._write_batch(batch)
+                except OSError as e:
+                    self._write_failed(batch, e)
+                    if closed:
+                        break
+                    with self.cond:
+                        self.cond.wait_for(lambda: self.closed, timeout=WRITE_RETRY_INTERVAL)
+                    continue
+            now = time.monotonic()
+            if closed or now - last_cursor_save >= CURSOR_SAVE_INTERVAL:
+                # Housekeeping: cursors, and time-based retention for logs
+                # too quiet to roll over
+                try:
+                    if self.cursors_dirty:
+                        self._save_cursors()
+                    self._apply_retention()
+                except OSError as e:
+                    logger.error(f"Alert log housekeeping failed: {e}")
+                last_cursor_save = now
+            if closed and not batch:
+                break
+        if self.file:
+            self.file.close()
+
+    def _write_batch(self, batch):
+        # Everything appended since the last batch: one write, one fsync
+        lines = [json.dumps({'seq': seq, 'ts': ts, **record}, ensure_ascii=False).encode('utf-8') + b'\n'
+                 for seq, ts, record in batch]
+        data = b''.join(lines)
+        segment = self.segments[-1] if self.segments else None
+        if segment is None or segment.size >= self.segment_bytes:
+            segment = self._roll(batch[0][0])
+        elif self.file is None:
+            self.file = open(segment.path, 'ab')  # Closed by a failed write
+        try:
+            self.file.write(data)
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+                self.fsyncs += 1
+        except OSError:
+            self._abandon_file(segment)
+            raise
+        segment.size += len(data)
+        segment.last_ts = batch[-1][1]
+        self.bytes_written += len(data)
+        self.batches += 1
+        with self.cond:
+            self.durable_seq = batch[-1][0]
+            self.cond.notify_all()
+        if self.failing:
+            self.failing = False
+            logger.info("Alert log writes are working again")
+
+    def _write_failed(self, batch, error):
+        # Writer thread: the batch goes back to the front of the queue
+        with self.cond:
+            self.pending.extendleft(reversed(batch))
+            while len(self.pending) > self.max_pending:
+                self.pending.popleft()
+                self.dropped += 1
+            self.write_errors += 1
+        if not self.failing:
+            # Once per stretch of failures, not per retry
+            self.failing = True
+            logger.error(f"Alert log write failed, retrying: {error}")
+
+    def _abandon_file(self, segment):
+        # Cut the segment back to its last complete record, in case part of
+        # the batch made it out; the next attempt opens it again
+        try:
+            self.file.close()
+        except OSError:
+            pass
+        self.file = None
+        try:
+            with open(segment.path, 'r+b') as f:
+                f.truncate(segment.size)
+        except OSError:
+            pass
+
+    def _roll(self, first_seq):
+        # Writer thread: start a new segment and apply retention
+        if self.file:
+            self.file.close()
+            self.file = None
+        path = os.path.join(self.directory, f"{first_seq:020d}{SEGMENT_SUFFIX}")
+        self.file = open(path, 'ab')
+        segment = Segment(first_seq, path)
+        with self.cond:
+            self.segments.append(segment)
+        self._apply_retention()
+        return segment
+
+    def _apply_retention(self):
+        cutoff = time.time() - self.retention_seconds
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            total = sum(segment.size for segment in self.segments)
+            if total <= self.retention_bytes and oldest.last_ts >= cutoff:
+                break
+            with self.cond:
+                self.segments.pop(0)
+            try:
+                os.remove(oldest.path)
+            except OSError:
+                pass
+
+    def _save_cursors(self):
+        with self.cond:
+            cursors = dict(self.cursors)
+            self.cursors_dirty = False
+        tmp_path = self.cursor_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(cursors, f)
+        os.replace(tmp_path, self.cursor_path)
+
+    def _replay_loop(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.replays or self.closed)
+                if self.closed:
+                    return
+                after, upto, match, callback = self.replays.popleft()
+            if not self.wait_durable(upto, REPLAY_WAIT):
+                # Writes are failing: replay what made it to disk
+                with self.cond:
+                    durable = self.durable_seq
+                logger.warning(f"Alert log replay of {after + 1}..{upto} cut to {durable}: not written yet")
+                upto = durable
+            try:
+                callback(self._read(after, upto, match))
+            except Exception as e:
+                logger.error(f"Alert log replay failed: {e}")
+
+    def _read(self, after, upto, match):
+        with self.cond:
+            segments = list(self.segments)
+        # Segments that can hold after+1..upto: from the last one starting
+        # at or before after+1
+        start = 0
+        for index, segment in enumerate(segments):
+            if segment.first_seq <= after + 1:
+                start = index
+        records = []
+        for segment in segments[start:]:
+            if segment.first_seq > upto:
+                break
+            try:
+                with open(segment.path, 'rb') as f:
+                    for line in f:
+                        record = json.loads(line)
+                        seq = record['seq']
+                        if seq > upto:
+                            break
+                        if seq > after and match(record):
+                            records.append((seq, record))
+            except (OSError, ValueError):
+                continue  # Removed by retention meanwhile, or a torn tail
+        return records
+
+    def _recover(self):
+        # Find the segments of a previous run and where it stopped
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+        for name in names:
+            path = os.path.join(self.directory, name)
+            self.segments.append(Segment(int(name[:-len(SEGMENT_SUFFIX)]), path, os.path.getsize(path)))
+        if self.segments:
+            last = self.segments[-1]
+            good = 0
+            with open(last.path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    if not line.endswith(b'\n'):
+                        break
+                    good += len(line)
+                    self.last_seq = record['seq']
+                    last.last_ts = record['ts']
+            if good < last.size:
+                with open(last.path, 'r+b') as f:
+                    f.truncate(good)
+                last.size = good
+            if not self.last_seq:
+                self.last_seq = last.first_seq - 1
+            self.file = open(last.path, 'ab')
+            self.durable_seq = self.last_seq
+        for segment in self.segments[:-1]:
+            segment.last_ts = os.path.getmtime(segment.path)
+        try:
+            with open(self.cursor_path) as f:
+                self.cursors = json.load(f)
+        except (OSError, ValueError):
+            self.cursors = {}
@@ -0,0 +1,1196 @@
+import argparse
+import hashlib
+import io
+import json
+import os
+import random
+import selectors
+import socket
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import urllib.request
+
+from framing import (MessageDecoder, encode_message, parse_message, hello_message, RECV_SIZE,
+                     FRAMING_NDJSON, FRAMING_BINARY, SUPPORTED_FRAMINGS)
+from registry import ClientRegistry, ClientRecord
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+BENCH_PORT = 23456
+
+# Benchmarks for the alert app. The server ones start server.py in a
+# subprocess (stdout discarded) so the numbers include the real I/O path, e.g.
+#   python bench.py idle --clients 10000 --modes threaded async
+#   python bench.py throughput --connections 4 --rate 1000
+#   python bench.py throughput --workers 2 --mode async
+#   python bench.py throughput --framing binary
+#   python bench.py wire
+#   python bench.py flood --clients 200
+#   python bench.py client-startup
+#   python bench.py gif --latency 300   (client side, needs Pillow/requests)
+#   python bench.py popup --size 2048   (client side, needs a display)
+#   python bench.py media --desks 300   (needs Pillow/requests)
+#   python bench.py gif-memory --frames 200
+
+
+def start_server(mode, port, extra_args=()):
+    cmd = [sys.executable, SERVER_SCRIPT, '--mode', mode, '--port', str(port), *extra_args]
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(port)
+    return proc
+
+def stop_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Server did not start on port {port}")
+
+def proc_status(pid):
+    # Linux only: VmRSS in kB and the thread count of the server process
+    status = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('VmRSS', 'Threads'):
+                status[key] = int(value.split()[0])
+    return status
+
+def drain(sockets, quiet=0.5):
+    # Read whatever the server pushes until it has been silent for `quiet`
+    # seconds, so its send buffers don't skew the memory numbers
+    sel = selectors.DefaultSelector()
+    for sock in sockets:
+        sock.setblocking(False)
+        sel.register(sock, selectors.EVENT_READ)
+    total = 0
+    while True:
+        events = sel.select(timeout=quiet)
+        if not events:
+            break
+        for key, _ in events:
+            try:
+                data = key.fileobj.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                continue
+            except OSError:
+                data = b''
+            if not data:
+                sel.unregister(key.fileobj)
+            total += len(data)
+    sel.close()
+    return total
+
+def open_clients(port, count, hello=True):
+    # hello=False opens legacy clients, which still get full roster lists
+    sockets = []
+    for _ in range(count):
+        sock = socket.create_connection(('127.0.0.1', port))
+        if hello:
+            sock.sendall(encode_message(hello_message()))
+        sockets.append(sock)
+    return sockets
+
+def close_clients(sockets):
+    for sock in sockets:
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+def bench_idle(args):
+    # Memory and threads needed to hold N idle connections
+    print(f"{'mode':<10} {'clients':>8} {'connect s':>10} {'base RSS MB':>12} "
+          f"{'RSS MB':>8} {'KB/client':>10} {'threads':>8}")
+    for mode in args.modes:
+        proc = start_server(mode, args.port)
+        try:
+            time.sleep(0.2)
+            base = proc_status(proc.pid)
+            start = time.perf_counter()
+            sockets = open_clients(args.port, args.clients, hello=not args.legacy)
+            drain(sockets)
+            elapsed = time.perf_counter() - start
+            loaded = proc_status(proc.pid)
+            per_client = (loaded['VmRSS'] - base['VmRSS']) / args.clients
+            print(f"{mode:<10} {args.clients:>8} {elapsed:>10.2f} {base['VmRSS'] / 1024:>12.1f} "
+                  f"{loaded['VmRSS'] / 1024:>8.1f} {per_client:>10.1f} {loaded['Threads']:>8}")
+            close_clients(sockets)
+        finally:
+            stop_server(proc)
+
+class BenchClient:
+    # Minimal protocol client: no Tk, just framing and a message callback.
+    # Framed clients wait for HELLO_ACK, so the first send already uses the
+    # negotiated framing.
+    def __init__(self, port, framed=True, framing=FRAMING_NDJSON):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.framing = None
+        self.decoder = MessageDecoder(framed=framed)
+        self.address = str(self.sock.getsockname())
+        self.corrupt = 0
+        self.client_id = None
+        if framed:
+            self.sock.sendall(encode_message(hello_message(framings=[framing]), FRAMING_NDJSON))
+            ack = self.wait_for(lambda m: m.get('type') == 'HELLO_ACK')
+            self.client_id = ack['client_id']
+            self.framing = ack['framing']
+            self.decoder.set_framing(self.framing)
+
+    def send(self, data):
+        if self.framing:
+            self.sock.sendall(encode_message(data, self.framing))
+        else:
+            self.sock.sendall(json.dumps(data).encode('utf-8'))
+
+    def read_forever(self, on_message):
+        while True:
+            try:
+                data = self.sock.recv(RECV_SIZE)
+            except OSError:
+                return
+            if not data:
+                return
+            for message in self.decoder.feed(data):
+                try:
+                    on_message(parse_message(message))
+                except json.JSONDecodeError:
+                    self.corrupt += 1
+
+    def wait_for(self, predicate, timeout=10):
+        # Read synchronously until predicate(message) holds; used before the
+        # reader thread starts
+        self.sock.settimeout(timeout)
+        try:
+            while True:
+                data = self.sock.recv(RECV_SIZE)
+                if not data:
+                    raise RuntimeError("Server closed the connection")
+                for message in self.decoder.feed(data):
+                    try:
+                        message = parse_message(message)
+                    except json.JSONDecodeError:
+                        continue
+                    if predicate(message):
+                        return message
+        finally:
+            self.sock.settimeout(None)
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+def find_client_id(client, address):
+    # Ask for the roster until it lists `address`, return that client's ID
+    while True:
+        client.send({'type': 'CLIENT_LIST_REQUEST'})
+        response = client.wait_for(lambda m: m.get('type') == 'CLIENT_LIST_RESPONSE')
+        for entry in response['clients']:
+            if entry['address'] == address:
+                return entry['id']
+        time.sleep(0.05)
+
+def bench_throughput(args):
+    # N senders each pace `rate` targeted CUSTOM alerts/sec at one receiver,
+    # which checks that every message arrives whole. With --workers the
+    # senders and the receiver land on different worker processes, so
+    # alerts are relayed over the bus.
+    # Senders go well past the per-client alert limit on purpose
+    proc = start_server(args.mode, args.port, ['--workers', str(args.workers), '--rate-limit', 'alert=off'])
+    try:
+        receiver = BenchClient(args.port, framed=not args.unframed, framing=args.framing)
+        senders = [BenchClient(args.port, framed=not args.unframed, framing=args.framing)
+                   for _ in range(args.connections)]
+        target_id = find_client_id(senders[0], receiver.address)
+
+        received = []
+        done = threading.Event()
+        expected = args.connections * args.rate * args.duration
+
+        def on_message(message):
+            if message.get('type') == 'CUSTOM':
+                received.append(time.perf_counter() - message['sent'])
+                if len(received) >= expected:
+                    done.set()
+
+        threading.Thread(target=receiver.read_forever, args=(on_message,), daemon=True).start()
+        for sender in senders:
+            # Senders also get roster pushes; discard them
+            threading.Thread(target=sender.read_forever, args=(lambda m: None,), daemon=True).start()
+
+        text = 'x' * args.size
+
+        def pace(sender):
+            interval = 1.0 / args.rate
+            next_send = time.perf_counter()
+            for seq in range(args.rate * args.duration):
+                sender.send({'type': 'CUSTOM', 'message': text, 'bg': '#ff4500', 'gif_url': None,
+                             'target_id': target_id, 'seq': seq, 'sent': time.perf_counter()})
+                next_send += interval
+                delay = next_send - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=pace, args=(sender,)) for sender in senders]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        done.wait(timeout=args.duration + 10)
+        elapsed = time.perf_counter() - start
+
+        latencies = sorted(received)
+        p50 = latencies[len(latencies) // 2] * 1000 if latencies else 0
+        p99 = latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0
+        framing = 'unframed' if args.unframed else args.framing
+        print(f"mode={args.mode} workers={args.workers} framing={framing} connections={args.connections} "
+              f"rate={args.rate}/s size={args.size}B")
+        print(f"sent={expected} received={len(received)} corrupt={receiver.corrupt} "
+              f"msgs/s={len(received) / elapsed:.0f} p50={p50:.2f}ms p99={p99:.2f}ms")
+
+        receiver.close()
+        for sender in senders:
+            sender.close()
+    finally:
+        stop_server(proc)
+
+def broadcast_mix(count, seed=1):
+    # What clients typically receive: mostly built-in alerts, some custom
+    # ones with a GIF, and the occasional roster delta
+    import random
+    rng = random.Random(seed)
+    alert_types = ['STOP', 'COLD', 'ALERT1', 'ALERT2', 'ALERT3']
+    colours = ['#ff4500', '#1e90ff', '#00ff00', '#ffff00', '#ff00ff']
+    names = [f"user{i:03d}" for i in range(200)]
+    messages = []
+    for i in range(count):
+        sender_id = rng.randrange(1, 2000)
+        roll = rng.random()
+        if roll < 0.6:
+            messages.append({'type': 'LEGACY_ALERT', 'alert_type': rng.choice(alert_types),
+                             'sender_id': sender_id, 'sender_username': rng.choice(names)})
+        elif roll < 0.9:
+            messages.append({'type': 'CUSTOM', 'message': "Coffee in the kitchen, come get it before it's gone",
+                             'bg': rng.choice(colours),
+                             'gif_url': 'https://media1.tenor.com/m/yHhqdtTladoAAAAC/cat-typing-typing.gif',
+                             'target_id': None, 'sender_id': sender_id, 'sender_username': rng.choice(names)})
+        else:
+            changes = [{'type': 'CLIENT_JOINED', 'id': rng.randrange(1, 2000), 'username': rng.choice(names),
+                        'address': f"('10.0.{rng.randrange(256)}.{rng.randrange(256)}', {rng.randrange(40000, 60000)})"}
+                       for _ in range(rng.randrange(1, 4))]
+            messages.append({'type': 'CLIENT_ROSTER_DELTA', 'base_version': i, 'version': i + 1,
+                             'changes': changes})
+    return messages
+
+def bench_wire(args):
+    # In-process: encode/decode cost and bytes on the wire per framing
+    messages = broadcast_mix(args.messages)
+    print(f"{args.messages} messages: 60% built-in alerts, 30% custom with GIF, 10% roster deltas")
+    print(f"{'framing':<8} {'bytes/msg':>10} {'total KB':>10} {'encode us':>10} {'decode us':>10}")
+    for framing in SUPPORTED_FRAMINGS:
+        start = time.perf_counter()
+        payloads = [encode_message(message, framing) for message in messages]
+        encode_time = time.perf_counter() - start
+
+        stream = b''.join(payloads)
+        decoder = MessageDecoder()
+        decoder.set_framing(framing)
+        start = time.perf_counter()
+        # Feed in recv()-sized chunks like a real reader
+        decoded = [parse_message(message) for offset in range(0, len(stream), RECV_SIZE)
+                   for message in decoder.feed(stream[offset:offset + RECV_SIZE])]
+        decode_time = time.perf_counter() - start
+        assert decoded == messages, f"{framing} round trip mismatch"
+
+        n = len(messages)
+        print(f"{framing:<8} {len(stream) / n:>10.1f} {len(stream) / 1024:>10.1f} "
+              f"{encode_time / n * 1e6:>10.2f} {decode_time / n * 1e6:>10.2f}")
+
+    # Client -> server: the legacy alert strings
+    for framing in SUPPORTED_FRAMINGS:
+        print(f"{framing:<8} 'STOP' from a client: {len(encode_message('STOP', framing))} bytes")
+
+    # One alert as a full CUSTOM payload vs by template ID, as received
+    from templates import TemplateRegistry
+    registry = TemplateRegistry({'MEETING': {'message': "Meeting in {room} in {minutes} minutes",
+                                             'bg': '#1e90ff',
+                                             'gif_url': 'https://media1.tenor.com/m/yHhqdtTladoAAAAC/cat-typing-typing.gif'}})
+    sender = {'sender_id': 42, 'sender_username': 'user042'}
+    for template_id, params in (('COLD', {}), ('MEETING', {'room': 'B2', 'minutes': '5'})):
+        full = dict(type='CUSTOM', **registry.render(template_id, params), **sender)
+        templated = dict(type='TEMPLATE_ALERT', template=template_id, **sender)
+        if params:
+            templated['params'] = params
+        sizes = '  '.join(f"{framing} {len(encode_message(full, framing))} -> {len(encode_message(templated, framing))}"
+                          for framing in SUPPORTED_FRAMINGS)
+        print(f"{template_id} alert, CUSTOM -> TEMPLATE_ALERT bytes: {sizes}")
+
+def bench_log(args):
+    # In-process: sustained append throughput of the alert log, group commit
+    # with and without fsync, against writing + fsyncing every alert inline
+    import tempfile
+    from alertlog import AlertLog
+    record = {'from': 'a' * 32, 'to': None,
+              'message': {'type': 'CUSTOM', 'message': 'x' * args.size, 'bg': '#ff4500',
+                          'gif_url': None, 'sender_id': 1, 'sender_username': 'user001'}}
+    per_thread = args.appends // args.threads
+    total = per_thread * args.threads
+    print(f"{total} appends from {args.threads} threads, ~{args.size} byte alerts")
+    print(f"{'mode':<10} {'appends/s':>11} {'p50 us':>8} {'p99 us':>8} {'max us':>9} "
+          f"{'batches':>8} {'fsyncs':>7} {'durable ms':>11}")
+
+    for mode in ('group', 'nofsync', 'inline'):
+        with tempfile.TemporaryDirectory() as directory:
+            if mode == 'inline':
+                # Baseline: what a naive log on the broadcast path costs
+                lock = threading.Lock()
+                f = open(os.path.join(directory, 'inline.log'), 'ab')
+                counter = [0]
+
+                def append(record):
+                    with lock:
+                        counter[0] += 1
+                        f.write(json.dumps({'seq': counter[0], 'ts': time.time(), **record}).encode() + b'\n')
+                        f.flush()
+                        os.fsync(f.fileno())
+                        return counter[0]
+                log = None
+            else:
+                log = AlertLog(directory, fsync=mode == 'group', max_pending=total + 1)
+                append = log.append
+
+            latencies = [[] for _ in range(args.threads)]
+
+            def worker(samples):
+                for _ in range(per_thread):
+                    start = time.perf_counter()
+                    append(record)
+                    samples.append(time.perf_counter() - start)
+
+            threads = [threading.Thread(target=worker, args=(samples,)) for samples in latencies]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            appended = time.perf_counter() - start
+            if log:
+                log.wait_durable(total)
+                durable = time.perf_counter() - start
+                stats = log.stats()
+                log.close()
+                assert stats['durable_seq'] == total and not stats['dropped']
+                batches, fsyncs = stats['batches'], stats['fsyncs']
+            else:
+                f.close()
+                durable = appended
+                batches = fsyncs = total
+
+            samples = sorted(sample for thread_samples in latencies for sample in thread_samples)
+            p50 = samples[len(samples) // 2] * 1e6
+            p99 = samples[int(len(samples) * 0.99)] * 1e6
+            print(f"{mode:<10} {total / appended:>11.0f} {p50:>8.1f} {p99:>8.1f} {samples[-1] * 1e6:>9.0f} "
+                  f"{batches:>8} {fsyncs:>7} {durable * 1000:>11.1f}")
+
+    # Replay of a reconnecting client's range, read back from the segments
+    with tempfile.TemporaryDirectory() as directory:
+        log = AlertLog(directory, segment_bytes=1024 * 1024)
+        for _ in range(total):
+            log.append(record)
+        log.wait_durable(total)
+        done = threading.Event()
+        result = []
+        start = time.perf_counter()
+        log.replay(total // 2, total, lambda record: True, lambda records: (result.extend(records), done.set()))
+        done.wait()
+        elapsed = time.perf_counter() - start
+        segments = log.stats()['segments']
+        log.close()
+        assert [seq for seq, _ in result] == list(range(total // 2 + 1, total + 1))
+        print(f"replay of {len(result)} records across {segments} segments: {elapsed * 1000:.1f} ms")
+
+CLIENT_STARTUP_CHILD = """
+import importlib, resource, sys, time
+name = sys.argv[1]
+start = time.perf_counter()
+module = importlib.import_module(name) if name != '-' else None
+imported = time.perf_counter() - start
+if name == 'clientcore':
+    module.AlertClientCore(identity='bench')
+elif name == 'client':
+    module.AlertClient()
+created = time.perf_counter() - start
+print(imported, created, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, len(sys.modules))
+"""
+
+def client_startup(module, cwd):
+    result = subprocess.run([sys.executable, '-c', CLIENT_STARTUP_CHILD, module],
+                            capture_output=True, text=True, check=True, cwd=cwd)
+    return [float(value) for value in result.stdout.split()]
+
+def bench_client_startup(args):
+    # Fresh interpreter per run: import + construct the headless core vs the
+    # Tk client, against a bare interpreter's footprint
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    base_rss = client_startup('-', src_dir)[2]
+    print(f"{'module':<12} {'import ms':>10} {'ready ms':>10} {'peak RSS MB':>12} {'+RSS MB':>8} {'modules':>8}")
+    for module in ('clientcore', 'client'):
+        runs = sorted(client_startup(module, src_dir) for _ in range(args.runs))
+        imported, created, rss, modules = runs[len(runs) // 2]  # Median by import time
+        print(f"{module:<12} {imported * 1000:>10.1f} {created * 1000:>10.1f} {rss / 1024:>12.1f} "
+              f"{(rss - base_rss) / 1024:>8.1f} {int(modules):>8}")
+
+def bench_registry(args):
+    # In-process: ClientRegistry against the old dict-of-dicts layout
+    n = args.clients
+    addresses = [('10.0.%d.%d' % (i // 250, i % 250), 40000 + i % 20000) for i in range(n)]
+
+    def run_registry():
+        registry = ClientRegistry()
+        start = time.perf_counter()
+        for i in range(n):
+            registry.add(ClientRecord(i, None, addresses[i], f"Client_{i}", None, None))
+        registered = time.perf_counter()
+        for _ in range(args.iterations):
+            for client in registry:
+                client.username
+        iterated = time.perf_counter()
+        for i in range(0, n, 2):
+            registry.get(i)
+            registry.find_by_username(f"Client_{i}")
+        looked_up = time.perf_counter()
+        for i in range(n):
+            registry.remove(i)
+        removed = time.perf_counter()
+        return registry, (registered - start, iterated - registered, looked_up - iterated, removed - looked_up)
+
+    def run_dicts():
+        clients = {}
+        start = time.perf_counter()
+        for i in range(n):
+            clients[i] = {'socket': None, 'address': addresses[i], 'username': f"Client_{i}",
+                          'decoder': None, 'framing': None, 'roster_deltas': False, 'queue': None}
+        registered = time.perf_counter()
+        for _ in range(args.iterations):
+            for client in list(clients.values()):
+                client['username']
+        iterated = time.perf_counter()
+        for i in range(0, n, 2):
+            clients.get(i)
+            # No username index: a scan is the only way
+            if i < 200:
+                [c for c in clients.values() if c['username'] == f"Client_{i}"]
+        looked_up = time.perf_counter()
+        for i in range(n):
+            del clients[i]
+        removed = time.perf_counter()
+        return clients, (registered - start, iterated - registered, looked_up - iterated, removed - looked_up)
+
+    print(f"{'layout':<10} {'clients':>8} {'register ms':>12} {'iterate ms':>11} {'lookup ms':>10} "
+          f"{'remove ms':>10} {'bytes/client':>13}")
+    for name, run in (('registry', run_registry), ('dicts', run_dicts)):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        _, timings = run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        # Timings are taken with tracemalloc running, so compare them
+        # against each other rather than in absolute terms
+        register, iterate, lookup, remove = (t * 1000 for t in timings)
+        print(f"{name:<10} {n:>8} {register:>12.1f} {iterate / args.iterations:>11.2f} {lookup:>10.1f} "
+              f"{remove:>10.1f} {(peak - before) / n:>13.0f}")
+    print("iterate ms is per full pass; dicts lookup only scans usernames for the first 100 lookups")
+
+def bench_heartbeat(args):
+    # In-process, simulated clock: per-tick cost of finding idle clients with
+    # the timer wheel against scanning every client each tick. A share of
+    # the clients talk each second; the rest go idle and get pinged.
+    from heartbeat import TimerWheel
+    n, interval = args.clients, args.interval
+    rng = random.Random(1)
+    active = [rng.random() < args.active for _ in range(n)]
+    print(f"{n} clients, {args.active:.0%} sending every second, ping after {interval:g}s idle, "
+          f"{args.seconds}s simulated")
+    print(f"{'method':<8} {'ms/tick':>9} {'max ms':>8} {'checked/tick':>13} {'pings':>8}")
+    for method in ('wheel', 'scan'):
+        # Connected at random times during the last interval
+        registry = ClientRegistry()
+        for i in range(n):
+            registry.add(ClientRecord(i, None, ('10.0.0.1', i), f"Client_{i}", None, None))
+            registry.get(i).last_seen = -rng.uniform(0, interval)
+        wheel = TimerWheel(1.0, interval, 0.0)
+        if method == 'wheel':
+            for client in registry:
+                wheel.schedule(client.client_id, client.last_seen + interval)
+        clients = list(registry)
+        pings = checked = 0
+        tick_times = []
+        for second in range(1, args.seconds + 1):
+            now = float(second)
+            for i in range(n):
+                if active[i]:
+                    clients[i].last_seen = now  # What handle_data does
+            start = time.perf_counter()
+            if method == 'wheel':
+                for client_id in wheel.advance(now):
+                    checked += 1
+                    client = registry.get(client_id)
+                    remaining = client.last_seen + interval - now
+                    if remaining > 0:
+                        wheel.schedule(client_id, remaining)
+                    else:
+                        pings += 1
+                        client.last_seen = now  # Assume the PONG comes back
+                        wheel.schedule(client_id, interval)
+            else:
+                for client in registry:
+                    checked += 1
+                    if now - client.last_seen >= interval:
+                        pings += 1
+                        client.last_seen = now
+            tick_times.append(time.perf_counter() - start)
+        print(f"{method:<8} {sum(tick_times) / len(tick_times) * 1000:>9.3f} {max(tick_times) * 1000:>8.2f} "
+              f"{checked // args.seconds:>13} {pings:>8}")
+
+class NullSocket:
+    # Stands in for a client socket in the in-process benchmarks
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        pass
+
+def bench_multicast(args):
+    # In-process: cost of one alert to a topic with S subscribers out of N
+    # connected clients, against broadcasting it to all N (what senders had
+    # to do before topics). Nothing drains the queues, so once they are full
+    # every alert also pays for dropping the oldest one: a steady state.
+    from server import AlertServer
+    print(f"{'clients':>8} {'subscribers':>12} {'topic us':>10} {'broadcast us':>13} {'10 IDs us':>10}")
+    for n in args.clients:
+        server = AlertServer(roster_debounce=3600)  # No roster updates mid-run
+        ids = [server.register_client(NullSocket(), ('10.0.0.1', i)) for i in range(n)]
+        sender, others = ids[0], ids[1:]
+        random.Random(1).shuffle(others)
+
+        def timed(targets, alerts):
+            start = time.perf_counter()
+            for _ in range(alerts):
+                server.broadcast_alert(sender, {'type': 'CUSTOM', 'message': 'x', 'bg': 'red'}, targets=targets)
+            return (time.perf_counter() - start) / alerts * 1e6
+
+        broadcast = timed(None, max(3, args.alerts // 20))
+        listed = timed(others[:10], args.alerts)
+        subscribed = 0
+        for subscribers in args.subscribers:
+            if subscribers > len(others):
+                continue
+            for client_id in others[subscribed:subscribers]:
+                server.clients.subscribe(client_id, ['ops'])
+            subscribed = subscribers
+            print(f"{n:>8} {subscribers:>12} {timed(['ops'], args.alerts):>10.1f} {broadcast:>13.1f} {listed:>10.1f}")
+
+def fetch_counters(admin_port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{admin_port}/metrics", timeout=5) as response:
+        snapshot = json.load(response)
+    return snapshot['counters'], snapshot['gauges']
+
+def bench_storm(args):
+    # Broadcast storm: a sender fires alerts back to back at N receivers.
+    # The server's own counters give send syscalls per message; delivery
+    # time is how long the receivers kept reading.
+    from outbound import MAX_WRITE_BATCH
+    alert = encode_message({'type': 'CUSTOM', 'message': 'x' * args.size, 'bg': '#ff4500', 'gif_url': None},
+                           FRAMING_BINARY)
+    print(f"{args.clients} receivers, {args.alerts} broadcasts of ~{args.size}B")
+    print(f"{'mode':<9} {'batch':>6} {'nodelay':>8} {'messages':>9} {'send calls':>11} {'msgs/call':>10} "
+          f"{'seconds':>8} {'msgs/s':>9} {'server cpu s':>13}")
+    for mode in args.modes:
+        for batch, nodelay in ((1, False), (1, True), (MAX_WRITE_BATCH, True)):
+            # Queues big enough that no alert is dropped for slow readers
+            server_args = ['--admin-port', str(args.admin_port), '--write-batch', str(batch), '--log-level', 'warning',
+                           '--tcp-nodelay' if nodelay else '--no-tcp-nodelay', '--queue-size', str(args.alerts + 100),
+                           '--rate-limit', 'alert=off']
+            proc = start_server(mode, args.port, server_args)
+            try:
+                receivers = open_clients(args.port, args.clients)
+                sender = open_clients(args.port, 1)[0]
+                drain(receivers + [sender])  # HELLO_ACKs and rosters
+                counters, gauges = fetch_counters(args.admin_port)
+                sender.setblocking(True)
+                start = time.perf_counter()
+                sender.sendall(alert * args.alerts)
+                drain(receivers, quiet=args.quiet)
+                elapsed = time.perf_counter() - start - args.quiet
+                after, after_gauges = fetch_counters(args.admin_port)
+                messages = after.get('messages_sent', 0) - counters.get('messages_sent', 0)
+                calls = after.get('send_calls', 0) - counters.get('send_calls', 0)
+                cpu = after_gauges['cpu_seconds'] - gauges['cpu_seconds']
+                print(f"{mode:<9} {batch:>6} {'on' if nodelay else 'off':>8} {messages:>9} {calls:>11} "
+                      f"{messages / max(calls, 1):>10.1f} {elapsed:>8.2f} {messages / elapsed:>9.0f} {cpu:>13.2f}")
+                close_clients(receivers + [sender])
+            finally:
+                stop_server(proc)
+
+def bench_connect_storm(args):
+    # N clients connect at the same instant, like an office after a server
+    # restart: how long until every one has its HELLO_ACK, for each listen
+    # backlog. Connections the backlog can't hold wait for a SYN retransmit
+    # (1s, 3s, 7s...) or fail.
+    import asyncio
+    from collections import Counter
+
+    async def connect(start, timings):
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', args.port), args.timeout)
+            writer.write(encode_message(hello_message(framings=[FRAMING_NDJSON])))
+            while True:
+                line = await asyncio.wait_for(reader.readline(), args.timeout)
+                if not line:
+                    raise ConnectionResetError("closed before HELLO_ACK")
+                if json.loads(line).get('type') == 'HELLO_ACK':
+                    break
+            timings.append(time.perf_counter() - start)
+            return writer
+        except (OSError, asyncio.TimeoutError, ValueError) as e:
+            return e
+
+    async def storm():
+        timings = []
+        start = time.perf_counter()
+        results = await asyncio.gather(*(connect(start, timings) for _ in range(args.clients)))
+        failures = Counter(type(result).__name__ for result in results
+                           if not isinstance(result, asyncio.StreamWriter))
+        for result in results:
+            if isinstance(result, asyncio.StreamWriter):
+                result.close()
+        return sorted(timings), failures
+
+    print(f"{args.clients} clients connecting at once")
+    print(f"{'mode':<9} {'backlog':>8} {'connected':>10} {'p50 ms':>8} {'p99 ms':>8} {'all s':>7}  failures")
+    for mode in args.modes:
+        for backlog in args.backlogs:
+            proc = start_server(mode, args.port, ['--backlog', str(backlog), '--log-level', 'warning'])
+            try:
+                timings, failures = asyncio.run(storm())
+            finally:
+                stop_server(proc)
+            p50 = timings[len(timings) // 2] * 1000 if timings else 0
+            p99 = timings[int(len(timings) * 0.99)] * 1000 if timings else 0
+            everyone = f"{timings[-1]:.2f}" if timings and not failures else '-'
+            print(f"{mode:<9} {backlog:>8} {len(timings):>10} {p50:>8.1f} {p99:>8.1f} {everyone:>7}  "
+                  f"{dict(failures) or ''}")
+
+def bench_flood(args):
+    # One client loops send_alert while another sends an alert every
+    # quarter second, to N receivers: how late the well-behaved alerts
+    # arrive and how much of the flood gets through, without per-client
+    # rate limits and with each limit policy
+    flood_alert = encode_message({'type': 'CUSTOM', 'message': 'x' * args.size, 'bg': '#ff4500', 'gif_url': None},
+                                 FRAMING_BINARY)
+    print(f"{args.clients} receivers, flooding for {args.duration}s, a normal alert every 0.25s")
+    print(f"{'mode':<9} {'limits':<9} {'flood sent':>11} {'flood/recv':>11} {'normal p50 ms':>14} "
+          f"{'normal p99 ms':>14} {'server cpu s':>13}")
+    for mode in args.modes:
+        for limits in ('off', 'throttle', 'drop'):
+            server_args = ['--admin-port', str(args.admin_port), '--log-level', 'error']
+            server_args += ['--rate-limit', 'alert=off'] if limits == 'off' else ['--rate-limit-policy', limits]
+            proc = start_server(mode, args.port, server_args)
+            try:
+                receivers = [BenchClient(args.port, framing=FRAMING_BINARY) for _ in range(args.clients)]
+                normal = BenchClient(args.port)
+                flooder = BenchClient(args.port, framing=FRAMING_BINARY)
+                latencies = []
+                flood_received = [0]
+                lock = threading.Lock()
+
+                def on_message(message):
+                    if message.get('type') != 'CUSTOM':
+                        return
+                    with lock:
+                        if 'sent' in message:
+                            latencies.append(time.time() - message['sent'])
+                        else:
+                            flood_received[0] += 1
+
+                for client in receivers + [normal, flooder]:
+                    handler = on_message if client in receivers else (lambda m: None)
+                    threading.Thread(target=client.read_forever, args=(handler,), daemon=True).start()
+                _, gauges = fetch_counters(args.admin_port)
+                stop = time.perf_counter() + args.duration
+                flood_sent = [0]
+
+                def flood():
+                    try:
+                        while time.perf_counter() < stop:
+                            flooder.sock.sendall(flood_alert * 10)
+                            flood_sent[0] += 10
+                    except OSError:
+                        pass  # Closed under it while blocked
+
+                thread = threading.Thread(target=flood, daemon=True)
+                thread.start()
+                while time.perf_counter() < stop:
+                    normal.send({'type': 'CUSTOM', 'message': 'normal', 'bg': '#ff4500', 'gif_url': None,
+                                 'sent': time.time()})
+                    time.sleep(0.25)
+                # The flooder may sit blocked in sendall while throttled
+                flooder.close()
+                thread.join(timeout=5)
+                time.sleep(args.quiet)
+                _, after_gauges = fetch_counters(args.admin_port)
+                with lock:
+                    latencies.sort()
+                    p50 = latencies[len(latencies) // 2] * 1000 if latencies else 0
+                    p99 = latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0
+                    per_receiver = flood_received[0] / args.clients
+                print(f"{mode:<9} {limits:<9} {flood_sent[0]:>11} {per_receiver:>11.0f} {p50:>14.1f} "
+                      f"{p99:>14.1f} {after_gauges['cpu_seconds'] - gauges['cpu_seconds']:>13.2f}")
+                for client in receivers + [normal]:
+                    client.close()
+            finally:
+                stop_server(proc)
+
+# Client-side GIF benchmarks. They need Pillow and requests, so the imports
+# are local. Frames stay PIL images (no Tk display here), so PhotoImage
+# conversion isn't timed and memory is PIL's, not Tk's.
+
+def wrap_prefixes(text, font_obj, max_width):
+    # How popups used to wrap: measure every growing prefix of the line
+    lines = []
+    current = ""
+    for word in text.split():
+        test = current + " " + word if current else word
+        if font_obj.measure(test) <= max_width:
+            current = test
+        else:
+            lines.append(current)
+            current = word
+    if current:
+        lines.append(current)
+    return lines
+
+def bench_popup(args):
+    # Popup open latency, short vs long message: wrapping alone (measuring
+    # prefixes vs the layout cache, empty and warm), then whole show_popup()
+    # calls up to Tk having drawn them
+    import statistics
+    import tkinter as tk
+    from client import AlertClient
+    from textlayout import TextLayout, shared_font
+    try:
+        root = tk.Tk()
+    except tk.TclError as e:
+        print(f"needs a display: {e}")
+        return
+    root.withdraw()
+    client = AlertClient()
+    client.root = root
+    label_font = shared_font("Arial", 36, "bold")
+    rng = random.Random(1)
+    vocabulary = ['alert', 'server', 'room', 'evacuate', 'meeting', 'freezer', 'temperature', 'now',
+                  'please', 'check', 'the', 'building', 'north', 'exit', 'immediately', 'a', 'of', 'to']
+    long_text = ''
+    while len(long_text) < args.size:
+        long_text += rng.choice(vocabulary) + ' '
+    messages = [('short', "Fire drill in 5 minutes"), (f"{args.size}B", long_text.strip())]
+
+    class Counting:
+        # Font stand-in counting measure() round trips
+        def __init__(self, font_obj):
+            self.font_obj = font_obj
+            self.calls = 0
+
+        def measure(self, text):
+            self.calls += 1
+            return self.font_obj.measure(text)
+
+    def median_ms(run):
+        samples = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            run()
+            samples.append((time.perf_counter() - start) * 1000)
+        return statistics.median(samples)
+
+    def open_popup(message, fresh):
+        if fresh:
+            client.text_layout = TextLayout()
+        popup, _ = client.show_popup(message)
+        root.update_idletasks()
+        popup.destroy()
+
+    print(f"{'message':<8} {'lines':>6} {'prefix wrap ms':>15} {'measures':>9} {'cache empty ms':>15} "
+          f"{'measures':>9} {'cached ms':>10} {'popup ms':>9} {'popup cached ms':>16}")
+    for name, message in messages:
+        counting = Counting(label_font)
+        wrap_prefixes(message, counting, 700)
+        prefix_measures = counting.calls
+        prefix_ms = median_ms(lambda: wrap_prefixes(message, label_font, 700))
+        layout = TextLayout()
+        lines = layout.wrap(message, label_font, 700)
+        measures = layout.measured
+        empty_ms = median_ms(lambda: TextLayout().wrap(message, label_font, 700))
+        cached_ms = median_ms(lambda: layout.wrap(message, label_font, 700))
+        popup_ms = median_ms(lambda: open_popup(message, True))
+        popup_cached_ms = median_ms(lambda: open_popup(message, False))
+        print(f"{name:<8} {len(lines):>6} {prefix_ms:>15.2f} {prefix_measures:>9} {empty_ms:>15.2f} {measures:>9} "
+              f"{cached_ms:>10.3f} {popup_ms:>9.2f} {popup_cached_ms:>16.2f}")
+    root.destroy()
+
+def make_gif(width, height, frame_count):
+    from PIL import Image
+    frames = [Image.effect_noise((width, height), 40 + i % 50).convert('RGB') for i in range(frame_count)]
+    buffer = io.BytesIO()
+    frames[0].save(buffer, format='GIF', save_all=True, append_images=frames[1:], duration=50, loop=0)
+    return buffer.getvalue()
+
+def serve_gif(gif_bytes, latency_ms):
+    # Local HTTP stand-in for the GIF host; returns (server, url)
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class GifHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency_ms / 1000)
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/gif')
+            self.send_header('Content-Length', str(len(gif_bytes)))
+            self.send_header('ETag', '"bench"')
+            self.end_headers()
+            self.wfile.write(gif_bytes)
+
+        def log_message(self, *args):
+            pass
+
+    http_server = ThreadingHTTPServer(('127.0.0.1', 0), GifHandler)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    return http_server, f"http://127.0.0.1:{http_server.server_address[1]}/bench.gif"
+
+def bench_media(args):
+    # One GIF alert to N desks: each downloading it from the GIF's host vs
+    # the sender uploading it to the server's media store once and the desks
+    # fetching it from there by hash, then the same alert again
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    from clientcore import AlertClientCore
+    from gifcache import DiskCache
+
+    gif_bytes = make_gif(args.gif_width, args.gif_height, args.frames)
+    http_server, url = serve_gif(gif_bytes, args.latency)
+    with tempfile.TemporaryDirectory() as media_dir, tempfile.TemporaryDirectory() as cache_dir:
+        proc = start_server('threaded', args.port, ['--media-dir', media_dir, '--media-port', str(args.media_port),
+                                                    '--admin-port', str(args.admin_port), '--log-level', 'warning'])
+        sender = AlertClientCore('bench', identity='bench-media', auto_reconnect=False)
+        try:
+            sender.connect_to_server('127.0.0.1', args.port)
+            deadline = time.time() + 5
+            while not sender.media_port and time.time() < deadline:
+                time.sleep(0.05)
+            print(f"GIF of {len(gif_bytes) // 1024} KB to {args.desks} desks, {args.latency} ms GIF host latency")
+            print(f"{'round':<16} {'host fetches':>13} {'server fetches':>15} {'MB sent':>8} {'all have it s':>14} "
+                  f"{'server cpu s':>13}")
+            sender_cache = DiskCache(os.path.join(cache_dir, 'sender'))
+            direct = [DiskCache(os.path.join(cache_dir, 'direct', str(i))) for i in range(args.desks)]
+            by_hash = [DiskCache(os.path.join(cache_dir, 'media', str(i))) for i in range(args.desks)]
+
+            def fetch_all(caches, desk_url):
+                with ThreadPoolExecutor(args.concurrency) as pool:
+                    list(pool.map(lambda cache: cache.fetch(desk_url), caches))
+
+            def timed_round(label, run, caches):
+                counters, gauges = fetch_counters(args.admin_port)
+                misses = sum(cache.misses for cache in caches + [sender_cache])
+                start = time.perf_counter()
+                host_fetches = run()
+                elapsed = time.perf_counter() - start
+                after, after_gauges = fetch_counters(args.admin_port)
+                served = after.get('media_served', 0) - counters.get('media_served', 0)
+                sent = (sum(cache.misses for cache in caches + [sender_cache]) - misses - served) * len(gif_bytes)
+                sent += after.get('media_bytes_served', 0) - counters.get('media_bytes_served', 0)
+                print(f"{label:<16} {host_fetches:>13} {served:>15} {sent / 1e6:>8.1f} {elapsed:>14.2f} "
+                      f"{after_gauges['cpu_seconds'] - gauges['cpu_seconds']:>13.2f}")
+
+            def from_host():
+                fetch_all(direct, url)
+                return args.desks
+
+            def through_store():
+                # The sender's client downloads the GIF and uploads it; the
+                # alert's hash gives every desk the same server URL
+                digest = sender.upload_media(sender_cache.fetch(url))
+                fetch_all(by_hash, sender.media_url(digest))
+                return 1
+
+            def repeat():
+                fetch_all(by_hash, sender.media_url(hashlib.sha256(gif_bytes).hexdigest()))
+                return 0
+
+            timed_round('gif_url', from_host, direct)
+            timed_round('media store', through_store, by_hash)
+            timed_round('media, repeated', repeat, by_hash)
+        finally:
+            sender.close()
+            stop_server(proc)
+            http_server.shutdown()
+
+def decode_all(data, width, height):
+    # What show_popup used to do: every frame resized up front
+    from PIL import Image, ImageSequence
+    im = Image.open(io.BytesIO(data))
+    ratio = max(width / im.size[0], height / im.size[1])
+    size = (int(im.size[0] * ratio), int(im.size[1] * ratio))
+    return [frame.resize(size, Image.Resampling.LANCZOS) for frame in ImageSequence.Iterator(im)]
+
+def make_loader(cache_dir, **options):
+    # GifLoader whose "Tk thread" is whoever drains the returned queue
+    import queue
+    from gifcache import DiskCache, GifCache
+    from gifloader import GifLoader
+    tk_queue = queue.Queue()
+    cache = GifCache(DiskCache(cache_dir))
+    loader = GifLoader(cache, lambda callback, *a: tk_queue.put((callback, a)), lambda frame: frame, **options)
+    return loader, tk_queue
+
+def pump_until(tk_queue, predicate, timeout=60):
+    while not predicate():
+        callback, callback_args = tk_queue.get(timeout=timeout)
+        callback(*callback_args)
+
+def bench_gif(args):
+    # Tk-thread blocking and time to first/all frames, old path vs loader
+    import tempfile
+    import requests
+    from gifcache import HTTP_HEADERS
+
+    gif_bytes = make_gif(args.gif_width, args.gif_height, args.frames)
+    http_server, url = serve_gif(gif_bytes, args.latency)
+    print(f"GIF {args.gif_width}x{args.gif_height}, {args.frames} frames, {len(gif_bytes) // 1024} KB, "
+          f"{args.latency} ms server latency, popup 800x600")
+
+    start = time.perf_counter()
+    response = requests.get(url, headers=HTTP_HEADERS, timeout=10)
+    decode_all(response.content, 800, 600)
+    blocked = (time.perf_counter() - start) * 1000
+    print(f"{'synchronous':<12} tk blocked {blocked:8.1f} ms   first frame {blocked:8.1f} ms   "
+          f"all frames {blocked:8.1f} ms")
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        loader, tk_queue = make_loader(cache_dir)
+        for label in ('loader cold', 'loader warm'):
+            start = time.perf_counter()
+            frames = loader.load(url, 800, 600)
+            blocked = (time.perf_counter() - start) * 1000
+            pump_until(tk_queue, lambda: frames.frames)
+            first = (time.perf_counter() - start) * 1000
+            pump_until(tk_queue, lambda: frames.complete)
+            last = (time.perf_counter() - start) * 1000
+            print(f"{label:<12} tk blocked {blocked:8.1f} ms   first frame {first:8.1f} ms   "
+                  f"all frames {last:8.1f} ms")
+        print(f"cache stats: {loader.cache.stats()}")
+        loader.shutdown()
+    http_server.shutdown()
+
+GIF_MEMORY_MODES = {
+    # mode: GifLoader options (None = old eager path)
+    'eager': None,
+    'prerender': {'memory_budget': 1 << 40},
+    'budget': {},
+    'stream': {'memory_budget': 0},
+    'stream-half': {'memory_budget': 0, 'downscale': 2},
+}
+
+def gif_memory_child(args):
+    # Runs in its own process so ru_maxrss is this mode's peak alone
+    import resource
+    import tempfile
+    import requests
+    from gifcache import HTTP_HEADERS
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        start = time.perf_counter()
+        options = GIF_MEMORY_MODES[args.child]
+        if options is None:
+            response = requests.get(args.url, headers=HTTP_HEADERS, timeout=10)
+            frames = decode_all(response.content, 800, 600)
+            first = time.perf_counter() - start
+            shown = len(frames)
+        else:
+            loader, tk_queue = make_loader(cache_dir, **options)
+            frames = loader.load(args.url, 800, 600)
+            shown = 0
+            first = None
+            # Play two full loops, pulling frames as fast as they come
+            while shown < args.frames * 2:
+                frame = frames.next_frame()
+                if frame is None:
+                    pump_until(tk_queue, lambda: frames.frames or frames.ring)
+                    continue
+                if first is None:
+                    first = time.perf_counter() - start
+                shown += 1
+            loader.shutdown()
+        total = time.perf_counter() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'first_ms': first * 1000, 'total_ms': total * 1000, 'peak_rss_mb': peak_kb / 1024,
+                      'frames_shown': shown}))
+
+def bench_gif_memory(args):
+    # Peak RSS and time to first frame for eager decoding vs the loader's
+    # pre-rendered and streaming modes
+    if args.child:
+        gif_memory_child(args)
+        return
+
+    gif_bytes = make_gif(args.gif_width, args.gif_height, args.frames)
+    http_server, url = serve_gif(gif_bytes, 0)
+    print(f"GIF {args.gif_width}x{args.gif_height}, {args.frames} frames, {len(gif_bytes) // 1024} KB, "
+          f"popup 800x600, two loops played")
+    print(f"{'mode':<12} {'first frame ms':>15} {'total ms':>10} {'peak RSS MB':>12}")
+    for mode in args.modes:
+        cmd = [sys.executable, os.path.abspath(__file__), 'gif-memory', '--child', mode, '--url', url,
+               '--frames', str(args.frames)]
+        result = json.loads(subprocess.run(cmd, capture_output=True, text=True, check=True).stdout)
+        print(f"{mode:<12} {result['first_ms']:>15.1f} {result['total_ms']:>10.1f} {result['peak_rss_mb']:>12.1f}")
+    http_server.shutdown()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Alert server benchmarks")
+    parser.add_argument('--port', type=int, default=BENCH_PORT)
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    idle = sub.add_parser('idle', help="memory per idle connection, threaded vs async")
+    idle.add_argument('--clients', type=int, default=500)
+    idle.add_argument('--modes', nargs='+', default=['threaded', 'async'])
+    idle.add_argument('--legacy', action='store_true', help="connect as pre-HELLO clients")
+    idle.set_defaults(func=bench_idle)
+
+    throughput = sub.add_parser('throughput', help="paced targeted alerts, checks framing under load")
+    throughput.add_argument('--mode', choices=['threaded', 'async'], default='threaded')
+    throughput.add_argument('--connections', type=int, default=4)
+    throughput.add_argument('--rate', type=int, default=1000, help="messages/sec per connection")
+    throughput.add_argument('--duration', type=int, default=5, help="seconds")
+    throughput.add_argument('--size', type=int, default=2000, help="message text length")
+    throughput.add_argument('--workers', type=int, default=1, help="server worker processes")
+    throughput.add_argument('--framing', choices=SUPPORTED_FRAMINGS, default=FRAMING_NDJSON)
+    throughput.add_argument('--unframed', action='store_true',
+                            help="behave like a pre-framing client, for comparison")
+    throughput.set_defaults(func=bench_throughput)
+
+    wire = sub.add_parser('wire', help="encode/decode cost and bytes on the wire, JSON vs binary")
+    wire.add_argument('--messages', type=int, default=50000)
+    wire.set_defaults(func=bench_wire)
+
+    log = sub.add_parser('log', help="alert log append throughput, group commit vs fsync per alert")
+    log.add_argument('--appends', type=int, default=20000)
+    log.add_argument('--threads', type=int, default=4)
+    log.add_argument('--size', type=int, default=200, help="approximate alert text length")
+    log.set_defaults(func=bench_log)
+
+    client_startup = sub.add_parser('client-startup', help="import time and memory, headless core vs Tk client")
+    client_startup.add_argument('--runs', type=int, default=5)
+    client_startup.set_defaults(func=bench_client_startup)
+
+    registry = sub.add_parser('registry', help="register/iterate/unregister microbenchmark")
+    registry.add_argument('--clients', type=int, default=50000)
+    registry.add_argument('--iterations', type=int, default=20, help="full iteration passes")
+    registry.set_defaults(func=bench_registry)
+
+    heartbeat = sub.add_parser('heartbeat', help="idle-client detection per tick, timer wheel vs full scan")
+    heartbeat.add_argument('--clients', type=int, default=50000)
+    heartbeat.add_argument('--active', type=float, default=0.1, help="share of clients sending every second")
+    heartbeat.add_argument('--interval', type=float, default=30.0)
+    heartbeat.add_argument('--seconds', type=int, default=120, help="simulated run length")
+    heartbeat.set_defaults(func=bench_heartbeat)
+
+    multicast = sub.add_parser('multicast', help="alert cost to a topic vs a broadcast, by subscribers and clients")
+    multicast.add_argument('--clients', type=int, nargs='+', default=[1000, 10000, 50000])
+    multicast.add_argument('--subscribers', type=int, nargs='+', default=[10, 100, 1000])
+    multicast.add_argument('--alerts', type=int, default=200, help="alerts timed per cell (broadcasts: 1/20th)")
+    multicast.set_defaults(func=bench_multicast)
+
+    storm = sub.add_parser('storm', help="broadcast storm: send syscalls per message and delivery rate, "
+                                         "batched writes vs one send per message")
+    storm.add_argument('--modes', nargs='+', choices=['threaded', 'async'], default=['threaded', 'async'])
+    storm.add_argument('--clients', type=int, default=200)
+    storm.add_argument('--alerts', type=int, default=500)
+    storm.add_argument('--size', type=int, default=100, help="alert text length")
+    storm.add_argument('--port', type=int, default=BENCH_PORT)
+    storm.add_argument('--admin-port', type=int, default=BENCH_PORT + 1)
+    storm.add_argument('--quiet', type=float, default=1.0, help="seconds of silence that end the run")
+    storm.set_defaults(func=bench_storm)
+
+    connect_storm = sub.add_parser('connect-storm', help="time until N simultaneous clients are all connected, "
+                                                         "by listen backlog")
+    connect_storm.add_argument('--modes', nargs='+', choices=['threaded', 'async'], default=['threaded', 'async'])
+    connect_storm.add_argument('--clients', type=int, default=500)
+    connect_storm.add_argument('--backlogs', type=int, nargs='+', default=[5, 1024])
+    connect_storm.add_argument('--timeout', type=float, default=30.0, help="per client")
+    connect_storm.add_argument('--port', type=int, default=BENCH_PORT)
+    connect_storm.set_defaults(func=bench_connect_storm)
+
+    flood = sub.add_parser('flood', help="one client looping send_alert: latency of everyone else's alerts, "
+                                         "with and without per-client rate limits")
+    flood.add_argument('--modes', nargs='+', choices=['threaded', 'async'], default=['threaded', 'async'])
+    flood.add_argument('--clients', type=int, default=200, help="receivers")
+    flood.add_argument('--duration', type=float, default=5.0, help="seconds")
+    flood.add_argument('--size', type=int, default=100, help="flood alert text length")
+    flood.add_argument('--port', type=int, default=BENCH_PORT)
+    flood.add_argument('--admin-port', type=int, default=BENCH_PORT + 1)
+    flood.add_argument('--quiet', type=float, default=1.0, help="seconds to let deliveries finish")
+    flood.set_defaults(func=bench_flood)
+
+    gif = sub.add_parser('gif', help="client GIF loading latency against a local HTTP stand-in")
+    gif.add_argument('--latency', type=int, default=300, help="HTTP server delay in ms")
+    gif.add_argument('--frames', type=int, default=30)
+    gif.add_argument('--gif-width', type=int, default=400)
+    gif.add_argument('--gif-height', type=int, default=300)
+    gif.set_defaults(func=bench_gif)
+
+    popup = sub.add_parser('popup', help="popup open latency and text wrapping cost, short vs long messages")
+    popup.add_argument('--size', type=int, default=2048, help="long message length")
+    popup.add_argument('--runs', type=int, default=20)
+    popup.set_defaults(func=bench_popup)
+
+    media = sub.add_parser('media', help="GIF alert to N desks: each fetching from the GIF host vs the server's "
+                                         "media store, and repeated")
+    media.add_argument('--desks', type=int, default=300)
+    media.add_argument('--concurrency', type=int, default=50, help="desks fetching at once")
+    media.add_argument('--latency', type=int, default=100, help="GIF host delay in ms")
+    media.add_argument('--frames', type=int, default=30)
+    media.add_argument('--gif-width', type=int, default=400)
+    media.add_argument('--gif-height', type=int, default=300)
+    media.add_argument('--media-port', type=int, default=BENCH_PORT + 2)
+    media.add_argument('--admin-port', type=int, default=BENCH_PORT + 1)
+    media.set_defaults(func=bench_media)
+
+    gif_memory = sub.add_parser('gif-memory', help="peak RSS and time to first frame per GIF decoding mode")
+    gif_memory.add_argument('--frames', type=int, default=200)
+    gif_memory.add_argument('--gif-width', type=int, default=200)
+    gif_memory.add_argument('--gif-height', type=int, default=150)
+    gif_memory.add_argument('--modes', nargs='+', choices=list(GIF_MEMORY_MODES), default=list(GIF_MEMORY_MODES))
+    gif_memory.add_argument('--child', choices=list(GIF_MEMORY_MODES), help=argparse.SUPPRESS)
+    gif_memory.add_argument('--url', help=argparse.SUPPRESS)
+    gif_memory.set_defaults(func=bench_gif_memory)
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.func(args)
@@ -1,155 +1,76 @@
-import socket
 import tkinter as tk
 from tkinter import font, ttk, messagebox, simpledialog
-import threading
-import requests
-from PIL import Image, ImageTk
-from PIL import ImageSequence
-import io
+import functools
 import random
-import json
+import threading
+
+from clientcore import AlertClientCore, PORT
+from templates import render_template, template_params
+from popupqueue import PopupScheduler, MAX_VISIBLE_POPUPS, MAX_POPUP_RATE
+from ticker import AnimationTicker
+from textlayout import TextLayout, shared_font
+
+# Tk front end on top of AlertClientCore (clientcore.py). The core's hooks
+# run on its receiver thread and are handed to the Tk thread with
+# root.after. PIL and requests (GIF loading and caching) are only imported
+# once the window is created.
 
-PORT = 12345
+SNOW_LANE_SPEEDS = (1.0, 2.0, 3.0)  # Pixels per snow tick
 
-class AlertClient:
-    def __init__(self):
-        self.socket = None
-        self.connected = False
-        self.sent_count = 0
-        self.received_count = 0
-        self.username = "Anonymous"
-        self.other_clients = []  # List of other connected clients
+class AlertClient(AlertClientCore):
+    def __init__(self, max_visible_popups=MAX_VISIBLE_POPUPS, popup_rate=MAX_POPUP_RATE):
+        super().__init__()
         self.target_client_id = None  # For targeted messages
+        self.roster_view = []  # Last roster shown in the dropdown (Tk thread)
         
-        # Alert definitions (same as original)
-        self.alerts = {
-            'STOP': {
-                'message': "Stop Scrolling! 😊",
-                'bg': "#ff4500",
-                'gif_url': 'https://media1.tenor.com/m/DafLbvYgt50AAAAC/trump-donald-trump.gif'
-            },
-            'COLD': {
-                'message': "Turning off the AC, it's freezing! ❄️🥶❄️",
-                'bg': "#1e90ff",
-                'gif_url': 'https://media1.tenor.com/m/ShXWuFDDZ8wAAAAd/vtactor007-rwmartin.gif'
-            },
-            'ALERT1': {
-                'message': "Working hard!",
-                'bg': "#00ff00",
-                'gif_url': 'https://media1.tenor.com/m/yHhqdtTladoAAAAC/cat-typing-typing.gif'
-            },
-            'ALERT2': {
-                'message': "Hardly working!",
-                'bg': "#ffff00",
-                'gif_url': 'https://media1.tenor.com/m/3pwRCgEnqN8AAAAC/sleeping-at-work-fail.gif'
-            },
-            'ALERT3': {
-                'message': "Ansys!",
-                'bg': "#ff00ff",
-                'gif_url': 'https://media1.tenor.com/m/7zrtEDHtArcAAAAC/ronswanson-parksandrec.gif'
-            },
-        }
+        # Downloaded GIFs on disk, decoded popup frames in memory (made in create_gui)
+        self.gif_cache = None
+        
+        # Alert storms: duplicates collapse into a counter, popups open at a
+        # limited rate and only a few at a time (scheduler made in create_gui)
+        self.max_visible_popups = max_visible_popups
+        self.popup_rate = popup_rate
+        self.popups = None
+        
+        # Wrapped popup messages, so a repeated alert isn't measured again
+        self.text_layout = TextLayout()
     
-    def connect_to_server(self, host='127.0.0.1'):
-        try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((host, PORT))
-            self.connected = True
-            print(f"Connected to server at {host}:{PORT}")
-            
-            # Start receiver thread
-            receiver_thread = threading.Thread(target=self.receiver, daemon=True)
-            receiver_thread.start()
-            
-            # Request client list
-            self.request_client_list()
-            
+    def connect_to_server(self, host='127.0.0.1', port=PORT):
+        if super().connect_to_server(host, port):
             return True
-        except Exception as e:
-            print(f"Failed to connect to server: {e}")
-            messagebox.showerror("Connection Error", f"Failed to connect to server: {e}")
-            return False
+        messagebox.showerror("Connection Error", f"Failed to connect to server: {self.connection_error}")
+        return False
     
-    def receiver(self):
-        while self.connected:
-            try:
-                data = self.socket.recv(1024).decode('utf-8')
-                if not data:
-                    break
-                
-                try:
-                    message_data = json.loads(data)
-                    self.process_received_message(message_data)
-                except json.JSONDecodeError:
-                    # Handle legacy messages if any
-                    print(f"Received non-JSON data: {data}")
-                    
-            except Exception as e:
-                if self.connected:
-                    print(f"Receiver error: {e}")
-                break
-        
-        self.connected = False
-        if hasattr(self, 'root'):
-            self.root.after(0, self.on_disconnected)
+    # Core hooks, from the receiver thread
     
-    def process_received_message(self, message_data):
-        message_type = message_data.get('type')
-        
-        if message_type == 'CUSTOM':
-            # Custom alert
-            message = message_data['message']
-            bg = message_data['bg']
-            gif_url = message_data.get('gif_url')
-            sender = message_data.get('sender_username', 'Unknown')
-            
-            self.received_count += 1
-            self.root.after(0, lambda: self.show_popup(f"From {sender}:\n{message}", bg, gif_url))
-            self.root.after(0, self.update_counters)
-            
-        elif message_type == 'LEGACY_ALERT':
-            # Legacy alert (STOP, COLD, etc.)
-            alert_type = message_data['alert_type']
-            sender = message_data.get('sender_username', 'Unknown')
-            
-            if alert_type in self.alerts:
-                info = self.alerts[alert_type]
-                self.received_count += 1
-                self.root.after(0, lambda: self.show_popup(f"From {sender}:\n{info['message']}", info['bg'], info['gif_url']))
-                self.root.after(0, self.update_counters)
-                
-        elif message_type == 'CLIENT_LIST_RESPONSE':
-            # Update client list
-            self.other_clients = message_data['clients']
-            self.root.after(0, self.update_client_dropdown)
+    def on_alert(self, alert):
+        self.root.after(0, self.queue_popup, alert.key, f"{alert.header()}\n{alert.message}", alert.bg, alert.gif_url)
+        self.root.after(0, self.update_counters)
     
-    def request_client_list(self):
-        if self.connected:
-            request = {'type': 'CLIENT_LIST_REQUEST'}
-            self.send_message(request)
+    def on_roster(self, clients):
+        self.root.after(0, self.update_client_dropdown, clients)
     
-    def send_message(self, data):
-        if self.connected:
-            try:
-                message = json.dumps(data)
-                self.socket.send(message.encode('utf-8'))
-                return True
-            except Exception as e:
-                print(f"Failed to send message: {e}")
-                return False
-        return False
+    def on_templates(self, changed):
+        self.root.after(0, self.show_templates, changed)
+    
+    def on_disconnected(self):
+        if hasattr(self, 'root'):
+            self.root.after(0, self.show_disconnected)
+    
+    def on_reconnecting(self, attempt, delay):
+        if hasattr(self, 'root'):
+            self.root.after(0, self.status_var.set, f"Connection lost - reconnecting in {delay:.1f}s (attempt {attempt})...")
+    
+    def on_reconnected(self):
+        if hasattr(self, 'root'):
+            self.root.after(0, self.status_var.set, "Reconnected to server")
     
     def send_alert(self, alert_type):
-        self.sent_count += 1
-        
-        if self.connected:
-            # Send to server for broadcasting/targeting
-            self.socket.send(alert_type.encode('utf-8'))
-        else:
+        if not super().send_alert(alert_type):
             # Dev mode - show locally
+            self.sent_count += 1
             info = self.alerts[alert_type]
-            self.show_popup(info['message'], info['bg'], info['gif_url'])
-        
+            self.queue_popup((None, alert_type), info['message'], info['bg'], info['gif_url'])
         self.update_counters()
     
     def send_custom(self, msg, gif):
@@ -160,20 +81,14 @@ class AlertClient:
         bg = random.choice(['#ff4500', '#1e90ff', '#00ff00', '#ffff00', '#ff00ff'])
         gif_url = gif if gif != "GIF URL (optional)" else None
         
-        self.sent_count += 1
-        
-        if self.connected:
-            custom_data = {
-                'type': 'CUSTOM',
-                'message': msg,
-                'bg': bg,
-                'gif_url': gif_url,
-                'target_id': self.target_client_id  # None for broadcast, specific ID for targeted
-            }
-            self.send_message(custom_data)
-        else:
+        if gif_url and self.media_port:
+            # Through the server's media store, uploaded off the Tk thread
+            threading.Thread(target=self.share_custom, args=(msg, bg, gif_url, self.target_client_id),
+                             daemon=True).start()
+        elif not super().send_custom(msg, bg, gif_url, self.target_client_id):
             # Dev mode - show locally
-            self.show_popup(msg, bg, gif_url)
+            self.sent_count += 1
+            self.queue_popup((None, 'CUSTOM', msg), msg, bg, gif_url)
         
         self.update_counters()
         
@@ -183,16 +98,48 @@ class AlertClient:
         self.gif_entry.delete(0, tk.END)
         self.gif_entry.insert(0, "GIF URL (optional)")
     
-    def set_username(self):
+    def share_custom(self, msg, bg, gif_url, target_id):
+        # Background thread. The GIF is uploaded once (and only if the server
+        # doesn't have it); recipients then fetch it from the server by hash
+        # rather than each from gif_url. Clients without the media feature
+        # still get gif_url.
+        media = None
+        try:
+            media = self.upload_media(self.gif_cache.disk.fetch(gif_url))
+        except Exception as e:
+            print(f"Error sharing GIF through the server, sending the URL only: {e}")
+        super().send_custom(msg, bg, gif_url, target_id, media=media)
+        self.root.after(0, self.update_counters)
+    
+    def send_selected_template(self):
+        template_id = self.template_var.get()
+        template = self.templates.get(template_id)
+        if not template:
+            return
+        params = {}
+        for name in template_params(template):
+            value = simpledialog.askstring("Template", f"{name}:")
+            if value is None:
+                return
+            params[name] = value
+        
+        if not self.send_template(template_id, params, self.target_client_id):
+            # Dev mode - show locally
+            self.sent_count += 1
+            message, bg, gif_url = render_template(template, params)
+            self.queue_popup((None, template_id, tuple(sorted(params.items()))), message, bg, gif_url)
+        self.update_counters()
+    
+    def show_templates(self, changed):
+        if changed:
+            # Pre-warm the GIFs of every template, so no alert waits on a download
+            self.gif_cache.prefetch([t['gif_url'] for t in self.templates.values() if t.get('gif_url')])
+        self.template_dropdown['values'] = sorted(self.templates)
+    
+    def ask_username(self):
         new_username = simpledialog.askstring("Username", "Enter your username:", initialvalue=self.username)
         if new_username:
-            self.username = new_username
-            if self.connected:
-                username_data = {
-                    'type': 'SET_USERNAME',
-                    'username': new_username
-                }
-                self.send_message(username_data)
+            self.set_username(new_username)
             
             # Update window title
             self.root.title(f"Alert App - {self.username}")
@@ -203,15 +150,16 @@ class AlertClient:
             self.target_client_id = None
         else:
             # Extract client ID from selection
-            for client in self.other_clients:
+            for client in self.roster_view:
                 if f"{client['username']} (ID: {client['id']})" == selection:
                     self.target_client_id = client['id']
                     break
     
-    def update_client_dropdown(self):
-        # Update the dropdown with connected clients
+    def update_client_dropdown(self, clients):
+        # Tk thread: clients is the roster the core just applied
+        self.roster_view = clients
         client_options = ["All Clients"]
-        for client in self.other_clients:
+        for client in clients:
             client_options.append(f"{client['username']} (ID: {client['id']})")
         
         self.target_dropdown['values'] = client_options
@@ -219,31 +167,44 @@ class AlertClient:
             self.target_var.set("All Clients")
         
         # Update status label
-        self.status_var.set(f"Connected clients: {len(self.other_clients)}")
+        self.status_var.set(f"Connected clients: {len(clients)}")
     
-    def on_disconnected(self):
+    def show_disconnected(self):
         messagebox.showwarning("Disconnected", "Connection to server lost!")
         self.status_var.set("Disconnected")
         self.target_dropdown['values'] = ["All Clients"]
         self.target_var.set("All Clients")
     
-    def wrap_text(self, text, font_obj, max_width):
-        lines = []
-        words = text.split()
-        current = ""
-        for word in words:
-            test = current + " " + word if current else word
-            w = font_obj.measure(test)
-            if w <= max_width:
-                current = test
-            else:
-                lines.append(current)
-                current = word
-        if current:
-            lines.append(current)
-        return lines
+    def queue_popup(self, key, message, bg_color, gif_url=None):
+        # Tk thread. Alerts with the same key collapse into one popup
+        self.popups.submit(key, message, bg_color, gif_url)
     
-    def show_popup(self, message, bg_color="#ff4500", gif_url=None):
+    def show_queued_popup(self, alert):
+        # Called by the scheduler when a popup slot is free
+        offset = 40 * (len(self.popups.visible) - 1)  # Cascade popups that are open together
+        popup, canvas = self.show_popup(alert.message, alert.bg, alert.gif_url, offset)
+        
+        # Counter badge, shown once the same alert arrives again
+        badge_bg = canvas.create_oval(730, 20, 780, 70, fill="#ff0000", outline="white", width=3, state='hidden')
+        badge_text = canvas.create_text(755, 45, text="", font=("Arial", 16, "bold"), fill="white", state='hidden')
+        
+        def on_count(count):
+            if popup.winfo_exists():
+                canvas.itemconfig(badge_text, text=f"×{count}" if count < 100 else "99+", state='normal')
+                canvas.itemconfig(badge_bg, state='normal')
+        
+        alert.on_count = on_count
+        if alert.count > 1:
+            on_count(alert.count)
+        
+        def on_destroy(event):
+            if event.widget is popup:
+                alert.on_count = None
+                self.popups.closed(alert)
+        
+        popup.bind('<Destroy>', on_destroy, add='+')
+    
+    def show_popup(self, message, bg_color="#ff4500", gif_url=None, offset=0):
         popup = tk.Toplevel(self.root)
         popup.title("ALERT!")
         
@@ -252,8 +213,8 @@ class AlertClient:
         height = 600
         screen_width = self.root.winfo_screenwidth()
         screen_height = self.root.winfo_screenheight()
-        x = (screen_width - width) // 2
-        y = (screen_height - height) // 2
+        x = (screen_width - width) // 2 + offset
+        y = (screen_height - height) // 2 + offset
         popup.geometry(f"{width}x{height}+{x}+{y}")
         
         popup.attributes('-topmost', True)
@@ -265,80 +226,76 @@ class AlertClient:
         canvas = tk.Canvas(popup, bg=bg_color, highlightthickness=0)
         canvas.pack(fill='both', expand=True)
         
-        # Handle GIF background
+        # Handle GIF background. The popup shows bg_color right away; the
+        # loader decodes in the background and frames join the animation as
+        # they arrive.
         if gif_url:
-            try:
-                headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
-                response = requests.get(gif_url, headers=headers, timeout=10)
-                if response.status_code == 200:
-                    gif_data = io.BytesIO(response.content)
-                    im = Image.open(gif_data)
-                    img_w, img_h = im.size
-                    ratio = max(width / img_w, height / img_h)
-                    new_w = int(img_w * ratio)
-                    new_h = int(img_h * ratio)
-                    
-                    resized_frames = []
-                    for frame in ImageSequence.Iterator(im):
-                        frame = frame.resize((new_w, new_h), Image.Resampling.LANCZOS)
-                        resized_frames.append(ImageTk.PhotoImage(frame))
-                    
-                    if resized_frames:
-                        duration = im.info.get('duration', 100)
-                        image_id = canvas.create_image(width / 2, height / 2, anchor='center')
-                        
-                        def update_gif(ind=0):
-                            if popup.winfo_exists():
-                                frame = resized_frames[ind]
-                                canvas.itemconfig(image_id, image=frame)
-                                canvas.image = frame
-                                ind = (ind + 1) % len(resized_frames)
-                                popup.after(duration, update_gif, ind)
-                        
-                        update_gif()
-                        canvas.frames = resized_frames
-                        
-            except Exception as e:
+            image_id = canvas.create_image(width / 2, height / 2, anchor='center')
+            
+            def on_error(e):
                 print(f"Error loading GIF: {e}")
-        
-        # Message text with shadow
-        label_font = font.Font(family="Arial", size=36, weight="bold")
-        lines = self.wrap_text(message, label_font, width - 100)
-        y = 100
-        linespace = label_font.metrics("linespace")
-        for line in lines:
-            canvas.create_text(width / 2 + 2, y + 2, text=line, font=label_font, fill="black", anchor='center')
-            canvas.create_text(width / 2, y, text=line, font=label_font, fill="white", anchor='center')
-            y += linespace
+            
+            frames = self.gif_loader.load(gif_url, width, height, on_error)
+            
+            def update_gif():
+                frame = frames.next_frame()
+                if frame is None:
+                    # Nothing decoded yet, check back soon
+                    return None if frames.failed else 20
+                if frame is not canvas.image:
+                    canvas.itemconfig(image_id, image=frame)
+                    canvas.image = frame
+                return frames.duration
+            
+            canvas.image = None
+            self.ticker.add(canvas, update_gif)
+            # Stop decoding once the popup is closed, even mid-load
+            popup.bind('<Destroy>', lambda event: frames.cancel() if event.widget is popup else None, add='+')
+        
+        # Message text with shadow: one text item each for all the lines,
+        # the first line centered at y=100
+        label_font = shared_font("Arial", 36, "bold")
+        text = "\n".join(self.text_layout.wrap(message, label_font, width - 100))
+        top = 100 - self.text_layout.linespace(label_font) / 2
+        canvas.create_text(width / 2 + 2, top + 2, text=text, font=label_font, fill="black", anchor='n', justify='center')
+        canvas.create_text(width / 2, top, text=text, font=label_font, fill="white", anchor='n', justify='center')
         
         # OK button
-        button_font = font.Font(family="Arial", size=20)
+        button_font = shared_font("Arial", 20)
         button = tk.Button(popup, text="OK", command=popup.destroy, font=button_font,
                            bg="#32cd32", fg="white", activebackground="#228b22", padx=30, pady=15)
         canvas.create_window(width / 2, height - 80, window=button, anchor='center')
         
-        # Snowfall effect for cold alerts
+        # Snowfall effect for cold alerts. Flakes fall in a few speed lanes,
+        # each moved with one canvas call per tick through its tag; positions
+        # are tracked here so only flakes that reach the bottom need coords().
         if "freezing" in message.lower() or "cold" in message.lower():
-            snowflakes = []
+            lanes = [(f"snow{i}", speed, []) for i, speed in enumerate(SNOW_LANE_SPEEDS)]
             for _ in range(50):
+                tag, _, flakes = random.choice(lanes)
                 x = random.randint(0, width)
                 y = random.randint(0, height)
                 size = random.randint(2, 5)
-                flake = canvas.create_oval(x, y, x + size, y + size, fill="white", outline="")
-                speed = random.uniform(1, 3)
-                snowflakes.append((flake, speed))
+                flake = canvas.create_oval(x, y, x + size, y + size, fill="white", outline="", tags=tag)
+                flakes.append([flake, x, y, size])
             
             def animate_snow():
-                if popup.winfo_exists():
-                    for flake, speed in snowflakes:
-                        canvas.move(flake, random.uniform(-1, 1), speed)
-                        pos = canvas.coords(flake)
-                        if pos and len(pos) >= 4 and pos[3] > height:
-                            canvas.move(flake, 0, -height - size)
-                            canvas.move(flake, random.randint(-50, 50), 0)
-                    popup.after(50, animate_snow)
+                for tag, speed, flakes in lanes:
+                    drift = random.uniform(-1, 1)
+                    canvas.move(tag, drift, speed)
+                    for state in flakes:
+                        state[1] += drift
+                        state[2] += speed
+                        if state[2] > height:
+                            flake, _, _, size = state
+                            state[1] = random.randint(0, width)
+                            state[2] = -size
+                            canvas.coords(flake, state[1], state[2], state[1] + size, state[2] + size)
+                return 50
             
-            animate_snow()
+            self.ticker.add(canvas, animate_snow)
+        
+        return popup, canvas
     
     def update_counters(self):
         self.my_received_var.set(f"Alerts Received: {self.received_count}")
@@ -347,6 +304,15 @@ class AlertClient:
     def create_gui(self):
         self.root = tk.Tk()
         self.root.title(f"Alert App - {self.username}")
+        # The imaging and HTTP stacks are only needed once there is a window
+        from PIL import ImageTk
+        from gifcache import GifCache
+        from gifloader import GifLoader
+        self.gif_cache = GifCache()
+        self.gif_loader = GifLoader(self.gif_cache, functools.partial(self.root.after, 0), ImageTk.PhotoImage)
+        self.ticker = AnimationTicker(self.root)  # Drives every popup animation
+        self.popups = PopupScheduler(self.show_queued_popup, self.root.after,
+                                     self.max_visible_popups, self.popup_rate)
         self.root.geometry("1200x900")
         self.root.configure(bg="#f0f8ff")
         
@@ -370,7 +336,7 @@ class AlertClient:
         control_frame = tk.Frame(self.root, bg="#f0f8ff")
         control_frame.pack(pady=5)
         
-        tk.Button(control_frame, text="Set Username", command=self.set_username, 
+        tk.Button(control_frame, text="Set Username", command=self.ask_username, 
                  bg="#4CAF50", fg="white", font=button_font, padx=10).pack(side='left', padx=5)
         
         tk.Button(control_frame, text="Refresh Clients", command=self.request_client_list,
@@ -447,12 +413,32 @@ class AlertClient:
         tk.Button(row3, text="Ansys!", command=lambda: self.send_alert('ALERT3'),
                  bg="#ff00ff", fg="white", font=button_font, padx=20, pady=10, width=20).pack(side='left', padx=10)
         
+        # Any alert template the server hosts, sent to the selected target
+        template_frame = tk.Frame(self.root, bg="#f0f8ff")
+        template_frame.pack(pady=10)
+        
+        tk.Label(template_frame, text="Template:", bg="#f0f8ff", font=button_font).pack(side='left', padx=5)
+        
+        self.template_var = tk.StringVar()
+        self.template_dropdown = ttk.Combobox(template_frame, textvariable=self.template_var,
+                                              values=sorted(self.templates), state="readonly", width=25)
+        self.template_dropdown.pack(side='left', padx=5)
+        
+        tk.Button(template_frame, text="Send Template", command=self.send_selected_template,
+                 bg="#9C27B0", fg="white", font=button_font, padx=15, pady=5).pack(side='left', padx=5)
+        
         return self.root
     
     def run(self, server_host='127.0.0.1', dev_mode=False):
         # Create GUI first
         root = self.create_gui()
         
+        # Download the built-in alert GIFs while the user is still connecting
+        # (and those of the templates cached from the last run)
+        urls = {info['gif_url'] for info in self.alerts.values()}
+        urls.update(t['gif_url'] for t in self.templates.values() if t.get('gif_url'))
+        self.gif_cache.prefetch(sorted(urls))
+        
         if not dev_mode:
             # Try to connect to server
             if not self.connect_to_server(server_host):
@@ -467,12 +453,12 @@ class AlertClient:
         root.mainloop()
     
     def on_closing(self):
-        if self.connected:
-            self.connected = False
-            try:
-                self.socket.close()
-            except:
-                pass
+        print(f"GIF cache: {self.gif_cache.stats()}")
+        print(f"Popups: {self.popups.stats()}")
+        print(f"Animation: {self.ticker.stats()}")
+        print(f"Text layout: {self.text_layout.stats()}")
+        self.gif_loader.shutdown()
+        self.close()
         self.root.destroy()
 
 def main():
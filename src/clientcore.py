@@ -0,0 +1,580 @@
+import hashlib
+import json
+import os
+import random
+import socket
+import threading
+import urllib.error
+import urllib.request
+import uuid
+
+from framing import (MessageDecoder, encode_message, parse_message, hello_message, FRAMING_NDJSON, RECV_SIZE,
+                     FEATURE_TEMPLATES, FEATURE_RESUME, FEATURE_HEARTBEAT, FEATURE_TOPICS, FEATURE_MEDIA)
+from media import is_media_hash
+from templates import BUILTIN_ALERTS, load_cached_templates, save_cached_templates, render_template
+
+# The UI-independent part of the alert client: connection, framing
+# negotiation, roster, templates, counters and alert dispatch. It imports
+# nothing from Tk, PIL or requests, so bots, test harnesses and other front
+# ends can embed it cheaply:
+#
+#   class Bot(AlertClientCore):
+#       def on_alert(self, alert):
+#           print(alert.header(), alert.message)
+#   bot = Bot(username="bot")
+#   bot.connect_to_server('127.0.0.1')
+#
+# The on_* hooks run on the receiver thread, in message order; a GUI hands
+# them over to its own thread (client.py does root.after). State they read
+# (templates, roster) is only changed on that same thread.
+#
+# A lost connection is retried with exponential backoff and full jitter, so
+# a restarted server isn't hit by every client at the same instant. Alerts
+# sent in the meantime wait in an outbox (up to MAX_OUTBOX) and go out after
+# the next HELLO_ACK. With the server's resume feature the HELLO carries the
+# last session's token: the server restores our username and only sends the
+# roster if ours is out of date, instead of SET_USERNAME and
+# CLIENT_LIST_REQUEST round trips.
+#
+# With heartbeats negotiated, a server that has been silent for the
+# interval gets a PING; no answer within the timeout counts as a lost
+# connection, so a dead server is noticed even while we only listen.
+#
+# A server with a media store hosts alert GIFs by content hash:
+# upload_media() puts a file there once, send_custom(media=...) refers to
+# it, and received alerts get the server's URL for it as gif_url. That
+# URL never changes content, so the GIF cache keeps it by hash for good.
+
+PORT = 12345
+HELLO_TIMEOUT = 2.0  # Seconds to wait for HELLO_ACK before assuming a legacy server
+IDENTITY_PATH = os.path.join(os.path.expanduser('~'), '.alert_app_cache', 'identity')
+CONNECT_TIMEOUT = 5.0
+RECONNECT_BASE_DELAY = 0.5  # Seconds; doubles per failed attempt
+RECONNECT_MAX_DELAY = 30.0
+MAX_OUTBOX = 100  # Alerts kept while disconnected; older ones are dropped
+MEDIA_TIMEOUT = 10.0  # Seconds per media store request
+
+
+def load_identity(path=IDENTITY_PATH):
+    # Random token kept across runs, so a server with an alert log can replay
+    # what this install missed while it was offline
+    try:
+        with open(path) as f:
+            identity = f.read().strip()
+        if identity:
+            return identity
+    except OSError:
+        pass
+    identity = uuid.uuid4().hex
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(identity)
+    except OSError as e:
+        print(f"Could not save client identity: {e}")
+    return identity
+
+
+class IncomingAlert:
+    # A received alert, already rendered. key identifies repeats of the same
+    # alert from the same sender, for coalescing.
+    __slots__ = ('key', 'sender', 'message', 'bg', 'gif_url', 'replayed', 'data')
+
+    def __init__(self, key, sender, message, bg, gif_url, data):
+        self.key = key
+        self.sender = sender
+        self.message = message
+        self.bg = bg
+        self.gif_url = gif_url
+        self.replayed = bool(data.get('replayed'))  # Sent while we were disconnected
+        self.data = data
+
+    def header(self):
+        if self.replayed:
+            return f"From {self.sender} (while you were away):"
+        return f"From {self.sender}:"
+
+
+class AlertClientCore:
+    def __init__(self, username="Anonymous", identity=None, auto_reconnect=True):
+        self.socket = None
+        self.connected = False
+        self.connection_error = None
+        self.host = None
+        self.port = PORT
+        
+        # Reconnecting: generation tells a connection's leftovers (receiver,
+        # HELLO timer) from the current one's
+        self.auto_reconnect = auto_reconnect
+        self.closing = threading.Event()
+        self.reconnecting = False
+        self.generation = 0
+        self.resume_token = None  # From the server, for the next connection
+        self.restoring = False  # Reconnected, session not yet restored
+        self.named = False  # set_username() was used, so the server should know our name
+        self.outbox_dropped = 0
+        self.reconnects = 0
+        self.topics = set()  # Subscriptions, re-sent in every HELLO
+        self.heartbeat = None  # (interval, timeout) from HELLO_ACK
+        self.media_port = None  # The server's media store, if it has one
+        self.ping_outstanding = False
+        self.sent_count = 0
+        self.received_count = 0
+        self.username = username
+        self.other_clients = {}  # Other connected clients, by ID (receiver thread)
+        self.client_id = None  # Our own ID, from HELLO_ACK
+        self.roster_version = None  # Version of other_clients, for applying deltas
+        self.roster_requested = False
+
+        # Wire framing, negotiated with HELLO right after connecting
+        self.decoder = MessageDecoder()
+        self.framing = None
+        self.negotiating = False
+        self.pending_sends = []  # Messages queued while waiting for HELLO_ACK
+        self.send_lock = threading.Lock()
+
+        # Alert definitions (same as original), used for LEGACY_ALERT and offline
+        self.alerts = BUILTIN_ALERTS
+
+        # Server-hosted alert templates, cached on disk between runs and
+        # re-synced by version after connecting
+        self.template_version, self.templates = load_cached_templates()
+        self.server_features = []
+        self.identity = identity or load_identity()
+
+    # Hooks, called on the receiver thread
+
+    def on_alert(self, alert):
+        pass
+
+    def on_roster(self, clients):
+        # clients: list of {'id', 'username', 'address'}, a copy
+        pass
+
+    def on_templates(self, changed):
+        pass
+
+    def on_disconnected(self):
+        # Lost for good: auto_reconnect is off
+        pass
+
+    def on_reconnecting(self, attempt, delay):
+        pass
+
+    def on_reconnected(self):
+        pass
+
+    # Connection
+
+    def connect_to_server(self, host='127.0.0.1', port=PORT):
+        self.host = host
+        self.port = port
+        return self.open_connection()
+
+    def open_connection(self):
+        try:
+            sock = socket.create_connection((self.host, self.port), timeout=CONNECT_TIMEOUT)
+            sock.settimeout(None)
+        except Exception as e:
+            print(f"Failed to connect to server: {e}")
+            self.connection_error = e
+            return False
+
+        with self.send_lock:
+            # Fresh per-connection state; anything queued stays queued until
+            # the HELLO_ACK
+            self.generation += 1
+            self.socket = sock
+            self.decoder = MessageDecoder()
+            self.framing = None
+            self.negotiating = True
+            self.connected = True
+            self.restoring = self.reconnecting
+            self.heartbeat = None
+            self.ping_outstanding = False
+            resume = self.resume_token
+        print(f"Connected to server at {self.host}:{self.port}")
+
+        # Start receiver thread
+        receiver_thread = threading.Thread(target=self.receiver, args=(self.generation,), daemon=True)
+        receiver_thread.start()
+
+        self.start_negotiation(resume)
+        if not resume:
+            # Request client list (a resumed session gets it pushed if needed)
+            self.request_client_list()
+        return True
+
+    def close(self):
+        self.closing.set()
+        if self.connected:
+            self.connected = False
+            try:
+                # close() alone leaves the receiver blocked in recv() and
+                # the connection open
+                self.socket.shutdown(socket.SHUT_RDWR)
+                self.socket.close()
+            except OSError:
+                pass
+
+    def start_negotiation(self, resume=None):
+        # Offer framing and hold back other sends until the server answers,
+        # so nothing is sent with the wrong framing in between
+        with self.send_lock:
+            self.negotiating = True
+            hello = hello_message(identity=self.identity, resume=resume, roster_version=self.roster_version,
+                                  topics=self.topics)
+            self.socket.sendall(encode_message(hello, FRAMING_NDJSON))
+        timer = threading.Timer(HELLO_TIMEOUT, self.finish_negotiation, args=(None, self.generation))
+        timer.daemon = True
+        timer.start()
+
+    def finish_negotiation(self, framing, generation=None):
+        # framing is None when the server is too old to answer HELLO
+        with self.send_lock:
+            if generation is not None and (generation != self.generation or not self.connected):
+                return  # HELLO timer of an earlier connection
+            if not self.negotiating:
+                # HELLO_ACK after we gave up waiting: the server has switched
+                # framing regardless, so follow it
+                if framing:
+                    self.framing = framing
+                    self.decoder.set_framing(framing)
+                return
+            self.negotiating = False
+            self.framing = framing
+            # Called from the receiver between two messages, so the rest of
+            # what the server sent is already read with the new framing
+            if framing:
+                self.decoder.set_framing(framing)
+            pending, self.pending_sends = self.pending_sends, []
+        for data in pending:
+            self.send_raw(data)
+
+    def send_raw(self, data):
+        # data is a message dict or a legacy alert string such as "STOP"
+        with self.send_lock:
+            if self.negotiating:
+                self.pending_sends.append(data)
+                if len(self.pending_sends) > MAX_OUTBOX:
+                    self.pending_sends.pop(0)
+                    self.outbox_dropped += 1
+                return
+            if self.framing:
+                self.socket.sendall(encode_message(data, self.framing))
+            else:
+                text = data if isinstance(data, str) else json.dumps(data)
+                self.socket.sendall(text.encode('utf-8'))
+
+    def send_message(self, data):
+        if self.connected:
+            try:
+                self.send_raw(data)
+                return True
+            except Exception as e:
+                print(f"Failed to send message: {e}")
+                return False
+        if self.reconnecting and (isinstance(data, str) or data.get('type') in ('CUSTOM', 'TEMPLATE_ALERT')):
+            # Alerts wait for the next connection; the rest (roster, name,
+            # template sync) is redone after connecting anyway
+            self.send_raw(data)
+            return True
+        return False
+
+    def receiver(self, generation):
+        while self.connected and generation == self.generation:
+            try:
+                try:
+                    data = self.socket.recv(RECV_SIZE)
+                except socket.timeout:
+                    # The server has been quiet for a whole heartbeat interval
+                    if self.ping_outstanding:
+                        print("Server stopped answering heartbeats")
+                        break
+                    self.ping_outstanding = True
+                    self.socket.settimeout(self.heartbeat[1])
+                    self.send_message({'type': 'PING'})
+                    continue
+                if not data:
+                    break
+                if self.ping_outstanding:
+                    self.ping_outstanding = False
+                    self.socket.settimeout(self.heartbeat[0])
+
+                # Only framing-aware servers send newlines; once we see one,
+                # stop treating recv() boundaries as message boundaries
+                if not self.decoder.framed and b'\n' in data:
+                    self.decoder.framed = True
+
+                for message in self.decoder.feed(data):
+                    try:
+                        message_data = parse_message(message)
+                        self.process_received_message(message_data)
+                    except json.JSONDecodeError:
+                        # Handle legacy messages if any
+                        print(f"Received non-JSON data: {message}")
+
+            except Exception as e:
+                if self.connected:
+                    print(f"Receiver error: {e}")
+                break
+
+        with self.send_lock:
+            if generation != self.generation:
+                return
+            self.connected = False
+            try:
+                self.socket.close()
+            except OSError:
+                pass
+            if self.auto_reconnect and not self.closing.is_set():
+                # Queue sends until we're back
+                self.reconnecting = True
+                self.negotiating = True
+        if self.reconnecting:
+            threading.Thread(target=self.reconnect_loop, daemon=True).start()
+        else:
+            self.on_disconnected()
+
+    def reconnect_loop(self):
+        attempt = 0
+        while not self.closing.is_set():
+            # Full jitter: anywhere up to the exponential delay
+            delay = random.uniform(0, min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** attempt))
+            attempt += 1
+            self.on_reconnecting(attempt, delay)
+            if self.closing.wait(delay):
+                return
+            if self.open_connection():
+                self.reconnecting = False
+                self.reconnects += 1
+                self.on_reconnected()
+                return
+
+    # Incoming messages
+
+    def process_received_message(self, message_data):
+        message_type = message_data.get('type')
+
+        if message_type == 'HELLO_ACK':
+            self.client_id = message_data.get('client_id')
+            self.server_features = message_data.get('features') or []
+            resumed = message_data.get('resumed')
+            self.resume_token = message_data.get('resume_token') if FEATURE_RESUME in self.server_features else None
+            restoring, self.restoring = self.restoring, False
+            if FEATURE_HEARTBEAT in self.server_features and message_data.get('heartbeat_interval'):
+                self.heartbeat = (message_data['heartbeat_interval'], message_data['heartbeat_timeout'])
+                self.socket.settimeout(self.heartbeat[0])
+            self.media_port = message_data.get('media_port') if FEATURE_MEDIA in self.server_features else None
+            if restoring and self.named and not (resumed and message_data.get('username') == self.username):
+                # New session, or renamed while disconnected: name first, so
+                # the queued alerts go out under it
+                with self.send_lock:
+                    self.pending_sends.insert(0, {'type': 'SET_USERNAME', 'username': self.username})
+            self.finish_negotiation(message_data.get('framing'))
+            if resumed is False:
+                # Token refused (expired, other secret): our roster is stale
+                self.request_client_list()
+            if FEATURE_TEMPLATES in self.server_features:
+                self.send_message({'type': 'TEMPLATE_SYNC', 'version': self.template_version})
+
+        elif message_type == 'RESUME_TOKEN':
+            self.resume_token = message_data.get('resume_token')
+
+        elif message_type == 'CONNECTION_REJECTED':
+            # The server hangs up next; reconnecting backs off as usual
+            print(f"Server refused the connection: {message_data.get('reason')}")
+
+        elif message_type == 'SUBSCRIPTIONS':
+            # What the server accepted
+            self.topics = set(message_data.get('topics') or [])
+
+        elif message_type == 'PING':
+            self.send_message({'type': 'PONG'})
+
+        elif message_type == 'PONG':
+            pass  # Any data resets the receiver's heartbeat timeout
+
+        elif message_type == 'CUSTOM':
+            # Custom alert; different texts from one sender are different
+            # alerts, so the text is part of the key
+            sender = message_data.get('sender_username', 'Unknown')
+            message = message_data['message']
+            gif_url = message_data.get('gif_url')
+            if self.media_port and is_media_hash(message_data.get('media')):
+                gif_url = self.media_url(message_data['media'])
+            self.received_count += 1
+            self.on_alert(IncomingAlert((sender, 'CUSTOM', message), sender, message, message_data['bg'],
+                                        gif_url, message_data))
+
+        elif message_type == 'LEGACY_ALERT':
+            # Legacy alert (STOP, COLD, etc.)
+            alert_type = message_data['alert_type']
+            sender = message_data.get('sender_username', 'Unknown')
+            if alert_type in self.alerts:
+                info = self.alerts[alert_type]
+                self.received_count += 1
+                self.on_alert(IncomingAlert((sender, alert_type), sender, info['message'], info['bg'],
+                                            info['gif_url'], message_data))
+
+        elif message_type == 'TEMPLATE_ALERT':
+            self.received_count += 1
+            self.on_alert(self.render_template_alert(message_data))
+
+        elif message_type == 'TEMPLATE_LIST':
+            self.apply_templates(message_data)
+
+        elif message_type in ('CLIENT_LIST_RESPONSE', 'CLIENT_ROSTER_DELTA'):
+            # Full client list or incremental changes, applied in order
+            if self.apply_roster_message(message_data):
+                self.on_roster([dict(client) for client in self.other_clients.values()])
+
+    def render_template_alert(self, message_data):
+        template_id = message_data.get('template')
+        params = message_data.get('params') or {}
+        sender = message_data.get('sender_username', 'Unknown')
+        template = self.templates.get(template_id)
+        if template is None:
+            # Our copy is stale; show what we can and fetch the new set
+            print(f"Unknown template {template_id}, re-syncing")
+            self.send_message({'type': 'TEMPLATE_SYNC', 'version': None})
+            template = {'message': template_id}
+        message, bg, gif_url = render_template(template, params)
+        return IncomingAlert((sender, template_id, tuple(sorted(params.items()))), sender, message, bg, gif_url,
+                             message_data)
+
+    def apply_templates(self, message_data):
+        # TEMPLATE_LIST, either a new set or "unchanged"
+        changed = not message_data.get('unchanged')
+        if changed:
+            self.templates = message_data.get('templates') or {}
+            self.template_version = message_data.get('version')
+            try:
+                save_cached_templates(self.template_version, self.templates)
+            except OSError as e:
+                print(f"Failed to cache templates: {e}")
+        self.on_templates(changed)
+
+    def apply_roster_message(self, message_data):
+        # Returns False if the message was stale or couldn't be applied
+        if message_data['type'] == 'CLIENT_LIST_RESPONSE':
+            self.other_clients = {client['id']: client for client in message_data['clients']}
+            self.roster_version = message_data.get('version')
+            self.roster_requested = False
+            return True
+
+        if self.roster_version is not None and message_data['version'] <= self.roster_version:
+            return False  # Already covered by a newer full list
+        if self.roster_version is None or message_data['base_version'] != self.roster_version:
+            # Missed a delta (or still waiting for the first list): resync
+            if not self.roster_requested:
+                self.request_client_list()
+            return False
+
+        for change in message_data['changes']:
+            client_id = change['id']
+            if client_id == self.client_id:
+                continue
+            if change['type'] == 'CLIENT_LEFT':
+                self.other_clients.pop(client_id, None)
+            elif change['type'] == 'CLIENT_RENAMED':
+                if client_id in self.other_clients:
+                    self.other_clients[client_id]['username'] = change['username']
+            else:
+                self.other_clients[client_id] = {
+                    'id': client_id,
+                    'username': change['username'],
+                    'address': change['address']
+                }
+        self.roster_version = message_data['version']
+        return True
+
+    # Outgoing messages; each returns whether it went to the server
+
+    def request_client_list(self):
+        if self.connected:
+            self.roster_requested = True
+            self.send_message({'type': 'CLIENT_LIST_REQUEST'})
+
+    def send_alert(self, alert_type):
+        if not (self.connected or self.reconnecting):
+            return False
+        self.sent_count += 1
+        if FEATURE_TEMPLATES in self.server_features and alert_type in self.templates:
+            # Just the template ID; every client already has the rest
+            return self.send_message({'type': 'TEMPLATE_ALERT', 'template': alert_type})
+        # Legacy string, broadcast by the server
+        return self.send_message(alert_type)
+
+    def send_custom(self, message, bg, gif_url=None, target_id=None, targets=None, media=None):
+        # targets: client IDs and topic names to send to instead, each
+        # recipient getting one copy. Not sent to servers without topics,
+        # which would broadcast it. media: hash from upload_media(), which
+        # recipients fetch from the server instead of gif_url.
+        if not (self.connected or self.reconnecting):
+            return False
+        if targets is not None and FEATURE_TOPICS not in self.server_features:
+            return False
+        self.sent_count += 1
+        alert = {
+            'type': 'CUSTOM',
+            'message': message,
+            'bg': bg,
+            'gif_url': gif_url,
+            'target_id': target_id  # None for broadcast, specific ID for targeted
+        }
+        if targets is not None:
+            alert['targets'] = list(targets)
+        if media is not None:
+            alert['media'] = media
+        return self.send_message(alert)
+
+    def send_template(self, template_id, params=None, target_id=None, targets=None):
+        if not (self.connected or self.reconnecting) or FEATURE_TEMPLATES not in self.server_features:
+            return False
+        if targets is not None and FEATURE_TOPICS not in self.server_features:
+            return False
+        self.sent_count += 1
+        alert = {'type': 'TEMPLATE_ALERT', 'template': template_id, 'target_id': target_id}
+        if params:
+            alert['params'] = params
+        if targets is not None:
+            alert['targets'] = list(targets)
+        return self.send_message(alert)
+
+    # Media store; blocking HTTP, so not from the receiver or a UI thread
+
+    def media_url(self, digest):
+        return f"http://{self.host}:{self.media_port}/media/{digest}"
+
+    def upload_media(self, data):
+        # -> the hash to send_custom() the file with, None without a media
+        # store. Only uploaded if the server doesn't have it yet.
+        if not self.media_port:
+            return None
+        digest = hashlib.sha256(data).hexdigest()
+        url = self.media_url(digest)
+        try:
+            urllib.request.urlopen(urllib.request.Request(url, method='HEAD'), timeout=MEDIA_TIMEOUT).close()
+            return digest
+        except urllib.error.HTTPError as e:
+            if e.code != 404:
+                raise
+        request = urllib.request.Request(url, data=data, method='PUT',
+                                         headers={'Content-Type': 'application/octet-stream'})
+        urllib.request.urlopen(request, timeout=MEDIA_TIMEOUT).close()
+        return digest
+
+    def subscribe(self, *topics):
+        # Remembered locally too, so a reconnect subscribes again in HELLO
+        self.topics.update(topics)
+        return self.send_message({'type': 'SUBSCRIBE', 'topics': list(topics)})
+
+    def unsubscribe(self, *topics):
+        self.topics.difference_update(topics)
+        return self.send_message({'type': 'UNSUBSCRIBE', 'topics': list(topics)})
+
+    def set_username(self, username):
+        self.username = username
+        self.named = True
+        return self.send_message({'type': 'SET_USERNAME', 'username': username})
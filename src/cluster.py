@@ -0,0 +1,235 @@
+import json
+import os
+import queue
+import socket
+import sys
+import threading
+
+from framing import MessageDecoder, FramingError, encode_message, RECV_SIZE
+from serverlog import logger, AsyncLog
+
+# Scale-out support for AlertServer.
+#
+# Several server workers (processes on one host sharing the port with
+# SO_REUSEPORT, or servers on different hosts) each own the clients
+# connected to them and relay everything else over a bus:
+#   - client IDs are counter * cluster_size + worker_index, so they are
+#     unique across workers and the owner of any ID is id % cluster_size
+#   - roster deltas are published so every worker knows every client
+#   - broadcasts are fanned out locally and published to the other workers;
+#     targeted sends to a remote client go to its owner only
+#
+# A bus endpoint is created with (worker_index, deliver) and has
+# publish(message, to=None) and close(). deliver(message) is called from a
+# bus thread for every message other workers publish (or send `to` this
+# worker), plus {'kind': 'worker_left', 'worker': n} when a worker goes away.
+#
+# Two stand-ins are provided:
+#   LocalBus    - in-process, for running several servers in one process
+#   SocketBus   - connects to a BusBroker on a Unix socket ('unix:/path') or
+#                 TCP ('tcp:host:port') address; run a broker on its own with
+#                 python cluster.py unix:/tmp/alert-bus.sock
+# Anything with the same interface (Redis, NATS, ...) can replace them.
+
+
+def parse_bus_address(address):
+    # 'unix:/path' or 'tcp:host:port' -> (family, sockaddr)
+    scheme, _, rest = address.partition(':')
+    if scheme == 'unix':
+        return socket.AF_UNIX, rest
+    if scheme == 'tcp':
+        host, _, port = rest.rpartition(':')
+        return socket.AF_INET, (host or '127.0.0.1', int(port))
+    raise ValueError(f"Unknown bus address: {address}")
+
+
+class LocalBus:
+    # In-process bus: every endpoint gets its own delivery thread, so
+    # publish() never runs another worker's code on the caller's thread
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def connect(self, worker_index, deliver):
+        endpoint = LocalBusEndpoint(self, worker_index, deliver)
+        with self.lock:
+            self.endpoints[worker_index] = endpoint
+        return endpoint
+
+    def route(self, sender, message, to=None):
+        with self.lock:
+            if to is not None:
+                targets = [self.endpoints[to]] if to in self.endpoints else []
+            else:
+                targets = [endpoint for worker, endpoint in self.endpoints.items() if worker != sender]
+        for endpoint in targets:
+            endpoint.inbox.put(message)
+
+    def disconnect(self, worker_index):
+        with self.lock:
+            self.endpoints.pop(worker_index, None)
+        self.route(worker_index, {'kind': 'worker_left', 'worker': worker_index})
+
+
+class LocalBusEndpoint:
+    def __init__(self, bus, worker_index, deliver):
+        self.bus = bus
+        self.worker_index = worker_index
+        self.deliver = deliver
+        self.inbox = queue.Queue()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def publish(self, message, to=None):
+        self.bus.route(self.worker_index, message, to)
+
+    def run(self):
+        while True:
+            message = self.inbox.get()
+            if message is None:
+                break
+            self.deliver(message)
+
+    def close(self):
+        self.bus.disconnect(self.worker_index)
+        self.inbox.put(None)
+
+
+class SocketBus:
+    # Endpoint talking to a BusBroker. Messages are newline-delimited JSON;
+    # the broker reads the routing fields 'from' and 'to'.
+    def __init__(self, address, worker_index, deliver):
+        family, sockaddr = parse_bus_address(address)
+        self.worker_index = worker_index
+        self.deliver = deliver
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(sockaddr)
+        self.send_lock = threading.Lock()
+        self.closed = False
+        self.send({'kind': 'hello', 'worker': worker_index})
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def publish(self, message, to=None):
+        message['from'] = self.worker_index
+        if to is not None:
+            message['to'] = to
+        self.send(message)
+
+    def send(self, message):
+        payload = encode_message(message)
+        with self.send_lock:
+            self.sock.sendall(payload)
+
+    def run(self):
+        decoder = MessageDecoder(framed=True)
+        try:
+            while True:
+                data = self.sock.recv(RECV_SIZE)
+                if not data:
+                    break
+                for text in decoder.feed(data):
+                    self.deliver(json.loads(text))
+        except (OSError, FramingError, ValueError) as e:
+            if not self.closed:
+                logger.error(f"Bus connection error: {e}")
+        if not self.closed:
+            logger.error("Lost connection to the bus broker")
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class BusBroker:
+    # Stand-in message broker: relays each message to every other worker, or
+    # to message['to'] only, and announces workers that disconnect. One
+    # thread per worker; there are only a handful.
+    def __init__(self, address):
+        self.address = address
+        self.lock = threading.Lock()
+        self.peers = {}  # worker index -> (socket, send lock)
+        self.server_socket = None
+
+    def start(self):
+        family, sockaddr = parse_bus_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(sockaddr):
+            os.unlink(sockaddr)  # Left over from a previous run
+        self.server_socket = socket.socket(family, socket.SOCK_STREAM)
+        if family != socket.AF_UNIX:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind(sockaddr)
+        self.server_socket.listen(64)
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+        logger.info(f"Bus broker listening on {self.address}")
+
+    def accept_loop(self):
+        while True:
+            try:
+                sock, _ = self.server_socket.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.handle_peer, args=(sock,), daemon=True).start()
+
+    def handle_peer(self, sock):
+        decoder = MessageDecoder(framed=True)
+        worker = None
+        try:
+            while True:
+                data = sock.recv(RECV_SIZE)
+                if not data:
+                    break
+                for text in decoder.feed(data):
+                    message = json.loads(text)
+                    if message.get('kind') == 'hello':
+                        worker = message['worker']
+                        with self.lock:
+                            self.peers[worker] = (sock, threading.Lock())
+                        logger.info(f"Worker {worker} joined the bus")
+                    else:
+                        self.route(worker, text, message.get('to'))
+        except (OSError, FramingError, ValueError) as e:
+            logger.warning(f"Bus peer error (worker {worker}): {e}")
+        finally:
+            sock.close()
+            if worker is not None:
+                with self.lock:
+                    if self.peers.get(worker, (None,))[0] is sock:
+                        del self.peers[worker]
+                logger.info(f"Worker {worker} left the bus")
+                self.route(worker, json.dumps({'kind': 'worker_left', 'worker': worker}))
+
+    def route(self, sender, text, to=None):
+        payload = encode_message(text)
+        with self.lock:
+            if to is not None:
+                targets = [self.peers[to]] if to in self.peers else []
+            else:
+                targets = [peer for worker, peer in self.peers.items() if worker != sender]
+        for sock, send_lock in targets:
+            try:
+                with send_lock:
+                    sock.sendall(payload)
+            except OSError:
+                pass  # Its reader thread notices and cleans up
+
+    def close(self):
+        if self.server_socket:
+            self.server_socket.close()
+        family, sockaddr = parse_bus_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(sockaddr):
+            os.unlink(sockaddr)
+
+
+if __name__ == "__main__":
+    # Standalone broker for workers on several hosts (use a tcp: address)
+    async_log = AsyncLog()
+    broker = BusBroker(sys.argv[1] if len(sys.argv) > 1 else 'unix:/tmp/alert-bus.sock')
+    broker.start()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        broker.close()
+    async_log.close()
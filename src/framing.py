@@ -0,0 +1,362 @@
+import json
+import struct
+
+# Wire framing shared by the server and the client.
+#
+# Every message is UTF-8 text terminated by a newline (json.dumps never emits
+# a raw newline, so JSON payloads can't contain the delimiter). Peers that
+# predate framing send one unterminated message per send() and expect the
+# same back; json.loads ignores the trailing newline, so they can still read
+# framed JSON. A client opts in by sending HELLO with the framings it
+# supports and switches once the server answers with HELLO_ACK.
+#
+# HELLO also lists optional protocol features; the server only uses the
+# ones a client asked for, so legacy clients keep the old behaviour.
+#
+# The 'binary' framing is a compact alternative to ndjson: each message is a
+# varint length followed by a msgpack-like encoding of the same dict (or
+# legacy string). Keys, message and alert types and other strings that
+# appear in almost every message are sent as one-byte indexes into
+# BINARY_STRINGS, small ints as one byte. HELLO and HELLO_ACK are always
+# ndjson; both sides switch after HELLO_ACK. Clients list framings in order
+# of preference, so a server that doesn't know 'binary' picks ndjson.
+#
+# The framing name says how much of BINARY_STRINGS a peer knows: 'binary'
+# is the first table, 'binary/N' version N of it (BINARY_TABLES). Each side
+# only interns strings within the negotiated table and sends the rest as
+# plain strings, so peers with an older table keep working; a peer knows
+# every version up to its own, so a server offered a newer one than it has
+# answers with its newest.
+
+FRAMING_NDJSON = 'ndjson'
+FRAMING_BINARY_1 = 'binary'
+FRAMING_BINARY = 'binary/2'  # The current table
+SUPPORTED_FRAMINGS = [FRAMING_BINARY, FRAMING_BINARY_1, FRAMING_NDJSON]
+
+FEATURE_ROSTER_DELTA = 'roster_delta'  # CLIENT_ROSTER_DELTA instead of full lists
+FEATURE_TEMPLATES = 'templates'  # TEMPLATE_ALERT instead of rendered CUSTOM alerts
+FEATURE_RESUME = 'resume'  # Resume tokens: username and roster restored on reconnect
+FEATURE_HEARTBEAT = 'heartbeat'  # PING/PONG when either side has been quiet
+FEATURE_TOPICS = 'topics'  # SUBSCRIBE to named topics; alerts to a list of topics and client IDs
+FEATURE_MEDIA = 'media'  # Alert GIFs by content hash from the server's media port (media.py)
+SUPPORTED_FEATURES = [FEATURE_ROSTER_DELTA, FEATURE_TEMPLATES, FEATURE_RESUME, FEATURE_HEARTBEAT, FEATURE_TOPICS,
+                      FEATURE_MEDIA]
+
+MAX_MESSAGE_SIZE = 1024 * 1024  # Drop peers that never send a delimiter
+MAX_DEPTH = 32  # Nested lists and dicts in a binary message
+RECV_SIZE = 65536
+
+
+class FramingError(Exception):
+    pass
+
+
+# Interned strings of the binary framing. Append only: the index is what
+# goes on the wire, so reordering breaks peers running the older list.
+# Appending also needs a new version in BINARY_TABLES.
+BINARY_STRINGS = (
+    # Keys
+    'type', 'message', 'bg', 'gif_url', 'target_id', 'sender_id', 'sender_username', 'alert_type',
+    'client_id', 'framing', 'features', 'version', 'base_version', 'changes', 'clients', 'id',
+    'username', 'address',
+    # Message types
+    'HELLO', 'HELLO_ACK', 'CUSTOM', 'LEGACY_ALERT', 'CLIENT_LIST_REQUEST', 'CLIENT_LIST_RESPONSE',
+    'CLIENT_ROSTER_DELTA', 'CLIENT_JOINED', 'CLIENT_LEFT', 'CLIENT_RENAMED', 'SET_USERNAME',
+    # Alert types and their colours
+    'STOP', 'COLD', 'ALERT1', 'ALERT2', 'ALERT3',
+    '#ff4500', '#1e90ff', '#00ff00', '#ffff00', '#ff00ff',
+    # Negotiation
+    FRAMING_NDJSON, FRAMING_BINARY_1, FEATURE_ROSTER_DELTA,
+    # Alert templates (FEATURE_TEMPLATES is 'templates')
+    'TEMPLATE_SYNC', 'TEMPLATE_LIST', 'TEMPLATE_ALERT', 'template', 'params', FEATURE_TEMPLATES, 'unchanged',
+    # Offline delivery
+    'identity', 'replayed',
+    # Session resume (FEATURE_RESUME is 'resume')
+    FEATURE_RESUME, 'resumed', 'resume_token', 'RESUME_TOKEN', 'roster_version',
+    # Heartbeats (FEATURE_HEARTBEAT is 'heartbeat')
+    FEATURE_HEARTBEAT, 'PING', 'PONG', 'heartbeat_interval', 'heartbeat_timeout',
+    # Topics (FEATURE_TOPICS is 'topics')
+    FEATURE_TOPICS, 'targets', 'SUBSCRIBE', 'UNSUBSCRIBE', 'SUBSCRIPTIONS',
+    # Media store (FEATURE_MEDIA is also the alert key holding the hash)
+    FEATURE_MEDIA, 'media_port',
+)
+BINARY_STRING_INDEX = {string: index for index, string in enumerate(BINARY_STRINGS)}
+assert len(BINARY_STRING_INDEX) == len(BINARY_STRINGS), "BINARY_STRINGS has a duplicate"
+# Binary framing -> how many of BINARY_STRINGS it interns
+BINARY_TABLES = {
+    FRAMING_BINARY_1: 42,
+    FRAMING_BINARY: 68,  # Templates, offline delivery, resume, heartbeats, topics, media
+}
+assert BINARY_TABLES[FRAMING_BINARY] == len(BINARY_STRINGS), "BINARY_STRINGS grew: add a binary version"
+
+# Binary value tags. 0x40-0x7f is an interned string with index 0-63 and
+# 0x80-0xff an int 0-127, both in a single byte.
+TAG_NONE, TAG_FALSE, TAG_TRUE, TAG_INT, TAG_NEG_INT, TAG_FLOAT, TAG_STR, TAG_INTERNED, TAG_LIST, TAG_DICT = range(10)
+TAG_SHORT_INTERNED = 0x40
+TAG_SHORT_INT = 0x80
+
+
+def encode_message(data, framing=None):
+    # data is a dict (JSON message) or a str (legacy alert such as "STOP").
+    # framing None (legacy peers) and ndjson both produce JSON lines.
+    interned = BINARY_TABLES.get(framing)
+    if interned is not None:
+        body = bytearray()
+        encode_value(data, body, interned)
+        frame = bytearray()
+        write_varint(len(body), frame)
+        return bytes(frame + body)
+    if not isinstance(data, str):
+        data = json.dumps(data)
+    return data.encode('utf-8') + b'\n'
+
+
+class EncodedMessage:
+    # A message queued for clients that may use different framings: each
+    # framing's bytes are produced on first use and shared from then on, so
+    # a broadcast still encodes once per framing, not once per client
+    __slots__ = ('data', 'payloads')
+
+    def __init__(self, data):
+        self.data = data
+        self.payloads = {}
+
+    def encode(self, framing):
+        payload = self.payloads.get(framing)
+        if payload is None:
+            payload = self.payloads[framing] = encode_message(self.data, framing)
+        return payload
+
+
+def parse_message(message):
+    # What MessageDecoder yields -> dict. Binary frames are decoded already;
+    # ndjson text goes through json.loads, which raises for legacy strings
+    # such as "STOP" in either framing.
+    if isinstance(message, str):
+        return json.loads(message)
+    return message
+
+
+def hello_message(features=SUPPORTED_FEATURES, framings=SUPPORTED_FRAMINGS, identity=None, resume=None,
+                  roster_version=None, topics=None):
+    # identity: a stable per-install token, so the server can replay alerts
+    # missed while disconnected. resume: the token from the last session,
+    # with the roster version we still hold. topics: subscriptions to
+    # (re)establish before any missed alerts are replayed.
+    hello = {'type': 'HELLO', 'framing': list(framings), 'features': list(features)}
+    if identity:
+        hello['identity'] = identity
+    if resume:
+        hello['resume'] = resume
+        hello['roster_version'] = roster_version
+    if topics:
+        hello['topics'] = sorted(topics)
+    return hello
+
+
+def choose_framing(offered, supported=SUPPORTED_FRAMINGS):
+    # Server side of the HELLO handshake: first offered framing we support,
+    # our newest binary for a newer binary than we know
+    if not isinstance(offered, list):
+        return None
+    for framing in offered:
+        if framing in supported:
+            return framing
+        if FRAMING_BINARY in supported and binary_version(framing) > binary_version(FRAMING_BINARY):
+            return FRAMING_BINARY
+    return None
+
+
+def binary_version(framing):
+    # 'binary' -> 1, 'binary/N' -> N, anything else 0
+    if framing == FRAMING_BINARY_1:
+        return 1
+    if isinstance(framing, str) and framing.startswith('binary/') and framing[7:].isdigit():
+        return int(framing[7:])
+    return 0
+
+
+def write_varint(value, out):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, pos):
+    # Returns (value, next position), or (None, pos) if data ends first
+    value = 0
+    shift = 0
+    while pos < len(data):
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+    return None, pos
+
+
+def encode_value(value, out, interned=len(BINARY_STRINGS)):
+    # interned: how many of BINARY_STRINGS the peer knows
+    if value is None:
+        out.append(TAG_NONE)
+    elif value is True:
+        out.append(TAG_TRUE)
+    elif value is False:
+        out.append(TAG_FALSE)
+    elif isinstance(value, str):
+        index = BINARY_STRING_INDEX.get(value)
+        if index is None or index >= interned:
+            data = value.encode('utf-8')
+            out.append(TAG_STR)
+            write_varint(len(data), out)
+            out += data
+        elif index < 0x40:
+            out.append(TAG_SHORT_INTERNED | index)
+        else:
+            out.append(TAG_INTERNED)
+            write_varint(index, out)
+    elif isinstance(value, int):
+        if 0 <= value < 0x80:
+            out.append(TAG_SHORT_INT | value)
+        elif value >= 0:
+            out.append(TAG_INT)
+            write_varint(value, out)
+        else:
+            out.append(TAG_NEG_INT)
+            write_varint(-value - 1, out)
+    elif isinstance(value, float):
+        out.append(TAG_FLOAT)
+        out += struct.pack('>d', value)
+    elif isinstance(value, dict):
+        out.append(TAG_DICT)
+        write_varint(len(value), out)
+        for key, item in value.items():
+            encode_value(key, out, interned)
+            encode_value(item, out, interned)
+    elif isinstance(value, (list, tuple)):
+        out.append(TAG_LIST)
+        write_varint(len(value), out)
+        for item in value:
+            encode_value(item, out, interned)
+    else:
+        raise TypeError(f"Can't encode {type(value).__name__} in binary framing")
+
+
+def decode_value(data, pos, interned=len(BINARY_STRINGS), depth=0):
+    # Returns (value, next position); raises FramingError on malformed input
+    try:
+        tag = data[pos]
+    except IndexError:
+        raise FramingError("Truncated binary message")
+    pos += 1
+    if tag >= TAG_SHORT_INT:
+        return tag & 0x7f, pos
+    if tag >= TAG_SHORT_INTERNED:
+        number = tag & 0x3f
+        if number >= interned:
+            raise FramingError(f"Unknown interned string {number}")
+        return BINARY_STRINGS[number], pos
+    if tag == TAG_NONE:
+        return None, pos
+    if tag == TAG_TRUE:
+        return True, pos
+    if tag == TAG_FALSE:
+        return False, pos
+    if tag == TAG_FLOAT:
+        if pos + 8 > len(data):
+            raise FramingError("Truncated binary message")
+        return struct.unpack_from('>d', data, pos)[0], pos + 8
+
+    number, pos = read_varint(data, pos)
+    if number is None:
+        raise FramingError("Truncated binary message")
+    if tag == TAG_STR:
+        if pos + number > len(data):
+            raise FramingError("Truncated binary message")
+        return str(data[pos:pos + number], 'utf-8', 'replace'), pos + number
+    if tag == TAG_INT:
+        return number, pos
+    if tag == TAG_NEG_INT:
+        return -number - 1, pos
+    if tag == TAG_INTERNED:
+        if number >= interned:
+            raise FramingError(f"Unknown interned string {number}")
+        return BINARY_STRINGS[number], pos
+    if tag in (TAG_LIST, TAG_DICT) and depth >= MAX_DEPTH:
+        raise FramingError(f"Binary message nested over {MAX_DEPTH} deep")
+    if tag == TAG_LIST:
+        items = []
+        for _ in range(number):
+            item, pos = decode_value(data, pos, interned, depth + 1)
+            items.append(item)
+        return items, pos
+    if tag == TAG_DICT:
+        value = {}
+        for _ in range(number):
+            key, pos = decode_value(data, pos, interned, depth + 1)
+            if isinstance(key, (list, dict)):
+                raise FramingError("Binary message has a list or dict as a key")
+            value[key], pos = decode_value(data, pos, interned, depth + 1)
+        return value, pos
+    raise FramingError(f"Unknown binary tag {tag:#x}")
+
+
+class MessageDecoder:
+    # Incremental decoder: feed() raw bytes as they arrive and iterate over
+    # the complete messages they finish - str for ndjson, the decoded dict
+    # (or str) for binary; parse_message() takes either. Partial frames,
+    # including UTF-8 sequences split across recv() calls, stay buffered.
+    #
+    # With framed=False the peer is a legacy one and whatever is left after
+    # the last newline is taken as a whole message, as the old code did.
+    # set_framing() may be called between two messages of one feed(), e.g.
+    # on HELLO, and the rest of the data is read with the new framing.
+    def __init__(self, framed=False, max_size=MAX_MESSAGE_SIZE):
+        self.framed = framed
+        self.interned = None  # Binary framing: how many of BINARY_STRINGS it interns
+        self.max_size = max_size
+        self.buffer = bytearray()
+
+    def set_framing(self, framing):
+        self.framed = framing is not None
+        self.interned = BINARY_TABLES.get(framing)
+
+    def feed(self, data):
+        self.buffer += data
+        while True:
+            if self.interned is not None:
+                length, start = read_varint(self.buffer, 0)
+                if length is None:
+                    break
+                if length > self.max_size:
+                    self.buffer.clear()
+                    raise FramingError(f"Message exceeds {self.max_size} bytes ({length} announced)")
+                end = start + length
+                if len(self.buffer) < end:
+                    break
+                body = bytes(self.buffer[start:end])
+                del self.buffer[:end]
+                message, pos = decode_value(body, 0, self.interned)
+                if pos != length:
+                    raise FramingError("Trailing bytes in binary message")
+                yield message
+                continue
+            end = self.buffer.find(b'\n')
+            if end < 0:
+                break
+            # bytearray deletes from the front in O(1)
+            line = bytes(self.buffer[:end])
+            del self.buffer[:end + 1]
+            if line.strip():
+                yield line.decode('utf-8', errors='replace')
+
+        if not self.framed and self.buffer:
+            line = bytes(self.buffer)
+            self.buffer.clear()
+            yield line.decode('utf-8', errors='replace')
+        elif len(self.buffer) > self.max_size:
+            size = len(self.buffer)
+            self.buffer.clear()
+            raise FramingError(f"Message exceeds {self.max_size} bytes ({size} buffered)")
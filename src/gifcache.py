@@ -0,0 +1,244 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+# Two-level cache for popup GIFs:
+#   DiskCache  - downloaded bytes keyed by URL, LRU-evicted by total size and
+#                revalidated with ETag/Last-Modified once they get old
+#   GifCache   - in-memory LRU of decoded, resized PhotoImage frame lists
+#                keyed by (url, width, height), on top of the disk cache,
+#                bounded by the decoded size of the frames it holds;
+#                GifLoader (gifloader.py) fills it for GIFs that fit its
+#                memory budget
+# Repeated alerts therefore skip the download, the decode and the resize.
+#
+# URLs of a server's media store (.../media/<sha256>, see media.py) are
+# content-addressed: they're kept under the hash itself, checked against it
+# when downloaded and never revalidated, so the same GIF is fetched once
+# whichever server or alert it comes from.
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.alert_app_cache', 'gifs')
+DISK_CACHE_BYTES = 200 * 1024 * 1024
+REVALIDATE_AFTER = 3600  # Seconds before a cached GIF is checked against the server
+FRAME_CACHE_BYTES = 128 * 1024 * 1024  # Decoded frames kept across popups
+MEDIA_URL = re.compile(r'https?://[^/]+/media/([0-9a-f]{64})\Z')
+HTTP_HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
+
+
+class DiskCache:
+    def __init__(self, directory=CACHE_DIR, max_bytes=DISK_CACHE_BYTES, revalidate_after=REVALIDATE_AFTER):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.revalidate_after = revalidate_after
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> metadata, least recently used first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def fetch(self, url, timeout=10):
+        # Returns the GIF bytes, from disk when possible
+        media = MEDIA_URL.match(url)
+        key = media.group(1) if media else hashlib.sha256(url.encode('utf-8')).hexdigest()
+        with self.lock:
+            meta = self.entries.get(key)
+            if meta:
+                self.entries.move_to_end(key)
+
+        if meta and (media or time.time() - meta['validated'] < self.revalidate_after):
+            data = self._read(key)
+            if data is not None:
+                self._count('hits')
+                return data
+
+        headers = dict(HTTP_HEADERS)
+        if meta:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        try:
+            response = requests.get(url, headers=headers, timeout=timeout)
+        except requests.RequestException:
+            # Offline: a stale copy beats no GIF at all
+            data = self._read(key) if meta else None
+            if data is None:
+                raise
+            self._count('hits')
+            return data
+
+        if response.status_code == 304 and meta:
+            data = self._read(key)
+            if data is not None:
+                meta['validated'] = time.time()
+                self._write_meta(key, meta)
+                self._count('revalidated')
+                return data
+
+        response.raise_for_status()
+        if media and hashlib.sha256(response.content).hexdigest() != key:
+            raise ValueError(f"{url} doesn't match its hash")
+        self._count('misses')
+        self._store(key, url, response)
+        return response.content
+
+    def stats(self):
+        with self.lock:
+            return {
+                'disk_hits': self.hits,
+                'disk_misses': self.misses,
+                'disk_revalidated': self.revalidated,
+                'disk_entries': len(self.entries),
+                'disk_bytes': self.total_bytes,
+            }
+
+    def _count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _path(self, key, ext):
+        return os.path.join(self.directory, key + ext)
+
+    def _read(self, key):
+        path = self._path(key, '.gif')
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # mtime records last use, so the LRU order survives restarts
+            os.utime(path)
+            return data
+        except OSError:
+            with self.lock:
+                self._forget(key)
+            return None
+
+    def _store(self, key, url, response):
+        data = response.content
+        meta = {
+            'url': url,
+            'size': len(data),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'validated': time.time(),
+        }
+        # Write to a temp file first so a crash never leaves a torn GIF
+        tmp_path = self._path(key, f'.{threading.get_ident()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self._path(key, '.gif'))
+        self._write_meta(key, meta)
+
+        with self.lock:
+            self._forget(key)
+            self.entries[key] = meta
+            self.total_bytes += meta['size']
+            self._evict()
+
+    def _write_meta(self, key, meta):
+        with open(self._path(key, '.json'), 'w') as f:
+            json.dump(meta, f)
+
+    def _evict(self):
+        # Caller holds the lock
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            key, _ = next(iter(self.entries.items()))
+            self._forget(key)
+            for ext in ('.gif', '.json'):
+                try:
+                    os.remove(self._path(key, ext))
+                except OSError:
+                    pass
+
+    def _forget(self, key):
+        meta = self.entries.pop(key, None)
+        if meta:
+            self.total_bytes -= meta['size']
+
+    def _load_index(self):
+        # Rebuild the LRU order from file access times of a previous run
+        found = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            key = name[:-len('.json')]
+            try:
+                with open(self._path(key, '.json')) as f:
+                    meta = json.load(f)
+                used = os.path.getmtime(self._path(key, '.gif'))
+            except (OSError, ValueError):
+                continue
+            found.append((used, key, meta))
+        for _, key, meta in sorted(found):
+            self.entries[key] = meta
+            self.total_bytes += meta['size']
+        self._evict()
+
+
+class GifCache:
+    def __init__(self, disk=None, max_bytes=FRAME_CACHE_BYTES):
+        self.disk = disk or DiskCache()
+        self.max_bytes = max_bytes
+        self.frames = OrderedDict()  # (url, width, height) -> (photo_frames, duration)
+        self.sizes = {}              # (url, width, height) -> decoded bytes
+        self.total_bytes = 0
+        self.frame_hits = 0
+        self.frame_misses = 0
+
+    def lookup(self, url, width, height):
+        # Tk thread only. Returns (frames, duration) or None.
+        key = (url, width, height)
+        cached = self.frames.get(key)
+        if cached:
+            self.frames.move_to_end(key)
+            self.frame_hits += 1
+            return cached
+        self.frame_misses += 1
+        return None
+
+    def store(self, url, width, height, frames, duration, size):
+        # Tk thread only; frames must be the complete list, size their
+        # decoded bytes (width * height * 4 per frame as rendered). A GIF
+        # bigger than the whole cache isn't kept.
+        key = (url, width, height)
+        self._forget(key)
+        if size > self.max_bytes:
+            return
+        self.frames[key] = (frames, duration)
+        self.sizes[key] = size
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes:
+            self._forget(next(iter(self.frames)))
+
+    def _forget(self, key):
+        if self.frames.pop(key, None) is not None:
+            self.total_bytes -= self.sizes.pop(key)
+
+    def prefetch(self, urls):
+        # Warm the disk cache in the background; decoding needs the Tk thread
+        def run():
+            for url in urls:
+                try:
+                    self.disk.fetch(url)
+                except Exception as e:
+                    print(f"Error prefetching GIF {url}: {e}")
+        threading.Thread(target=run, daemon=True).start()
+
+    def stats(self):
+        stats = self.disk.stats()
+        stats.update({
+            'frame_hits': self.frame_hits,
+            'frame_misses': self.frame_misses,
+            'frame_entries': len(self.frames),
+            'frame_bytes': self.total_bytes,
+        })
+        return stats
@@ -0,0 +1,193 @@
+import io
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+# Loads popup GIFs off the Tk thread with bounded memory.
+#
+# Download (through the disk cache), decode and resize run on a small thread
+# pool, one frame per task, and each frame is handed to the Tk thread with
+# post(). How frames are kept depends on what the whole GIF would cost once
+# rendered at popup size:
+#   - within the memory budget: every frame is pre-rendered to a PhotoImage
+#     once, played from memory and stored in the GifCache frame LRU
+#   - over budget (or downscaled): frames are streamed - only a small ring of
+#     decoded frames is held, each is turned into a PhotoImage when shown and
+#     the GIF is decoded again on every loop
+# In both cases the popup can start animating as soon as the first frame is
+# ready.
+
+GIF_WORKERS = 4
+GIF_MEMORY_BUDGET = 64 * 1024 * 1024  # Bytes of pre-rendered frames per popup
+GIF_RING_SIZE = 4  # Decoded frames kept ahead of playback when streaming
+BYTES_PER_PIXEL = 4  # Tk photo images are 32-bit
+
+
+class FrameProvider:
+    # One per popup. next_frame() and the delivery callbacks run on the Tk
+    # thread; the decode state (image, decode_index) belongs to whichever
+    # worker task currently runs, and there is at most one at a time.
+    def __init__(self, loader, url, width, height, on_error=None):
+        self.loader = loader
+        self.url = url
+        self.width = width
+        self.height = height
+        self.on_error = on_error
+        self.cancelled = threading.Event()
+        self.duration = 100
+        self.streaming = False
+        self.complete = False
+        self.failed = False
+        self.frames = []     # Pre-rendered PhotoImages, growing while decoding
+        self.ring = deque()  # Streaming: decoded frames not shown yet
+        self.index = 0       # Next pre-rendered frame to show
+        self.render_width = width
+        self.render_height = height
+        self.decoding = False
+        self.future = None
+
+        # Worker side
+        self.image = None
+        self.frame_count = 0
+        self.decode_index = 0
+        self.decode_size = (width, height)
+
+    def next_frame(self):
+        # Tk thread. The frame to show now, or None if nothing is decoded yet
+        if self.streaming:
+            if not self.ring:
+                return None
+            frame = self.ring.popleft()
+            self._request_decode()
+            if frame.size != (self.render_width, self.render_height):
+                # Downscaled mode: cheap upscale for display only
+                frame = frame.resize((self.render_width, self.render_height), Image.Resampling.NEAREST)
+            return self.loader.to_image(frame)
+
+        if not self.frames:
+            return None
+        frame = self.frames[self.index % len(self.frames)]
+        self.index += 1
+        return frame
+
+    def cancel(self):
+        self.cancelled.set()
+        if self.future:
+            self.future.cancel()
+        self.ring.clear()
+
+    def _open(self):
+        # Worker thread: fetch and read the header, not the frames
+        data = self.loader.cache.disk.fetch(self.url)
+        im = Image.open(io.BytesIO(data))
+        img_w, img_h = im.size
+        ratio = max(self.width / img_w, self.height / img_h)
+        render_size = (int(img_w * ratio), int(img_h * ratio))
+        frame_count = getattr(im, 'n_frames', 1)
+        duration = im.info.get('duration', 100) or 100
+        self.image = im
+        self.frame_count = frame_count
+        self.loader.post(self._opened, render_size, frame_count, duration)
+
+    def _opened(self, render_size, frame_count, duration):
+        # Tk thread: pick pre-rendered or streaming now that the size is known
+        self.decoding = False
+        if self.cancelled.is_set():
+            return
+        self.render_width, self.render_height = render_size
+        self.duration = duration
+        downscale = self.loader.downscale
+        rendered_bytes = render_size[0] * render_size[1] * BYTES_PER_PIXEL * frame_count
+        self.streaming = downscale > 1 or rendered_bytes > self.loader.memory_budget
+        if downscale > 1:
+            self.decode_size = (max(1, render_size[0] // downscale), max(1, render_size[1] // downscale))
+        else:
+            self.decode_size = render_size
+        self._request_decode()
+
+    def _request_decode(self):
+        # Tk thread: keep exactly one decode task going while there is room
+        if self.decoding or self.cancelled.is_set():
+            return
+        if self.streaming:
+            if len(self.ring) >= self.loader.ring_size:
+                return
+        elif self.complete:
+            return
+        self.decoding = True
+        self.future = self.loader.executor.submit(self.loader.run, self, self._decode)
+
+    def _decode(self):
+        # Worker thread: one frame, wrapping around when streaming
+        if self.decode_index >= self.frame_count:
+            self.decode_index = 0
+        self.image.seek(self.decode_index)
+        frame = self.image.convert('RGBA').resize(self.decode_size, Image.Resampling.LANCZOS)
+        self.decode_index += 1
+        self.loader.post(self._deliver, frame, self.decode_index >= self.frame_count)
+
+    def _deliver(self, frame, last):
+        # Tk thread
+        self.decoding = False
+        if self.cancelled.is_set():
+            return
+        if self.streaming:
+            self.ring.append(frame)
+        else:
+            self.frames.append(self.loader.to_image(frame))
+            if last:
+                self.complete = True
+                self.image = None
+                size = self.render_width * self.render_height * BYTES_PER_PIXEL * len(self.frames)
+                self.loader.cache.store(self.url, self.width, self.height, self.frames, self.duration, size)
+        self._request_decode()
+
+    def _failed(self, error):
+        self.decoding = False
+        self.failed = True
+        if self.on_error and not self.cancelled.is_set():
+            self.on_error(error)
+
+
+class GifLoader:
+    def __init__(self, cache, post, to_image, workers=GIF_WORKERS, memory_budget=GIF_MEMORY_BUDGET,
+                 ring_size=GIF_RING_SIZE, downscale=1):
+        # post(callback, *args) must run callback on the Tk thread (root.after
+        # with 0 delay); to_image turns a PIL frame into what the popup
+        # displays (ImageTk.PhotoImage) and is only called from there.
+        # downscale=2 decodes at half resolution and always streams.
+        self.cache = cache
+        self.post = post
+        self.to_image = to_image
+        self.memory_budget = memory_budget
+        self.ring_size = ring_size
+        self.downscale = downscale
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='gif-loader')
+
+    def load(self, url, width, height, on_error=None):
+        # Tk thread. Returns a FrameProvider right away; cancel() it when the
+        # popup goes away.
+        provider = FrameProvider(self, url, width, height, on_error)
+        cached = self.cache.lookup(url, width, height)
+        if cached:
+            provider.frames, provider.duration = cached
+            provider.complete = True
+            return provider
+
+        provider.decoding = True
+        provider.future = self.executor.submit(self.run, provider, provider._open)
+        return provider
+
+    def run(self, provider, step):
+        # Worker thread: one step of a provider's load
+        if provider.cancelled.is_set():
+            return
+        try:
+            step()
+        except Exception as e:
+            self.post(provider._failed, e)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
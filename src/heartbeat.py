@@ -0,0 +1,90 @@
+import math
+import socket
+import threading
+
+# Idle-connection detection for AlertServer.
+#
+# A laptop that goes to sleep leaves a half-open connection behind: recv()
+# on it blocks forever and sends to it just fill buffers. Clients that
+# negotiate the 'heartbeat' feature are pinged once they've been quiet for
+# HEARTBEAT_INTERVAL, and disconnected when nothing (a PONG or any other
+# message) arrives within HEARTBEAT_TIMEOUT after that. Legacy clients
+# can't answer pings; TCP keepalive (set_keepalive) catches those, more
+# slowly, in the kernel.
+#
+# Deadlines live in a hashed timer wheel: scheduling and cancelling are O(1)
+# and a tick only looks at the clients due in that slot, so each client is
+# looked at about once per interval rather than once per tick. Traffic doesn't
+# reschedule anything, it just stamps the client's last_seen; when a slot
+# comes due the client is checked and, if it was active, put back in the
+# wheel for the rest of its interval.
+
+HEARTBEAT_INTERVAL = 30.0  # Seconds of silence before a PING
+HEARTBEAT_TIMEOUT = 10.0   # Seconds to answer it
+HEARTBEAT_TICK = 1.0       # Wheel resolution
+
+KEEPALIVE_IDLE = 60        # Seconds before the first TCP keepalive probe
+KEEPALIVE_INTERVAL = 10    # Seconds between probes
+KEEPALIVE_COUNT = 3        # Unanswered probes before the kernel drops the connection
+
+
+class TimerWheel:
+    def __init__(self, tick, horizon, now):
+        # horizon: the longest delay scheduled; longer ones are clamped
+        self.tick = tick
+        self.slots = [[] for _ in range(int(math.ceil(horizon / tick)) + 2)]
+        self.position = 0
+        self.current = now
+        # key -> slot index. Rescheduling or cancelling only updates this;
+        # stale entries left in the slot lists are skipped when they come due.
+        self.where = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.where)
+
+    def schedule(self, key, delay):
+        # Rounded up a whole tick: due no earlier than delay, at most a tick late
+        ticks = int(delay / self.tick) + 1
+        if ticks >= len(self.slots):
+            ticks = len(self.slots) - 1
+        with self.lock:
+            index = (self.position + ticks) % len(self.slots)
+            self.slots[index].append(key)
+            self.where[key] = index
+
+    def cancel(self, key):
+        with self.lock:
+            self.where.pop(key, None)
+
+    def advance(self, now):
+        # -> keys whose slots came due since the last call
+        expired = []
+        with self.lock:
+            while now - self.current >= self.tick:
+                self.current += self.tick
+                self.position = (self.position + 1) % len(self.slots)
+                slot = self.slots[self.position]
+                if slot:
+                    where = self.where
+                    for key in slot:
+                        if where.get(key) == self.position:
+                            del where[key]
+                            expired.append(key)
+                    slot.clear()
+        return expired
+
+
+def set_keepalive(sock, idle=KEEPALIVE_IDLE, interval=KEEPALIVE_INTERVAL, count=KEEPALIVE_COUNT):
+    # Kernel-side dead peer detection; the TCP_* knobs are Linux/BSD only
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in (('TCP_KEEPIDLE', idle), ('TCP_KEEPINTVL', interval), ('TCP_KEEPCNT', count)):
+            if hasattr(socket, option):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+        if hasattr(socket, 'TCP_USER_TIMEOUT'):
+            # Also give up on data the peer never acknowledges, instead of
+            # retransmitting to a sleeping laptop for ~15 minutes
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, (idle + interval * count) * 1000)
+    except OSError:
+        pass  # Already reset by the peer; the reader will find out
@@ -0,0 +1,480 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import time
+import urllib.request
+from collections import Counter
+from datetime import datetime
+
+from framing import (MessageDecoder, FramingError, encode_message, parse_message, hello_message, RECV_SIZE,
+                     FRAMING_NDJSON, SUPPORTED_FRAMINGS)
+from metrics import Histogram
+from bench import start_server, stop_server
+
+# Load generator for the alert server: thousands of simulated clients on one
+# asyncio loop, speaking the same protocol as client.py (HELLO negotiation,
+# framing, roster updates) without Tk. An open-loop driver issues `rate`
+# operations per second drawn from a weighted mix:
+#   legacy    - a legacy string alert ('STOP', ...) broadcast to everyone
+#   custom    - a CUSTOM broadcast
+#   targeted  - a CUSTOM alert to one random client
+#   rename    - SET_USERNAME, which fans out a roster update
+#   churn     - one client disconnects and a new one connects
+# CUSTOM alerts carry the send time, so every delivery yields an end-to-end
+# latency sample; expected delivery counts use the roster at send time, so
+# under churn the ratios are approximate. Server RSS/CPU come from /proc (when the server was
+# started here or --server-pid is given) and its metrics from --admin-port.
+# Results go to stdout and, with --json, to a file that --compare reads:
+#   python loadgen.py --server async --clients 2000 --rate 200 --json async.json
+#   python loadgen.py --server threaded --clients 2000 --rate 200 --json threaded.json
+#   python loadgen.py --compare threaded.json async.json
+#   python loadgen.py --port 12345 --admin-port 9100 --mix custom=1,targeted=1
+
+LOADGEN_PORT = 23460
+DEFAULT_MIX = 'legacy=1,custom=2,targeted=4,rename=1,churn=2'
+OP_KINDS = ('legacy', 'custom', 'targeted', 'rename', 'churn')
+LEGACY_ALERTS = ('STOP', 'COLD', 'ALERT1', 'ALERT2', 'ALERT3')
+CONNECT_TIMEOUT = 10.0
+SAMPLE_INTERVAL = 1.0  # Seconds between server RSS/CPU samples
+DRAIN_QUIET = 1.0      # Stop waiting for deliveries after this long without any
+
+
+def get_timestamp():
+    return datetime.now().strftime("%H:%M:%S")
+
+
+def parse_mix(text):
+    # 'custom=2,targeted=1' -> {'custom': 2.0, 'targeted': 1.0}
+    mix = {}
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        kind = kind.strip()
+        if kind not in OP_KINDS:
+            raise argparse.ArgumentTypeError(f"Unknown operation {kind!r}, expected one of {', '.join(OP_KINDS)}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def process_tree(pid):
+    # pid and its descendants (the worker processes of a --workers server)
+    pids = [pid]
+    for parent in pids:
+        try:
+            for task in os.listdir(f"/proc/{parent}/task"):
+                with open(f"/proc/{parent}/task/{task}/children") as f:
+                    pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def sample_process(pid):
+    # Linux only: (RSS in kB, CPU seconds) summed over the process tree
+    rss = 0
+    cpu = 0.0
+    ticks = os.sysconf('SC_CLK_TCK')
+    for member in process_tree(pid):
+        try:
+            with open(f"/proc/{member}/status") as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        rss += int(line.split()[1])
+            with open(f"/proc/{member}/stat") as f:
+                fields = f.read().rpartition(')')[2].split()
+            cpu += (int(fields[11]) + int(fields[12])) / ticks  # utime + stime
+        except (OSError, IndexError, ValueError):
+            pass
+    return rss, cpu
+
+
+def fetch_metrics(port):
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+            return json.load(response)
+    except (OSError, ValueError) as e:
+        print(f"[{get_timestamp()}] Could not read server metrics: {e}")
+        return None
+
+
+class SimClient:
+    def __init__(self, generator, index):
+        self.generator = generator
+        self.index = index
+        self.client_id = None
+        self.framing = None
+        self.decoder = MessageDecoder()
+        self.reader = None
+        self.writer = None
+        self.ready = None
+        self.closed = False
+
+    async def connect(self, host, port, framing):
+        loop = asyncio.get_running_loop()
+        self.ready = loop.create_future()
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        # Offer only the framing under test; HELLO itself is always ndjson
+        self.writer.write(encode_message(hello_message(framings=[framing]), FRAMING_NDJSON))
+        loop.create_task(self.read_loop())
+        await asyncio.wait_for(self.ready, CONNECT_TIMEOUT)
+
+    async def read_loop(self):
+        try:
+            while True:
+                data = await self.reader.read(RECV_SIZE)
+                if not data:
+                    break
+                for item in self.decoder.feed(data):
+                    message = parse_message(item)
+                    if message.get('type') == 'HELLO_ACK':
+                        self.client_id = message.get('client_id')
+                        self.framing = message.get('framing') or FRAMING_NDJSON
+                        if message.get('framing'):
+                            self.decoder.set_framing(self.framing)
+                        if not self.ready.done():
+                            self.ready.set_result(True)
+                    elif message.get('type') == 'PING':
+                        self.send({'type': 'PONG'})
+                    else:
+                        self.generator.on_message(message)
+        except (OSError, FramingError, ValueError) as e:
+            if not self.closed:
+                self.generator.errors[type(e).__name__] += 1
+        finally:
+            if not self.ready.done():
+                self.ready.set_exception(ConnectionError("closed before HELLO_ACK"))
+            if not self.closed:
+                self.closed = True
+                self.generator.lost(self)
+
+    def send(self, data):
+        self.writer.write(encode_message(data, self.framing))
+
+    def close(self):
+        self.closed = True
+        if self.writer:
+            self.writer.close()
+
+
+class LoadGenerator:
+    def __init__(self, args):
+        self.args = args
+        self.mix = args.mix
+        self.random = random.Random(args.seed)
+        self.clients = []     # Connected, in no particular order
+        self.by_id = {}       # client_id -> SimClient, for targeted sends
+        self.next_index = 0
+        self.sent = Counter()
+        self.expected = Counter()
+        self.received = Counter()
+        self.errors = Counter()
+        self.latency = {'broadcast': Histogram(), 'targeted': Histogram()}
+        self.connect_latency = Histogram()
+        self.samples = []  # (elapsed, rss kB, cpu %)
+        self.last_delivery = time.perf_counter()
+
+    def on_message(self, message):
+        message_type = message.get('type')
+        if message_type == 'CUSTOM' and 'lg_sent' in message:
+            kind = 'targeted' if message.get('lg_targeted') else 'broadcast'
+            self.latency[kind].observe(time.perf_counter() - message['lg_sent'])
+            self.received[kind] += 1
+            self.last_delivery = time.perf_counter()
+        elif message_type == 'LEGACY_ALERT':
+            self.received['legacy'] += 1
+            self.last_delivery = time.perf_counter()
+        elif message_type in ('CLIENT_ROSTER_DELTA', 'CLIENT_LIST_RESPONSE'):
+            self.received['roster'] += 1
+        else:
+            self.received['other'] += 1
+
+    def lost(self, client):
+        # Dropped by the server (or churned away)
+        if client in self.clients:
+            self.clients.remove(client)
+            self.errors['disconnected_by_server'] += 1
+        self.by_id.pop(client.client_id, None)
+
+    async def open_client(self, semaphore=None):
+        client = SimClient(self, self.next_index)
+        self.next_index += 1
+        start = time.perf_counter()
+        try:
+            if semaphore:
+                async with semaphore:
+                    await client.connect(self.args.host, self.args.port, self.args.framing)
+            else:
+                await client.connect(self.args.host, self.args.port, self.args.framing)
+        except (OSError, asyncio.TimeoutError, ConnectionError) as e:
+            self.errors[f"connect_{type(e).__name__}"] += 1
+            client.close()
+            return None
+        self.connect_latency.observe(time.perf_counter() - start)
+        self.clients.append(client)
+        self.by_id[client.client_id] = client
+        return client
+
+    def run_op(self, kind, seq):
+        if not self.clients:
+            return
+        sender = self.random.choice(self.clients)
+        others = len(self.clients) - 1
+        if kind == 'legacy':
+            sender.send(self.random.choice(LEGACY_ALERTS))
+            self.expected['legacy'] += others
+        elif kind == 'custom':
+            sender.send({'type': 'CUSTOM', 'message': self.args.text, 'bg': '#ff4500', 'gif_url': None,
+                         'lg_seq': seq, 'lg_sent': time.perf_counter()})
+            self.expected['broadcast'] += others
+        elif kind == 'targeted':
+            if not others:
+                return
+            target = sender
+            while target is sender:
+                target = self.random.choice(self.clients)
+            sender.send({'type': 'CUSTOM', 'message': self.args.text, 'bg': '#ff4500', 'gif_url': None,
+                         'target_id': target.client_id, 'lg_seq': seq, 'lg_targeted': True,
+                         'lg_sent': time.perf_counter()})
+            self.expected['targeted'] += 1
+        elif kind == 'rename':
+            sender.send({'type': 'SET_USERNAME', 'username': f"load{sender.index}-{seq}"})
+        elif kind == 'churn':
+            self.clients.remove(sender)
+            self.by_id.pop(sender.client_id, None)
+            sender.close()
+            asyncio.get_running_loop().create_task(self.open_client())
+        self.sent[kind] += 1
+
+    async def drive(self):
+        # Open loop: operations are issued on schedule whether or not the
+        # server keeps up, so overload shows as latency and loss
+        kinds = list(self.mix)
+        weights = [self.mix[kind] for kind in kinds]
+        start = time.perf_counter()
+        issued = 0
+        while True:
+            elapsed = time.perf_counter() - start
+            if elapsed >= self.args.duration:
+                break
+            due = int(elapsed * self.args.rate)
+            for kind in self.random.choices(kinds, weights, k=due - issued):
+                issued += 1
+                self.run_op(kind, issued)
+            await asyncio.sleep(0.001)
+        return time.perf_counter() - start
+
+    async def sample_server(self, pid):
+        start = time.perf_counter()
+        last_cpu = None
+        while True:
+            rss, cpu = sample_process(pid)
+            now = time.perf_counter()
+            if last_cpu is not None:
+                self.samples.append((round(now - start, 1), rss, round((cpu - last_cpu[0]) / (now - last_cpu[1]) * 100, 1)))
+            last_cpu = (cpu, now)
+            await asyncio.sleep(SAMPLE_INTERVAL)
+
+    async def run(self, server_pid=None):
+        args = self.args
+        sampler = asyncio.get_running_loop().create_task(self.sample_server(server_pid)) if server_pid else None
+
+        print(f"[{get_timestamp()}] Connecting {args.clients} clients to {args.host}:{args.port} "
+              f"({args.framing})...")
+        semaphore = asyncio.Semaphore(args.connect_concurrency)
+        start = time.perf_counter()
+        await asyncio.gather(*(self.open_client(semaphore) for _ in range(args.clients)))
+        connect_time = time.perf_counter() - start
+        print(f"[{get_timestamp()}] {len(self.clients)} connected in {connect_time:.2f}s")
+        await asyncio.sleep(args.settle)  # Let the join roster deltas go out
+
+        baseline = Counter(self.received)
+        cpu_start = time.process_time()
+        print(f"[{get_timestamp()}] Driving {args.rate} ops/s for {args.duration}s, mix {args.mix_text}")
+        drive_time = await self.drive()
+
+        # Drain: wait until deliveries stop arriving
+        deadline = time.perf_counter() + args.drain
+        while time.perf_counter() < deadline and time.perf_counter() - self.last_delivery < DRAIN_QUIET:
+            await asyncio.sleep(0.1)
+        run_time = time.perf_counter() - start - connect_time - args.settle
+        loadgen_cpu = time.process_time() - cpu_start
+
+        if sampler:
+            sampler.cancel()
+        metrics = fetch_metrics(args.admin_port) if args.admin_port else None
+        for client in self.clients:
+            client.close()
+
+        received = self.received - baseline
+        deliveries = received['broadcast'] + received['targeted'] + received['legacy']
+        return {
+            'label': args.label,
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'config': {
+                'host': args.host, 'port': args.port, 'server': args.server, 'server_args': args.server_args,
+                'clients': args.clients, 'rate': args.rate, 'duration': args.duration, 'mix': self.mix,
+                'framing': args.framing, 'text_bytes': len(args.text), 'seed': args.seed,
+            },
+            'connect': {
+                'connected': args.clients - sum(count for error, count in self.errors.items()
+                                                if error.startswith('connect_')),
+                'seconds': round(connect_time, 3),
+                'latency': self.connect_latency.snapshot(),
+            },
+            'ops': {'sent': dict(self.sent), 'per_s': round(sum(self.sent.values()) / drive_time, 1)},
+            'deliveries': {
+                'expected': dict(self.expected),
+                'received': dict(received),
+                'delivered_ratio': {kind: round(received[kind] / expected, 4)
+                                    for kind, expected in self.expected.items() if expected},
+                'per_s': round(deliveries / run_time, 1),
+            },
+            'latency': {kind: histogram.snapshot() for kind, histogram in self.latency.items()},
+            'server': self.server_summary(metrics),
+            'loadgen': {'cpu_percent': round(loadgen_cpu / run_time * 100, 1)},
+            'errors': dict(self.errors),
+        }
+
+    def server_summary(self, metrics):
+        summary = {}
+        if self.samples:
+            cpu = [sample[2] for sample in self.samples]
+            summary.update({
+                'rss_kb_peak': max(sample[1] for sample in self.samples),
+                'rss_kb_end': self.samples[-1][1],
+                'cpu_percent_mean': round(sum(cpu) / len(cpu), 1),
+                'cpu_percent_peak': max(cpu),
+                'samples': self.samples,
+            })
+        if metrics:
+            summary['metrics'] = metrics
+        return summary
+
+
+def print_summary(result):
+    config = result['config']
+    print(f"clients={config['clients']} rate={config['rate']}/s duration={config['duration']}s "
+          f"framing={config['framing']} server={config['server'] or 'external'}")
+    connect = result['connect']
+    print(f"connect: {connect['connected']} in {connect['seconds']}s, "
+          f"p99 {connect['latency'].get('p99_us', 0) / 1000:.1f}ms")
+    print(f"ops sent: {result['ops']['sent']} ({result['ops']['per_s']}/s)")
+    deliveries = result['deliveries']
+    print(f"delivered: {deliveries['per_s']}/s, ratio {deliveries['delivered_ratio']}")
+    for kind, latency in result['latency'].items():
+        if latency['count']:
+            print(f"{kind:<10} latency ms: p50 {latency['p50_us'] / 1000:.2f}  p90 {latency['p90_us'] / 1000:.2f}  "
+                  f"p99 {latency['p99_us'] / 1000:.2f}  max {latency['max_us'] / 1000:.2f}  (n={latency['count']})")
+    server = result['server']
+    if 'rss_kb_peak' in server:
+        print(f"server: RSS peak {server['rss_kb_peak'] / 1024:.1f} MB, "
+              f"CPU mean {server['cpu_percent_mean']}% peak {server['cpu_percent_peak']}%")
+    print(f"loadgen CPU: {result['loadgen']['cpu_percent']}% (near 100% means the numbers are loadgen-bound)")
+    if result['errors']:
+        print(f"errors: {result['errors']}")
+
+
+def compare(paths):
+    # Side by side summary of several --json results
+    results = []
+    for path in paths:
+        with open(path) as f:
+            results.append(json.load(f))
+    rows = [
+        ('connect s', lambda r: r['connect']['seconds']),
+        ('ops/s', lambda r: r['ops']['per_s']),
+        ('deliveries/s', lambda r: r['deliveries']['per_s']),
+        ('broadcast p50 ms', lambda r: r['latency']['broadcast'].get('p50_us', 0) / 1000),
+        ('broadcast p99 ms', lambda r: r['latency']['broadcast'].get('p99_us', 0) / 1000),
+        ('targeted p50 ms', lambda r: r['latency']['targeted'].get('p50_us', 0) / 1000),
+        ('targeted p99 ms', lambda r: r['latency']['targeted'].get('p99_us', 0) / 1000),
+        ('targeted ratio', lambda r: r['deliveries']['delivered_ratio'].get('targeted', 0)),
+        ('server RSS MB', lambda r: r['server'].get('rss_kb_peak', 0) / 1024),
+        ('server CPU %', lambda r: r['server'].get('cpu_percent_mean', 0)),
+    ]
+    names = [result.get('label') or os.path.basename(path) for result, path in zip(results, paths)]
+    print(f"{'':<18}" + ''.join(f"{name[:14]:>15}" for name in names))
+    for title, read in rows:
+        values = []
+        for result in results:
+            try:
+                values.append(f"{read(result):>15.2f}")
+            except (KeyError, TypeError):
+                values.append(f"{'-':>15}")
+        print(f"{title:<18}" + ''.join(values))
+
+
+def raise_fd_limit(needed):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, needed), hard))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Alert server load generator")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=LOADGEN_PORT)
+    parser.add_argument('--server', choices=['threaded', 'async'],
+                        help="start server.py in this mode for the run (default: use a running server)")
+    parser.add_argument('--server-args', default='', help="extra server.py arguments, e.g. '--workers 2'")
+    parser.add_argument('--server-pid', type=int, help="sample RSS/CPU of this already running server")
+    parser.add_argument('--admin-port', type=int, help="read the server's metrics endpoint at the end")
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--connect-concurrency', type=int, default=200, help="connections opened at once")
+    parser.add_argument('--rate', type=float, default=100, help="operations per second, all clients together")
+    parser.add_argument('--duration', type=float, default=10, help="seconds")
+    parser.add_argument('--mix', dest='mix_text', default=DEFAULT_MIX,
+                        help=f"weights per operation ({', '.join(OP_KINDS)})")
+    parser.add_argument('--framing', choices=SUPPORTED_FRAMINGS, default=FRAMING_NDJSON)
+    parser.add_argument('--size', type=int, default=100, help="alert text length")
+    parser.add_argument('--settle', type=float, default=1.0, help="seconds between connecting and driving")
+    parser.add_argument('--drain', type=float, default=10.0, help="max seconds to wait for deliveries at the end")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--label', help="name for this run in --compare output")
+    parser.add_argument('--json', help="write the results here ('-' for stdout only)")
+    parser.add_argument('--compare', nargs='+', metavar='RESULT', help="compare --json results and exit")
+    args = parser.parse_args()
+    if not args.compare:
+        args.mix = parse_mix(args.mix_text)
+        args.text = 'x' * args.size
+    return args
+
+
+def main():
+    args = parse_args()
+    if args.compare:
+        compare(args.compare)
+        return
+    raise_fd_limit(args.clients + 256)
+
+    proc = None
+    server_pid = args.server_pid
+    if args.server:
+        extra = args.server_args.split()
+        if args.admin_port is None:
+            args.admin_port = args.port + 1
+        extra += ['--admin-port', str(args.admin_port)]
+        proc = start_server(args.server, args.port, extra)
+        server_pid = proc.pid
+    try:
+        result = asyncio.run(LoadGenerator(args).run(server_pid))
+    finally:
+        if proc:
+            stop_server(proc)
+
+    if args.json == '-':
+        json.dump(result, sys.stdout, indent=2)
+        print()
+        return
+    print_summary(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f"Results written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Server-hosted alert media, content-addressed. A CUSTOM alert's gif_url
+# makes every recipient download the GIF from the internet on its own: 300
+# desks, 300 identical fetches from one external host. With a media store
+# the sender uploads the bytes once, the alert carries their SHA-256
+# ('media'), and recipients fetch them from the server's media port:
+#
+#   HEAD /media/<sha256>   is it there already? (then there's no upload)
+#   PUT  /media/<sha256>   upload; refused unless the body hashes to the name
+#   GET  /media/<sha256>   the file, sent with sendfile() straight from the
+#                          page cache; immutable, so clients cache it by hash
+#                          for good and a repeated alert costs no bytes at all
+#
+# Files are stored under their hash, so the same GIF uploaded by two desks
+# is kept once. The store is trimmed to its retention size, least recently
+# served first. Like the alert port itself, anyone who can reach the media
+# port can upload; only images are accepted, up to max_file_bytes each.
+
+MEDIA_PORT = 12346
+MEDIA_RETENTION_BYTES = 512 * 1024 * 1024
+MAX_MEDIA_BYTES = 10 * 1024 * 1024  # Per file
+MEDIA_TYPES = (  # Leading bytes -> Content-Type
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+)
+HASH_PATTERN = re.compile(r'[0-9a-f]{64}\Z')
+PATH_PATTERN = re.compile(r'/media/([0-9a-f]{64})\Z')
+
+
+def is_media_hash(value):
+    return isinstance(value, str) and HASH_PATTERN.match(value) is not None
+
+
+def media_type(head):
+    # Content-Type for a file starting with head, None if it isn't an image we take
+    for magic, content_type in MEDIA_TYPES:
+        if head.startswith(magic):
+            return content_type
+    return None
+
+
+class MediaError(Exception):
+    def __init__(self, status, reason):
+        super().__init__(reason)
+        self.status = status  # HTTP status to answer with
+
+
+class MediaStore:
+    # Only the process serving the media port writes; cluster workers
+    # sharing the directory just check what's there (has())
+    def __init__(self, directory, retention_bytes=MEDIA_RETENTION_BYTES, max_file_bytes=MAX_MEDIA_BYTES):
+        self.directory = directory
+        self.retention_bytes = retention_bytes
+        self.max_file_bytes = max_file_bytes
+        self.lock = threading.Lock()
+        self.files = OrderedDict()  # hash -> size, least recently used first
+        self.total_bytes = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest)
+
+    def has(self, digest):
+        return is_media_hash(digest) and os.path.exists(self.path(digest))
+
+    def put(self, digest, data):
+        # -> True if stored, False if it was there already
+        if len(data) > self.max_file_bytes:
+            raise MediaError(413, f"over {self.max_file_bytes} bytes")
+        if media_type(data[:16]) is None:
+            raise MediaError(415, "not a GIF, PNG or JPEG image")
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise MediaError(400, "content doesn't match its hash")
+        if self.has(digest):
+            self.touch(digest)
+            return False
+        # Written under a temporary name first, so a file is never seen torn
+        tmp_path = self.path(f"{digest}.{threading.get_ident()}.tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path(digest))
+        with self.lock:
+            if digest not in self.files:
+                self.files[digest] = len(data)
+                self.total_bytes += len(data)
+            self._evict()
+        return True
+
+    def open(self, digest):
+        # -> (file, size, content type) or None; the caller closes the file
+        try:
+            f = open(self.path(digest), 'rb')
+        except OSError:
+            return None
+        size = os.fstat(f.fileno()).st_size
+        content_type = media_type(os.pread(f.fileno(), 16, 0)) or 'application/octet-stream'
+        self.touch(digest)
+        return f, size, content_type
+
+    def touch(self, digest):
+        with self.lock:
+            if digest in self.files:
+                self.files.move_to_end(digest)
+
+    def stats(self):
+        with self.lock:
+            return {'files': len(self.files), 'bytes': self.total_bytes}
+
+    def _evict(self):
+        # Caller holds the lock
+        while self.total_bytes > self.retention_bytes and len(self.files) > 1:
+            digest, size = self.files.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self.path(digest))
+            except OSError:
+                pass
+
+    def _load_index(self):
+        # Oldest modified first: a restart forgets the order they were last served in
+        found = []
+        for name in os.listdir(self.directory):
+            path = self.path(name)
+            if name.endswith('.tmp'):
+                try:
+                    os.remove(path)  # Left by a crash mid-upload
+                except OSError:
+                    pass
+                continue
+            if not is_media_hash(name):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            found.append((stat.st_mtime, name, stat.st_size))
+        for _, digest, size in sorted(found):
+            self.files[digest] = size
+            self.total_bytes += size
+        self._evict()
+
+
+class MediaServer:
+    # The media port, on its own threads. incr(name, n) counts requests
+    # (Metrics.incr), so they show up in the server's metrics.
+    def __init__(self, store, port=MEDIA_PORT, host='', incr=None):
+        self.store = store
+        self.incr = incr or (lambda name, n=1: None)
+        self.httpd = ThreadingHTTPServer((host, port), self.make_handler())
+        self.httpd.daemon_threads = True
+
+    def make_handler(self):
+        store = self.store
+        incr = self.incr
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # Keep-alive, for fetching several files
+
+            def digest(self):
+                match = PATH_PATTERN.match(self.path)
+                if match is None:
+                    self.send_error(404)
+                    return None
+                return match.group(1)
+
+            def do_HEAD(self):
+                self.send_file(body=False)
+
+            def do_GET(self):
+                self.send_file(body=True)
+
+            def send_file(self, body):
+                digest = self.digest()
+                if digest is None:
+                    return
+                etag = f'"{digest}"'
+                if self.headers.get('If-None-Match') == etag:
+                    # The client has it already; content never changes
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    incr('media_not_modified')
+                    return
+                opened = store.open(digest)
+                if opened is None:
+                    self.send_error(404)
+                    return
+                f, size, content_type = opened
+                with f:
+                    self.send_response(200)
+                    self.send_header('Content-Type', content_type)
+                    self.send_header('Content-Length', str(size))
+                    self.send_header('ETag', etag)
+                    self.send_header('Cache-Control', 'public, max-age=31536000, immutable')
+                    self.end_headers()
+                    if body:
+                        # Headers are written by now (wfile is unbuffered);
+                        # the file goes from the page cache to the socket
+                        # without passing through Python
+                        self.connection.sendfile(f)
+                        incr('media_served')
+                        incr('media_bytes_served', size)
+
+            def do_PUT(self):
+                digest = self.digest()
+                if digest is None:
+                    return
+                if self.headers.get('Content-Length') is None:
+                    self.send_error(411)
+                    return
+                try:
+                    length = int(self.headers['Content-Length'])
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    # A negative length would read to EOF, past max_file_bytes
+                    self.send_error(400, "bad Content-Length")
+                    return
+                if length > store.max_file_bytes:
+                    self.send_error(413)
+                    return
+                data = self.rfile.read(length)
+                try:
+                    stored = store.put(digest, data)
+                except MediaError as e:
+                    self.send_error(e.status, str(e))
+                    return
+                incr('media_uploads' if stored else 'media_upload_duplicates')
+                reply = json.dumps({'media': digest}).encode('utf-8')
+                self.send_response(201 if stored else 200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(reply)))
+                self.end_headers()
+                self.wfile.write(reply)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name='media-http', daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,193 @@
+import json
+import math
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# In-process server metrics:
+#   - counters: monotonically increasing totals (messages, bytes, drops, ...)
+#   - histograms: latencies in log-spaced buckets, so observing is O(1) and
+#     memory is fixed no matter how many samples; percentiles are read from
+#     the buckets (within ~10% of the true value)
+#   - gauges: functions read only when a snapshot is taken (connected
+#     clients, queue depths), so they cost nothing on the hot path
+# snapshot() returns plain JSON-able dicts; AdminServer serves them over
+# HTTP on localhost:
+#   curl http://127.0.0.1:9100/metrics
+
+BUCKETS_PER_OCTAVE = 8
+HISTOGRAM_OCTAVES = 36  # 1 us .. ~19 hours
+PERCENTILES = (50, 90, 99, 99.9)
+RETIRE_SHARDS = 64  # Shards registered before those of finished threads are folded away
+
+
+class Histogram:
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (BUCKETS_PER_OCTAVE * HISTOGRAM_OCTAVES)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        # Bucket from the float's exponent and mantissa, no search
+        micros = seconds * 1e6
+        if micros < 1.0:
+            index = 0
+        else:
+            mantissa, exponent = math.frexp(micros)  # micros = mantissa * 2**exponent, 0.5 <= mantissa < 1
+            index = min((exponent - 1) * BUCKETS_PER_OCTAVE + int((mantissa * 2 - 1) * BUCKETS_PER_OCTAVE),
+                        len(self.counts) - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        # Upper bound of the bucket holding the p-th percentile, in seconds
+        if not self.count:
+            return 0.0
+        rank = self.count * p / 100
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                octave, step = divmod(index + 1, BUCKETS_PER_OCTAVE)
+                return min(2 ** octave * (1 + step / BUCKETS_PER_OCTAVE) / 1e6, self.max)
+        return self.max
+
+    def snapshot(self):
+        stats = {'count': self.count}
+        if self.count:
+            stats['mean_us'] = round(self.total / self.count * 1e6, 1)
+            for p in PERCENTILES:
+                stats[f"p{p:g}_us"] = round(self.percentile(p) * 1e6, 1)
+            stats['max_us'] = round(self.max * 1e6, 1)
+        return stats
+
+
+class Shard:
+    # One thread's counters and histograms: updated without a lock
+    __slots__ = ('thread', 'counters', 'histograms')
+
+    def __init__(self, thread):
+        self.thread = thread
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+
+    def merge_into(self, counters, histograms):
+        for name, value in list(self.counters.items()):
+            counters[name] += value
+        for name, histogram in list(self.histograms.items()):
+            total = histograms[name]
+            total.counts = [a + b for a, b in zip(total.counts, histogram.counts)]
+            total.count += histogram.count
+            total.total += histogram.total
+            total.max = max(total.max, histogram.max)
+
+
+class Metrics:
+    # incr() and observe() go to a per-thread shard, so the threaded server's
+    # reader and writer threads never contend on a lock; snapshot() adds the
+    # shards up. Shards of finished threads are folded into a running total
+    # whenever the list doubles, scraped or not, so per-connection threads
+    # and timers don't pile up shards.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.shards = []
+        self.retire_at = RETIRE_SHARDS
+        self.retired = Shard(None)
+        self.gauges = {}
+        self.started = time.time()
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = Shard(threading.current_thread())
+            with self.lock:
+                self.shards.append(shard)
+                if len(self.shards) >= self.retire_at:
+                    self._retire_finished()
+                    self.retire_at = max(RETIRE_SHARDS, 2 * len(self.shards))
+            return shard
+
+    def incr(self, name, amount=1):
+        self.shard().counters[name] += amount
+
+    def observe(self, name, seconds):
+        self.shard().histograms[name].observe(seconds)
+
+    def gauge(self, name, read):
+        # read() is called at snapshot time, from the admin thread
+        self.gauges[name] = read
+
+    def snapshot(self):
+        counters = defaultdict(int)
+        histograms = defaultdict(Histogram)
+        with self.lock:
+            self._retire_finished()
+            for shard in [self.retired] + self.shards:
+                shard.merge_into(counters, histograms)
+        gauges = {}
+        for name, read in list(self.gauges.items()):
+            try:
+                gauges[name] = read()
+            except Exception as e:
+                gauges[name] = f"error: {e}"
+        return {
+            'uptime_s': round(time.time() - self.started, 1),
+            'counters': dict(counters),
+            'gauges': gauges,
+            'latency': {name: histogram.snapshot() for name, histogram in histograms.items()},
+        }
+
+    def _retire_finished(self):
+        # Caller holds the lock
+        live = []
+        for shard in self.shards:
+            if shard.thread.is_alive():
+                live.append(shard)
+            else:
+                shard.merge_into(self.retired.counters, self.retired.histograms)
+        self.shards = live
+
+
+class AdminServer:
+    # GET /metrics (or /) -> snapshot() as JSON. Localhost only by default;
+    # it runs on its own thread so a scrape never waits on the server loop.
+    def __init__(self, snapshot, port, host='127.0.0.1'):
+        self.snapshot = snapshot
+        self.httpd = ThreadingHTTPServer((host, port), self.make_handler())
+        self.httpd.daemon_threads = True
+
+    def make_handler(self):
+        snapshot = self.snapshot
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = json.dumps(snapshot(), indent=2).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Scrapes aren't worth a log line each
+
+        return Handler
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name='admin-http', daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
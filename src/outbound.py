@@ -0,0 +1,217 @@
+import socket
+import threading
+from collections import deque
+
+# Per-client outbound queues. Messages are encoded once (see
+# AlertServer.broadcast_alert) and the same bytes object is queued for every
+# recipient; a writer thread or the event loop drains each queue, so a slow
+# peer only ever delays itself.
+#
+# put() also takes an EncodedMessage, which is turned into bytes for the
+# queue's framing under the queue lock. set_framing() switches that framing
+# in the same critical section as queuing HELLO_ACK, so no message encoded
+# for the old framing can end up behind the ACK.
+#
+# Writers take everything queued at once (get_batch/pop_batch) and hand it
+# to the kernel in one gathered write (write_batch: sendmsg, i.e. writev),
+# so a burst of messages for one client costs one syscall instead of one
+# each. Sockets run with TCP_NODELAY: batching is done here, where we know
+# when a burst ends, instead of by Nagle's algorithm and its delayed-ACK
+# stalls.
+#
+# A full queue also pushes back on the client's reads: its reader waits
+# (wait_drained) until the queue is down to half, so a client that asks for
+# rosters and templates without reading the answers stops being read
+# rather than having them dropped.
+
+POLICY_DROP_OLDEST = 'drop_oldest'  # Full queue: discard the oldest message
+POLICY_DISCONNECT = 'disconnect'    # Full queue: give up on the client
+POLICY_COALESCE = 'coalesce'        # Newer message replaces a queued one with the same key
+SLOW_CONSUMER_POLICIES = [POLICY_DROP_OLDEST, POLICY_DISCONNECT, POLICY_COALESCE]
+
+DEFAULT_QUEUE_SIZE = 256
+MAX_WRITE_BATCH = 1024  # Messages per write; Linux's IOV_MAX
+
+
+class OutboundQueue:
+    def __init__(self, maxsize=DEFAULT_QUEUE_SIZE, policy=POLICY_DROP_OLDEST, on_ready=None):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.on_ready = on_ready  # Called when the queue goes from empty to non-empty
+        self.items = deque()  # [key, payload] cells
+        self.keyed = {}       # key -> cell still in self.items, for coalescing
+        self.cond = threading.Condition()
+        self.closed = False
+        self.framing = None  # Wire framing the client negotiated, for EncodedMessage
+        self.dropped = 0
+        self.coalesced = 0
+        self.draining = 0  # Readers blocked in wait_drained()
+
+    def __len__(self):
+        return len(self.items)
+
+    def full(self):
+        return len(self.items) >= self.maxsize
+
+    def drained(self):
+        return len(self.items) <= self.maxsize // 2
+
+    def wait_drained(self, timeout=None):
+        # Block until the queue is down to half full (or closed); False on timeout
+        with self.cond:
+            self.draining += 1
+            try:
+                while not self.closed and not self.drained():
+                    if not self.cond.wait(timeout):
+                        return False
+                return True
+            finally:
+                self.draining -= 1
+
+    def put(self, payload, key=None):
+        # Returns False when the client should be disconnected (queue closed,
+        # or full under the disconnect policy)
+        with self.cond:
+            if self.closed:
+                return False
+            if not isinstance(payload, bytes):
+                payload = payload.encode(self.framing)
+
+            if self.policy == POLICY_COALESCE and key is not None and key in self.keyed:
+                # Still unsent: the newer message supersedes it in place
+                self.keyed[key][1] = payload
+                self.coalesced += 1
+                return True
+
+            if len(self.items) >= self.maxsize:
+                if self.policy == POLICY_DISCONNECT:
+                    return False
+                self._forget(self.items.popleft())
+                self.dropped += 1
+
+            cell = [key, payload]
+            self.items.append(cell)
+            if key is not None:
+                self.keyed[key] = cell
+            was_empty = len(self.items) == 1
+            self.cond.notify()
+
+        if was_empty and self.on_ready:
+            self.on_ready()
+        return True
+
+    def set_framing(self, framing, payload=None):
+        # Queue payload (the last message in the old framing) and switch
+        with self.cond:
+            queued = payload is None or self.put(payload)
+            self.framing = framing
+            return queued
+
+    def get(self, timeout=None):
+        # Blocking pop for writer threads; None once the queue is closed
+        with self.cond:
+            while not self.items and not self.closed:
+                if not self.cond.wait(timeout):
+                    return None
+            if self.closed:
+                return None
+            cell = self.items.popleft()
+            self._forget(cell)
+            self._wake_drained()
+            return cell[1]
+
+    def pop(self):
+        # Non-blocking pop for the event loop; None when empty
+        with self.cond:
+            if not self.items:
+                return None
+            cell = self.items.popleft()
+            self._forget(cell)
+            self._wake_drained()
+            return cell[1]
+
+    def get_batch(self, limit=MAX_WRITE_BATCH, timeout=None):
+        # Like get(), but everything queued (up to limit) as a list
+        with self.cond:
+            while not self.items and not self.closed:
+                if not self.cond.wait(timeout):
+                    return None
+            if self.closed:
+                return None
+            return self._take(limit)
+
+    def pop_batch(self, limit=MAX_WRITE_BATCH):
+        # Like pop(); an empty list when there's nothing queued
+        with self.cond:
+            return self._take(limit)
+
+    def _take(self, limit):
+        batch = []
+        items = self.items
+        while items and len(batch) < limit:
+            cell = items.popleft()
+            self._forget(cell)
+            batch.append(cell[1])
+        if batch:
+            self._wake_drained()
+        return batch
+
+    def _wake_drained(self):
+        # Called with the lock held after taking messages out
+        if self.draining and self.drained():
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.items.clear()
+            self.keyed.clear()
+            self.cond.notify_all()
+
+    def _forget(self, cell):
+        key = cell[0]
+        if key is not None and self.keyed.get(key) is cell:
+            del self.keyed[key]
+
+
+def set_nodelay(sock, nodelay=True):
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if nodelay else 0)
+    except OSError:
+        pass  # Already reset by the peer
+
+
+def write_batch(sock, payloads, cork=False):
+    # Write all of payloads to a blocking socket with as few syscalls as
+    # possible; returns the number of send calls. sendmsg() may take only
+    # part of the batch (a full send buffer), in which case the rest,
+    # starting mid-payload if need be, goes in the next call. cork holds
+    # the segments back until the whole batch is written (Linux TCP_CORK),
+    # so a batch that needs several calls still leaves in full-sized packets.
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b''.join(payloads))
+        return 1
+    corked = cork and hasattr(socket, 'TCP_CORK')
+    if corked:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+    try:
+        calls = 0
+        index = 0
+        while index < len(payloads):
+            sent = sock.sendmsg(payloads[index:index + MAX_WRITE_BATCH])
+            calls += 1
+            while index < len(payloads) and sent >= len(payloads[index]):
+                sent -= len(payloads[index])
+                index += 1
+            if sent:
+                # Short write: keep the unsent tail of this payload
+                payloads[index] = memoryview(payloads[index])[sent:]
+        return calls
+    finally:
+        if corked:
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+            except OSError:
+                pass
@@ -0,0 +1,90 @@
+import time
+from collections import OrderedDict
+
+# Client-side alert scheduler. Incoming alerts no longer open a popup each:
+#   - an alert with the same key (sender + type) as one already on screen or
+#     waiting just bumps that alert's count, shown as a badge on the popup
+#   - at most max_visible popups are open at once; the rest wait in order
+#   - new popups open at most max_rate per second, so a burst of 100 alerts
+#     trickles in instead of opening 100 windows in one go
+# Everything runs on the Tk thread. show(alert) opens the popup and must call
+# closed(alert) when it goes away; call_later(ms, callback) is root.after.
+
+MAX_VISIBLE_POPUPS = 3
+MAX_POPUP_RATE = 2.0  # New popups per second
+MAX_PENDING_ALERTS = 100  # Distinct alerts waiting; later ones are dropped
+
+
+class PendingAlert:
+    __slots__ = ('key', 'message', 'bg', 'gif_url', 'count', 'on_count')
+
+    def __init__(self, key, message, bg, gif_url):
+        self.key = key
+        self.message = message
+        self.bg = bg
+        self.gif_url = gif_url
+        self.count = 1
+        self.on_count = None  # Set by show() to refresh the badge of an open popup
+
+
+class PopupScheduler:
+    def __init__(self, show, call_later, max_visible=MAX_VISIBLE_POPUPS, max_rate=MAX_POPUP_RATE,
+                 max_pending=MAX_PENDING_ALERTS):
+        self.show = show
+        self.call_later = call_later
+        self.max_visible = max_visible
+        self.min_interval = 1.0 / max_rate if max_rate > 0 else 0.0
+        self.max_pending = max_pending
+        self.visible = {}            # key -> alert with an open popup
+        self.pending = OrderedDict()  # key -> alert waiting, oldest first
+        self.last_shown = 0.0
+        self.pump_scheduled = False
+        self.shown = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def submit(self, key, message, bg, gif_url=None):
+        alert = self.visible.get(key) or self.pending.get(key)
+        if alert:
+            alert.count += 1
+            self.coalesced += 1
+            if alert.on_count:
+                alert.on_count(alert.count)
+            return
+        if len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        self.pending[key] = PendingAlert(key, message, bg, gif_url)
+        self.pump()
+
+    def closed(self, alert):
+        if self.visible.get(alert.key) is alert:
+            del self.visible[alert.key]
+        self.pump()
+
+    def pump(self):
+        while self.pending and len(self.visible) < self.max_visible:
+            wait = self.last_shown + self.min_interval - time.monotonic()
+            if wait > 0:
+                if not self.pump_scheduled:
+                    self.pump_scheduled = True
+                    self.call_later(int(wait * 1000) + 1, self._scheduled_pump)
+                return
+            _, alert = self.pending.popitem(last=False)
+            self.visible[alert.key] = alert
+            self.last_shown = time.monotonic()
+            self.shown += 1
+            self.show(alert)
+
+    def _scheduled_pump(self):
+        self.pump_scheduled = False
+        self.pump()
+
+    def stats(self):
+        return {
+            'popups_shown': self.shown,
+            'alerts_coalesced': self.coalesced,
+            'alerts_dropped': self.dropped,
+            'popups_visible': len(self.visible),
+            'alerts_pending': len(self.pending),
+        }
@@ -0,0 +1,106 @@
+import argparse
+
+# Per-client limits on what clients send us. Without them one desk looping
+# send_alert makes the server fan out to everyone else at line rate.
+#
+# Each client gets a token bucket per kind of message: `rate` per second,
+# up to `burst` at once. An alert is CUSTOM, TEMPLATE_ALERT or a legacy
+# string alert, all sharing one bucket; roster requests, renames and so on
+# each have their own. Types not listed (HELLO, PING, PONG) aren't limited;
+# a 'type' that isn't a string at all counts as INVALID.
+#
+# Traffic over the limit is either throttled (the message waits for its
+# token and the client isn't read meanwhile, so it backs up into the
+# client's TCP send buffer and a looping sender blocks) or dropped. Only
+# the client's own reader (or its slot on the event loop) touches its
+# buckets, so they need no lock.
+
+RATE_POLICY_THROTTLE = 'throttle'  # Over the limit: hold the message until allowed
+RATE_POLICY_DROP = 'drop'          # Over the limit: discard the message
+RATE_POLICIES = [RATE_POLICY_THROTTLE, RATE_POLICY_DROP]
+
+ALERT = 'alert'
+INVALID = 'invalid'  # Messages whose type isn't a string
+# kind -> (messages per second, burst)
+RATE_LIMITS = {
+    ALERT: (5.0, 20),
+    'CLIENT_LIST_REQUEST': (1.0, 5),
+    'SET_USERNAME': (1.0, 5),
+    'TEMPLATE_SYNC': (1.0, 5),
+    'SUBSCRIBE': (5.0, 20),
+    'UNSUBSCRIBE': (5.0, 20),
+    INVALID: (1.0, 5),
+}
+ALERT_TYPES = ('CUSTOM', 'TEMPLATE_ALERT', 'legacy')
+
+
+def limit_kind(message_type):
+    if not isinstance(message_type, str):
+        return INVALID  # Lists and dicts can't even be looked up
+    return ALERT if message_type in ALERT_TYPES else message_type
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'last')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = now
+
+    def take(self, now, borrow=False):
+        # -> 0 if a token was taken, else seconds until there is one. With
+        # borrow the token is taken anyway, for a message that will wait
+        # that long; the bucket then refills to empty by then.
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        wait = (1 - self.tokens) / self.rate
+        if borrow:
+            self.tokens -= 1
+        return wait
+
+
+class ClientLimits:
+    # One client's buckets, made on first use of each kind
+    __slots__ = ('limits', 'buckets', 'limited', 'over')
+
+    def __init__(self, limits):
+        self.limits = limits  # Shared kind -> (rate, burst) dict
+        self.buckets = {}
+        self.limited = 0      # Messages throttled or dropped, for metrics
+        self.over = False     # Over a limit since the last message let straight through
+
+    def take(self, message_type, now, borrow=False):
+        # -> (kind, 0) if the message may be handled now, else (kind, seconds to wait)
+        kind = limit_kind(message_type)
+        bucket = self.buckets.get(kind)
+        if bucket is None:
+            limit = self.limits.get(kind)
+            if limit is None:
+                return kind, 0
+            bucket = self.buckets[kind] = TokenBucket(limit[0], limit[1], now)
+        return kind, bucket.take(now, borrow)
+
+
+def parse_rate_limit(text):
+    # argparse type for KIND=RATE[/BURST] or KIND=off, e.g. alert=10/50
+    kind, _, value = text.partition('=')
+    if not kind or not value:
+        raise argparse.ArgumentTypeError(f"expected KIND=RATE[/BURST] or KIND=off, got {text!r}")
+    if kind in ALERT_TYPES:
+        raise argparse.ArgumentTypeError(f"{kind} shares the {ALERT!r} limit")
+    if value == 'off':
+        return kind, None
+    rate, _, burst = value.partition('/')
+    try:
+        rate = float(rate)
+        burst = float(burst) if burst else max(1.0, rate)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"bad rate limit {text!r}")
+    if rate <= 0 or burst < 1:
+        raise argparse.ArgumentTypeError(f"rate must be positive and burst at least 1 in {text!r}")
+    return kind, (rate, burst)
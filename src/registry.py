@@ -0,0 +1,183 @@
+import threading
+
+# Connected-client bookkeeping for AlertServer.
+#
+# Reader, writer and timer threads all add and remove clients while
+# broadcasts walk the whole list. Mutations take the registry lock; readers
+# iterate an immutable snapshot (a tuple, rebuilt lazily after a change), so
+# a broadcast never sees the registry change size underneath it and never
+# holds the lock while it sends.
+#
+# Topic subscriptions are indexed the same way: topic -> subscribed records,
+# with a per-topic snapshot, so publishing to a topic touches its
+# subscribers only, however many other clients are connected.
+
+MAX_TOPICS = 100  # Subscriptions per client
+MAX_TOPIC_LENGTH = 64
+MAX_USERNAME_LENGTH = 64
+
+
+class ClientRecord:
+    __slots__ = ('client_id', 'socket', 'address', 'username', 'decoder', 'framing',
+                 'roster_deltas', 'templates', 'resume', 'heartbeat', 'queue', 'identity', 'connected_seq',
+                 'last_seen', 'ping_sent', 'topics', 'limits', 'held')
+
+    def __init__(self, client_id, socket, address, username, decoder, queue):
+        self.client_id = client_id
+        self.socket = socket        # Anything with shutdown() and close()
+        self.address = address
+        self.username = username
+        self.decoder = decoder      # Legacy framing until the client sends HELLO
+        self.framing = None
+        self.roster_deltas = False  # Set by HELLO; legacy clients get full lists
+        self.templates = False      # Set by HELLO; otherwise template alerts arrive rendered
+        self.resume = False         # Set by HELLO; gets resume tokens
+        self.heartbeat = False      # Set by HELLO; pinged when idle, reaped when silent
+        self.queue = queue
+        self.identity = None        # Stable client token from HELLO, for offline delivery
+        self.connected_seq = 0      # Alert log position when this connection was registered
+        self.last_seen = 0.0        # time.monotonic() of the last data received
+        self.ping_sent = 0.0        # time.monotonic() of the unanswered PING, 0 if none
+        self.topics = frozenset()   # Subscribed topics; replaced, not mutated, under the registry lock
+        self.limits = None          # ratelimit.ClientLimits, None when unlimited
+        self.held = None            # (message, rest of its chunk, rate limit still to check), see resume_data
+
+
+class ClientRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_id = {}
+        self.by_username = {}  # username -> [records]; names aren't unique, but nearly so
+        self.by_address = {}   # (host, port) -> record
+        self.by_host = {}      # host -> number of connections, for per-IP limits
+        self.by_topic = {}     # topic -> {client_id: record}
+        self._snapshot = ()
+        self._snapshot_valid = True
+        self._topic_snapshots = {}  # topic -> tuple of records, dropped on change
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __contains__(self, client_id):
+        return client_id in self.by_id
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def add(self, record):
+        with self.lock:
+            self.by_id[record.client_id] = record
+            self.by_username.setdefault(record.username, []).append(record)
+            self.by_address[record.address] = record
+            host = record.address[0]
+            self.by_host[host] = self.by_host.get(host, 0) + 1
+            self._snapshot_valid = False
+
+    def remove(self, client_id):
+        # Returns the record to exactly one caller; everyone racing to
+        # disconnect the same client after that gets None. by_id goes last,
+        # so a record that can't be unindexed is still found next time.
+        with self.lock:
+            record = self.by_id.get(client_id)
+            if record is None:
+                return None
+            self._unindex_username(record)
+            if self.by_address.get(record.address) is record:
+                del self.by_address[record.address]
+            host = record.address[0]
+            if self.by_host[host] > 1:
+                self.by_host[host] -= 1
+            else:
+                del self.by_host[host]
+            self._unindex_topics(record, record.topics)
+            del self.by_id[client_id]
+            self._snapshot_valid = False
+            return record
+
+    def rename(self, client_id, username):
+        with self.lock:
+            record = self.by_id.get(client_id)
+            if record is None:
+                return None
+            # Indexed first, so a name that can't be (unhashable) raises
+            # before the record changes
+            self.by_username.setdefault(username, [])
+            self._unindex_username(record)
+            record.username = username
+            self.by_username.setdefault(username, []).append(record)
+            return record
+
+    def get(self, client_id):
+        return self.by_id.get(client_id)
+
+    def subscribe(self, client_id, topics):
+        # -> the client's topics afterwards, None if it's gone. Past
+        # MAX_TOPICS, further topics are ignored.
+        with self.lock:
+            record = self.by_id.get(client_id)
+            if record is None:
+                return None
+            added = [topic for topic in topics if topic not in record.topics]
+            added = added[:max(0, MAX_TOPICS - len(record.topics))]
+            for topic in added:
+                self.by_topic.setdefault(topic, {})[client_id] = record
+                self._topic_snapshots.pop(topic, None)
+            record.topics = record.topics.union(added)
+            return record.topics
+
+    def unsubscribe(self, client_id, topics):
+        with self.lock:
+            record = self.by_id.get(client_id)
+            if record is None:
+                return None
+            removed = record.topics.intersection(topics)
+            self._unindex_topics(record, removed)
+            record.topics = record.topics - removed
+            return record.topics
+
+    def subscribers(self, topic):
+        # Immutable view of a topic's subscribers, like snapshot()
+        subscribers = self._topic_snapshots.get(topic)
+        if subscribers is None:
+            with self.lock:
+                subscribed = self.by_topic.get(topic)
+                if not subscribed:
+                    return ()
+                subscribers = self._topic_snapshots[topic] = tuple(subscribed.values())
+        return subscribers
+
+    def topic_count(self):
+        return len(self.by_topic)
+
+    def find_by_username(self, username):
+        with self.lock:
+            return list(self.by_username.get(username, ()))
+
+    def find_by_address(self, address):
+        return self.by_address.get(address)
+
+    def host_count(self, host):
+        return self.by_host.get(host, 0)
+
+    def snapshot(self):
+        # Immutable view of all records, safe to iterate without the lock
+        with self.lock:
+            if not self._snapshot_valid:
+                self._snapshot = tuple(self.by_id.values())
+                self._snapshot_valid = True
+            return self._snapshot
+
+    def _unindex_topics(self, record, topics):
+        for topic in topics:
+            subscribed = self.by_topic.get(topic)
+            if subscribed and subscribed.pop(record.client_id, None) is not None:
+                if not subscribed:
+                    del self.by_topic[topic]
+                self._topic_snapshots.pop(topic, None)
+
+    def _unindex_username(self, record):
+        same_name = self.by_username.get(record.username)
+        if same_name and record in same_name:
+            same_name.remove(record)
+            if not same_name:
+                del self.by_username[record.username]
@@ -1,198 +1,1398 @@
 import socket
 import threading
+import asyncio
+import argparse
+import functools
+import heapq
 import json
+import logging
+import os
+import resource
+import secrets
+import selectors
+import signal
+import subprocess
+import sys
 import time
-from datetime import datetime
+from collections import OrderedDict
+
+from framing import (MessageDecoder, FramingError, EncodedMessage, encode_message, parse_message, choose_framing, RECV_SIZE,
+                     SUPPORTED_FRAMINGS, FRAMING_NDJSON, SUPPORTED_FEATURES, FEATURE_ROSTER_DELTA, FEATURE_TEMPLATES,
+                     FEATURE_RESUME, FEATURE_HEARTBEAT, FEATURE_TOPICS, FEATURE_MEDIA)
+from outbound import (OutboundQueue, SLOW_CONSUMER_POLICIES, POLICY_DROP_OLDEST, DEFAULT_QUEUE_SIZE, MAX_WRITE_BATCH,
+                      write_batch, set_nodelay)
+from registry import ClientRegistry, ClientRecord, MAX_TOPICS, MAX_TOPIC_LENGTH, MAX_USERNAME_LENGTH
+from cluster import SocketBus, BusBroker
+from templates import TemplateRegistry, TemplateError
+from alertlog import AlertLog, LOG_RETENTION_BYTES
+from metrics import Metrics, AdminServer
+from serverlog import logger, AsyncLog, LOG_RATE
+from sessions import ResumeTokens, load_secret, SECRET_ENV
+from heartbeat import (TimerWheel, set_keepalive, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT, HEARTBEAT_TICK,
+                       KEEPALIVE_IDLE)
+from media import MediaStore, MediaServer, MEDIA_PORT, MEDIA_RETENTION_BYTES, MAX_MEDIA_BYTES
+from ratelimit import ClientLimits, parse_rate_limit, RATE_LIMITS, RATE_POLICIES, RATE_POLICY_THROTTLE
 
 PORT = 12345
+ROSTER_DEBOUNCE = 0.25  # Seconds of join/leave/rename churn batched into one roster delta
+DEPARTED_IDENTITIES = 10000  # Disconnected client IDs remembered for offline targeted alerts
+LISTEN_BACKLOG = 1024  # Connections the kernel queues for us (capped by net.core.somaxconn)
+ACCEPT_BATCH = 64  # Connections accepted per wakeup before handling anything else
+DRAIN = -1.0  # From handle_data(): a message is held until the client's outbound queue drains
+PING = EncodedMessage({'type': 'PING'})
+MAX_TARGETS = 1000  # Client IDs and topics in one multicast
+# Message types counted separately in the metrics; anything else is 'other'
+MESSAGE_TYPES = ('HELLO', 'CUSTOM', 'TEMPLATE_ALERT', 'TEMPLATE_SYNC', 'CLIENT_LIST_REQUEST', 'SET_USERNAME',
+                 'PING', 'PONG', 'SUBSCRIBE', 'UNSUBSCRIBE')
+
+
+def topic_names(topics):
+    # Valid names from a client's list; anything else is ignored
+    if not isinstance(topics, list):
+        return []
+    return [topic for topic in topics[:MAX_TOPICS] if isinstance(topic, str) and 0 < len(topic) <= MAX_TOPIC_LENGTH]
+
+
+def split_targets(targets):
+    # A multicast's 'targets' -> (client IDs, topic names)
+    if not isinstance(targets, list):
+        return [], []
+    targets = targets[:MAX_TARGETS]
+    client_ids = [target for target in targets if isinstance(target, int) and not isinstance(target, bool)]
+    return client_ids, topic_names([target for target in targets if isinstance(target, str)])
+
 
 class AlertServer:
-    def __init__(self):
-        self.clients = {}  # {client_id: {'socket': socket, 'address': address, 'username': username}}
+    def __init__(self, port=PORT, queue_size=DEFAULT_QUEUE_SIZE, slow_consumer_policy=POLICY_DROP_OLDEST,
+                 roster_debounce=ROSTER_DEBOUNCE, worker_index=0, cluster_size=1, bus=None, reuse_port=False,
+                 framings=SUPPORTED_FRAMINGS, templates=None, log=None, admin_port=None, resume_secret=None,
+                 heartbeat_interval=HEARTBEAT_INTERVAL, heartbeat_timeout=HEARTBEAT_TIMEOUT,
+                 keepalive_idle=KEEPALIVE_IDLE, write_batch=MAX_WRITE_BATCH, tcp_nodelay=True, tcp_cork=False,
+                 backlog=LISTEN_BACKLOG, max_clients=0, max_per_ip=0, rate_limits=RATE_LIMITS,
+                 rate_limit_policy=RATE_POLICY_THROTTLE, media=None, media_port=MEDIA_PORT):
+        self.clients = ClientRegistry()  # ClientRecord per connected client, indexed by ID/username/address
         self.client_counter = 0
         self.server_socket = None
+        self.port = port
+        
+        # Accept path: a backlog deep enough for a whole office reconnecting
+        # at once, and admission limits (0: none) checked before a
+        # connection costs anything more than the accept
+        self.backlog = backlog
+        self.max_clients = max_clients
+        self.max_per_ip = max_per_ip
+        self.queue_size = queue_size
+        self.slow_consumer_policy = slow_consumer_policy
+        
+        # Inbound limits (ratelimit.py): kind -> (rate, burst) token buckets
+        # per client, empty for none. Over the limit, messages are held back
+        # (throttle) or dropped.
+        self.rate_limits = rate_limits
+        self.rate_limit_policy = rate_limit_policy
+        self.framings = framings  # Offered in HELLO and accepted by us, e.g. binary and ndjson
+        
+        # Send path (outbound.py): up to write_batch queued messages go out
+        # in one sendmsg(); 1 means a send per message. tcp_cork only
+        # matters to the threaded writers, asyncio buffers on its own.
+        self.write_batch = write_batch
+        self.tcp_nodelay = tcp_nodelay
+        self.tcp_cork = tcp_cork
+        self.templates = templates or TemplateRegistry()  # Alerts clients can send by ID
         
+        # Durable alert log (alertlog.py), None to keep nothing. Clients that
+        # send an identity get what they missed replayed when they come back;
+        # departed maps recently disconnected client IDs to their identity so
+        # alerts targeted at them are kept for later.
+        self.log = log
+        self.departed = OrderedDict()
+        
+        # Scale-out (see cluster.py): bus(worker_index, deliver) connects to
+        # the other workers; None runs standalone. remote_clients holds the
+        # roster entries of clients connected to other workers.
+        self.worker_index = worker_index
+        self.cluster_size = cluster_size
+        self.bus_factory = bus
+        self.bus = None
+        self.reuse_port = reuse_port
+        self.remote_clients = {}
+        
+        # Roster versioning: changes collect in roster_changes (one entry per
+        # client ID) until the debounce timer sends them as a single delta
+        self.roster_debounce = roster_debounce
+        self.roster_version = 0
+        self.roster_changes = {}
+        self.roster_flush_pending = False
+        self.roster_lock = threading.Lock()
+        # Identifies this process's roster versions, which restart at 0
+        self.roster_epoch = secrets.token_hex(4)
+        
+        # Signed resume tokens (sessions.py); a random secret only survives
+        # until the process exits
+        self.resume_tokens = ResumeTokens(resume_secret or load_secret())
+        
+        # Heartbeats (heartbeat.py): clients that negotiate them sit in a
+        # timer wheel and are reaped when they stop answering. An interval
+        # of 0 leaves dead connections to TCP keepalive alone.
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.keepalive_idle = keepalive_idle
+        self.wheel = None
+        if heartbeat_interval:
+            self.wheel = TimerWheel(HEARTBEAT_TICK, max(heartbeat_interval, heartbeat_timeout), time.monotonic())
+        
+        # Content-addressed alert media (media.py), None for none: alerts
+        # carry a hash and clients fetch the file from media_port. In a
+        # cluster the workers share the directory and worker 0 serves it.
+        self.media = media
+        self.media_port = media_port
+        self.media_server = None
+        
+        # Counters, latency histograms and gauges (metrics.py), served as
+        # JSON on localhost:admin_port when one is given
+        self.metrics = Metrics()
+        self.admin_port = admin_port
+        self.admin = None
+        self.register_gauges()
+        
+    def register_gauges(self):
+        gauge = self.metrics.gauge
+        gauge('clients', lambda: len(self.clients))
+        gauge('remote_clients', lambda: len(self.remote_clients))
+        gauge('outbound_queued', lambda: sum(len(client.queue) for client in self.clients))
+        gauge('outbound_queue_max', lambda: max((len(client.queue) for client in self.clients), default=0))
+        gauge('queue_dropped_connected', lambda: sum(client.queue.dropped for client in self.clients))
+        gauge('topics', self.clients.topic_count)
+        if self.rate_limits:
+            gauge('rate_limited_clients', self.rate_limited_clients)
+        if self.wheel is not None:
+            gauge('heartbeat_tracked', lambda: len(self.wheel))
+        gauge('cpu_seconds', lambda: round(time.process_time(), 2))
+        gauge('max_rss_kb', lambda: resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        if self.log:
+            gauge('alert_log', self.log.stats)
+        if self.media:
+            gauge('media_store', self.media.stats)
+    
+    def rate_limited_clients(self):
+        # The connected clients hit hardest by rate limits: [[id, username, limited messages]]
+        limited = [client for client in self.clients if client.limits is not None and client.limits.limited]
+        top = heapq.nlargest(5, limited, key=lambda client: client.limits.limited)
+        return [[client.client_id, client.username, client.limits.limited] for client in top]
+    
+    def start_admin(self):
+        if self.admin_port is None:
+            return
+        self.admin = AdminServer(self.metrics.snapshot, self.admin_port)
+        self.admin.start()
+        logger.info(f"Metrics on http://127.0.0.1:{self.admin_port}/metrics")
+    
+    def start_media(self):
+        if self.media is None or self.worker_index != 0:
+            return
+        self.media_server = MediaServer(self.media, self.media_port, incr=self.metrics.incr)
+        self.media_server.start()
+        logger.info(f"Media store on port {self.media_port}")
+    
     def start_server(self):
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server_socket.bind(('', PORT))
-        self.server_socket.listen(5)  # Allow up to 5 pending connections
+        if self.reuse_port:
+            # Workers share the port; the kernel spreads connections over them
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.server_socket.bind(('', self.port))
+        self.server_socket.listen(self.backlog)
+        self.server_socket.setblocking(False)  # Drained until empty on each wakeup
+        self.connect_bus()
+        self.start_admin()
+        self.start_media()
+        self.start_heartbeats()
         
-        print(f"[{self.get_timestamp()}] Server started on port {PORT}")
-        print(f"[{self.get_timestamp()}] Waiting for clients to connect...")
+        logger.info(f"Server started on port {self.port}")
+        self.log_backlog()
+        logger.info("Waiting for clients to connect...")
         
+        selector = selectors.DefaultSelector()
+        selector.register(self.server_socket, selectors.EVENT_READ)
         try:
             while True:
-                client_socket, client_address = self.server_socket.accept()
-                self.client_counter += 1
-                client_id = self.client_counter
-                
-                # Store client info
-                self.clients[client_id] = {
-                    'socket': client_socket,
-                    'address': client_address,
-                    'username': f"Client_{client_id}"
-                }
-                
-                print(f"[{self.get_timestamp()}] New client connected: {client_address} (ID: {client_id})")
-                print(f"[{self.get_timestamp()}] Total clients: {len(self.clients)}")
-                
-                # Start a thread to handle this client
-                client_thread = threading.Thread(
-                    target=self.handle_client, 
-                    args=(client_id,),
-                    daemon=True
-                )
-                client_thread.start()
-                
-                # Send welcome message and client list
-                self.send_client_list_update()
+                selector.select()
+                for client_socket, client_address in self.accept_pending():
+                    self.start_client(client_socket, client_address)
                 
         except KeyboardInterrupt:
-            print(f"\n[{self.get_timestamp()}] Server shutting down...")
+            logger.info("Server shutting down...")
             self.shutdown()
         except Exception as e:
-            print(f"[{self.get_timestamp()}] Server error: {e}")
+            logger.error(f"Server error: {e}")
             self.shutdown()
     
+    def log_backlog(self):
+        # listen() silently caps the backlog at the kernel's limit
+        try:
+            with open('/proc/sys/net/core/somaxconn') as f:
+                somaxconn = int(f.read())
+        except (OSError, ValueError):
+            return
+        if somaxconn < self.backlog:
+            logger.warning(f"Listen backlog {self.backlog} is capped at net.core.somaxconn = {somaxconn}")
+    
+    def accept_pending(self):
+        # Everything waiting in the backlog (up to ACCEPT_BATCH) in one go,
+        # so a connection storm empties the queue before it can overflow
+        accepted = []
+        while len(accepted) < ACCEPT_BATCH:
+            try:
+                accepted.append(self.server_socket.accept())
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                # Out of file descriptors, most likely: back off rather than spin
+                logger.error(f"Accept failed: {e}")
+                time.sleep(0.1)
+                break
+        return accepted
+    
+    def start_client(self, client_socket, client_address):
+        reason = self.admission(client_address)
+        if reason:
+            self.reject(client_socket, client_address, reason)
+            return
+        set_keepalive(client_socket, self.keepalive_idle)
+        set_nodelay(client_socket, self.tcp_nodelay)
+        client_id = self.register_client(client_socket, client_address)
+        
+        # Start a thread to handle this client, and one to write to it
+        client_thread = threading.Thread(
+            target=self.handle_client, 
+            args=(client_id,),
+            daemon=True
+        )
+        client_thread.start()
+        writer_thread = threading.Thread(
+            target=self.write_client,
+            args=(client_id,),
+            daemon=True
+        )
+        writer_thread.start()
+    
+    def admission(self, client_address):
+        # None to let the connection in, or why not
+        if self.max_clients and len(self.clients) >= self.max_clients:
+            return 'server full'
+        if self.max_per_ip and self.clients.host_count(client_address[0]) >= self.max_per_ip:
+            return 'too many connections from this address'
+        return None
+    
+    def reject(self, client_socket, client_address, reason):
+        # Best effort: tell the client why, then hang up. Clients back off
+        # and retry like after any other lost connection.
+        self.metrics.incr('connections_rejected')
+        logger.info(f"Rejected connection from {client_address}: {reason}")
+        try:
+            client_socket.send(encode_message({'type': 'CONNECTION_REJECTED', 'reason': reason}, FRAMING_NDJSON))
+        except OSError:
+            pass
+        client_socket.close()
+    
+    def register_client(self, client_socket, client_address, on_ready=None):
+        # client_socket only needs shutdown() and close(), so the asyncio mode
+        # can register its transport adapter here as well. on_ready is passed
+        # to the outbound queue for modes that drain it from an event loop.
+        start = time.perf_counter()
+        self.client_counter += 1
+        # Unique across workers, and id % cluster_size tells who owns it
+        client_id = self.client_counter * self.cluster_size + self.worker_index
+        
+        # Store client info
+        client = ClientRecord(
+            client_id, client_socket, client_address, f"Client_{client_id}",
+            MessageDecoder(), OutboundQueue(self.queue_size, self.slow_consumer_policy, on_ready)
+        )
+        client.last_seen = time.monotonic()
+        if self.rate_limits:
+            client.limits = ClientLimits(self.rate_limits)
+        self.clients.add(client)
+        if self.log:
+            # Read after add(): an alert logged in between reaches the client
+            # both live and by replay, rather than neither
+            client.connected_seq = self.log.last_seq
+        
+        logger.info(f"New client connected: {client_address} (ID: {client_id}), {len(self.clients)} total")
+        self.roster_changed('CLIENT_JOINED', client)
+        self.metrics.incr('connections_accepted')
+        self.metrics.observe('accept', time.perf_counter() - start)
+        return client_id
+    
     def handle_client(self, client_id):
-        client_info = self.clients[client_id]
-        client_socket = client_info['socket']
-        client_address = client_info['address']
+        client = self.clients.get(client_id)
+        if not client:
+            return
+        client_socket = client.socket
+        client_address = client.address
         
         try:
             while True:
-                data = client_socket.recv(1024).decode('utf-8')
+                data = client_socket.recv(RECV_SIZE)
                 if not data:
                     break
                 
-                print(f"[{self.get_timestamp()}] Received from {client_address} (ID: {client_id}): {data}")
-                
-                # Parse the message
-                try:
-                    message_data = json.loads(data)
-                    self.process_message(client_id, message_data)
-                except json.JSONDecodeError:
-                    # Handle legacy string messages (STOP, COLD, etc.)
-                    self.process_legacy_message(client_id, data)
+                delay = self.handle_data(client_id, data)
+                while delay:
+                    # A message is held, and the socket isn't read until it
+                    # has gone through
+                    if delay == DRAIN:
+                        client.queue.wait_drained()  # Woken by disconnect_client too
+                    else:
+                        time.sleep(delay)  # Throttled
+                    delay = self.resume_data(client_id)
                     
         except ConnectionResetError:
-            print(f"[{self.get_timestamp()}] Client {client_address} (ID: {client_id}) disconnected abruptly")
+            logger.info(f"Client {client_address} (ID: {client_id}) disconnected abruptly")
         except Exception as e:
-            print(f"[{self.get_timestamp()}] Error handling client {client_id}: {e}")
+            logger.warning(f"Error handling client {client_id}: {e}")
         finally:
             self.disconnect_client(client_id)
     
+    def write_client(self, client_id):
+        # Writer thread: drains the client's outbound queue so broadcasts
+        # never block on this client's socket. Whatever piled up since the
+        # last write goes out in one batch.
+        client = self.clients.get(client_id)
+        if not client:
+            return
+        client_socket = client.socket
+        queue = client.queue
+        
+        metrics = self.metrics
+        try:
+            while True:
+                batch = queue.get_batch(self.write_batch)
+                if batch is None:
+                    break
+                size = sum(len(payload) for payload in batch)
+                start = time.perf_counter()
+                calls = write_batch(client_socket, batch, self.tcp_cork)
+                metrics.observe('send', time.perf_counter() - start)
+                metrics.incr('send_calls', calls)
+                metrics.incr('messages_sent', len(batch))
+                metrics.incr('bytes_sent', size)
+        except Exception as e:
+            logger.warning(f"Failed to send to client {client_id}: {e}")
+            self.disconnect_client(client_id)
+    
+    def handle_data(self, client_id, data):
+        # Raw bytes off the socket; the decoder holds on to partial messages.
+        # Returns 0, or when a message is held back, the seconds its rate
+        # limit makes it wait or DRAIN; then resume_data() goes on with it
+        # and the client mustn't be read meanwhile.
+        client = self.clients.get(client_id)
+        if not client:
+            return 0
+        client.last_seen = time.monotonic()  # Any traffic answers a PING
+        self.metrics.incr('bytes_received', len(data))
+        # feed() is a generator (a HELLO can switch framing mid-chunk), so
+        # decoding is timed as the chunk's total minus handling its messages
+        start = time.perf_counter()
+        delay, handling = self.handle_messages(client, client.decoder.feed(data))
+        self.metrics.observe('decode', time.perf_counter() - start - handling)
+        return delay
+    
+    def resume_data(self, client_id):
+        # A held message's wait is over: handle it and the rest of its
+        # chunk. Same return as handle_data().
+        client = self.clients.get(client_id)
+        if not client or client.held is None:
+            return 0
+        message, messages, limited = client.held
+        client.held = None
+        delay = self.handle_message(client_id, message, limited)
+        if delay:
+            client.held = (message, messages, False)
+            return delay
+        return self.handle_messages(client, messages)[0]
+    
+    def handle_messages(self, client, messages):
+        # -> (what handle_data() returns, seconds spent handling)
+        client_id = client.client_id
+        handling = 0.0
+        for message in messages:
+            if client_id not in self.clients:
+                break
+            if client.queue.full():
+                # Read-side backpressure: a client that isn't reading what
+                # we send it gets nothing more handled until it catches up,
+                # rather than answers we'd only drop
+                client.held = (message, messages, True)
+                self.metrics.incr('read_backpressure')
+                return DRAIN, handling
+            handled = time.perf_counter()
+            delay = self.handle_message(client_id, message)
+            handling += time.perf_counter() - handled
+            if delay:
+                # Throttled; its token is spent already
+                client.held = (message, messages, False)
+                return delay, handling
+        return 0, handling
+    
+    def handle_message(self, client_id, data, limited=True):
+        # -> seconds to hold the message for its rate limit, 0 once handled
+        client = self.clients.get(client_id)
+        if not client:
+            return 0
+        client_address = client.address
+        logger.debug("Received from %s (ID: %s): %s", client_address, client_id, data)
+        
+        # Parse the message (binary frames arrive decoded already)
+        start = time.perf_counter()
+        try:
+            message_data = parse_message(data)
+        except json.JSONDecodeError:
+            message_data = None  # Legacy string message (STOP, COLD, etc.)
+        if message_data is not None and not isinstance(message_data, dict):
+            if not isinstance(data, str):
+                logger.warning(f"Client {client_id} sent a {type(message_data).__name__}, not a message")
+                return 0
+            message_data = None  # JSON but not an object, e.g. "42": taken as a legacy alert
+        if limited and client.limits is not None:
+            delay = self.check_rate(client, message_data.get('type') if message_data is not None else 'legacy')
+            if delay:
+                return delay
+            if delay is None:
+                self.metrics.incr('messages_received')
+                return 0
+        if message_data is None:
+            self.process_legacy_message(client_id, data)
+        else:
+            self.process_message(client_id, message_data)
+        self.metrics.incr('messages_received')
+        self.metrics.observe('process_message', time.perf_counter() - start)
+        return 0
+    
+    def check_rate(self, client, message_type):
+        # -> 0 to handle the message now, seconds to hold it for (throttle
+        # policy; the token is borrowed now), or None to drop it
+        limits = client.limits
+        throttle = self.rate_limit_policy == RATE_POLICY_THROTTLE
+        kind, wait = limits.take(message_type, time.monotonic(), borrow=throttle)
+        if not wait:
+            limits.over = False
+            return 0
+        limits.limited += 1
+        self.metrics.incr(f"rate_limited.{kind}")
+        if not limits.over:
+            # Once per stretch over the limit, not per message
+            limits.over = True
+            logger.warning(f"Client {client.client_id} ({client.username}) is over its {kind} rate limit, "
+                           f"{'throttling' if throttle else 'dropping'}")
+        if throttle:
+            self.metrics.observe('throttle', wait)
+            return wait
+        return None
+    
     def process_message(self, sender_id, message_data):
+        sender = self.clients.get(sender_id)
+        if not sender:
+            return
         message_type = message_data.get('type')
         target_id = message_data.get('target_id')
+        self.metrics.incr(f"received.{message_type if message_type in MESSAGE_TYPES else 'other'}")
         
-        if message_type == 'CUSTOM':
-            # Custom alert message
-            self.broadcast_alert(sender_id, message_data, target_id)
+        if message_type == 'HELLO':
+            # Framing negotiation. HELLO_ACK itself goes out as ndjson, since
+            # the client doesn't know the outcome yet; everything after it,
+            # both ways, uses the chosen framing.
+            framing = choose_framing(message_data.get('framing'), self.framings)
+            features = [feature for feature in message_data.get('features') or [] if feature in SUPPORTED_FEATURES
+                        and (feature != FEATURE_MEDIA or self.media is not None)]
+            sender.roster_deltas = FEATURE_ROSTER_DELTA in features
+            sender.templates = FEATURE_TEMPLATES in features
+            sender.resume = FEATURE_RESUME in features
+            sender.heartbeat = FEATURE_HEARTBEAT in features and self.wheel is not None
+            if FEATURE_TOPICS in features and message_data.get('topics'):
+                # Before replay_missed below, so it includes these topics
+                self.clients.subscribe(sender_id, topic_names(message_data['topics']))
+            identity = message_data.get('identity')
+            if self.log and isinstance(identity, str) and identity:
+                sender.identity = identity[:64]
+            session = self.resume_tokens.verify(message_data.get('resume')) if sender.resume else None
+            if session:
+                # Reconnect: same name as before, no SET_USERNAME needed
+                if session['u']:
+                    self.clients.rename(sender_id, session['u'])
+                    self.roster_changed('CLIENT_RENAMED', sender)
+                logger.info(f"Client {sender_id} resumed session as: {sender.username}")
+                self.metrics.incr('sessions_resumed')
+            ack = {
+                'type': 'HELLO_ACK',
+                'framing': framing,
+                'client_id': sender_id,  # Lets the client leave itself out of roster deltas
+                'features': features
+            }
+            if sender.resume:
+                ack['resumed'] = bool(session)
+                ack['username'] = sender.username
+                ack['resume_token'] = self.resume_token(sender)
+            if sender.heartbeat:
+                # The client pings us on the same schedule when we go quiet
+                ack['heartbeat_interval'] = self.heartbeat_interval
+                ack['heartbeat_timeout'] = self.heartbeat_timeout
+                self.wheel.schedule(sender_id, self.heartbeat_interval)
+            if FEATURE_MEDIA in features:
+                ack['media_port'] = self.media_port
+            ack = encode_message(ack, FRAMING_NDJSON)
+            if framing:
+                sender.framing = framing
+                sender.decoder.set_framing(framing)
+                if not sender.queue.set_framing(framing, ack):
+                    self.disconnect_client(sender_id)
+            else:
+                self.enqueue(sender_id, ack)
+            if session and not (session['e'] == self.roster_epoch
+                                and message_data.get('roster_version') == self.roster_version):
+                # The client's roster is from another process or has gaps:
+                # send the full list now instead of waiting for a request
+                self.send_client_list(sender_id)
+            if sender.identity:
+                self.replay_missed(sender)
+        elif message_type == 'CUSTOM':
+            # Custom alert message. A media hash only goes out if the file
+            # is there to fetch; gif_url stays for clients without the feature.
+            if 'media' in message_data and not (self.media and self.media.has(message_data['media'])):
+                del message_data['media']
+            self.broadcast_alert(sender_id, message_data, target_id, targets=message_data.get('targets'))
+        elif message_type == 'TEMPLATE_ALERT':
+            # Alert by template ID plus params
+            self.broadcast_template(sender_id, message_data, target_id, message_data.get('targets'))
+        elif message_type == 'TEMPLATE_SYNC':
+            # The client's cached copy is current unless the version changed
+            if message_data.get('version') == self.templates.version:
+                self.send_to_client(sender_id, {'type': 'TEMPLATE_LIST', 'version': self.templates.version,
+                                                'unchanged': True})
+            else:
+                self.send_to_client(sender_id, self.templates.listing())
         elif message_type == 'CLIENT_LIST_REQUEST':
             # Send client list to requesting client
             self.send_client_list(sender_id)
         elif message_type == 'SET_USERNAME':
             # Update client username
             new_username = message_data.get('username', f"Client_{sender_id}")
-            self.clients[sender_id]['username'] = new_username
-            print(f"[{self.get_timestamp()}] Client {sender_id} changed username to: {new_username}")
-            self.send_client_list_update()
+            if not isinstance(new_username, str):
+                logger.warning(f"Client {sender_id} sent a username that isn't a string")
+                return
+            new_username = new_username[:MAX_USERNAME_LENGTH]
+            self.clients.rename(sender_id, new_username)
+            if sender.resume:
+                self.send_to_client(sender_id, {'type': 'RESUME_TOKEN', 'resume_token': self.resume_token(sender)})
+            logger.info(f"Client {sender_id} changed username to: {new_username}")
+            self.roster_changed('CLIENT_RENAMED', sender)
+        elif message_type in ('SUBSCRIBE', 'UNSUBSCRIBE'):
+            topics = topic_names(message_data.get('topics'))
+            if message_type == 'SUBSCRIBE':
+                subscribed = self.clients.subscribe(sender_id, topics)
+            else:
+                subscribed = self.clients.unsubscribe(sender_id, topics)
+            if subscribed is not None:
+                self.send_to_client(sender_id, {'type': 'SUBSCRIPTIONS', 'topics': sorted(subscribed)})
+                logger.debug("Client %s now subscribed to %s", sender_id, sorted(subscribed))
+        elif message_type == 'PING':
+            self.send_to_client(sender_id, {'type': 'PONG'})
+        elif message_type == 'PONG':
+            pass  # handle_data already noted the client is alive
         else:
-            print(f"[{self.get_timestamp()}] Unknown message type: {message_type}")
+            logger.warning(f"Unknown message type: {message_type}")
+    
+    def resume_token(self, client):
+        # Default names aren't carried over; the next connection has its own
+        username = client.username if client.username != f"Client_{client.client_id}" else None
+        return self.resume_tokens.issue(username, self.roster_epoch)
     
     def process_legacy_message(self, sender_id, alert_type):
         # Handle legacy string alerts (STOP, COLD, ALERT1, etc.)
+        sender = self.clients.get(sender_id)
+        if not sender:
+            return
+        self.metrics.incr('received.legacy')
         message_data = {
             'type': 'LEGACY_ALERT',
             'alert_type': alert_type,
             'sender_id': sender_id,
-            'sender_username': self.clients[sender_id]['username']
+            'sender_username': sender.username
         }
         self.broadcast_alert(sender_id, message_data)
     
-    def broadcast_alert(self, sender_id, message_data, target_id=None):
-        sender_username = self.clients[sender_id]['username']
-        message_data['sender_id'] = sender_id
-        message_data['sender_username'] = sender_username
+    def broadcast_template(self, sender_id, message_data, target_id=None, targets=None):
+        template_id = message_data.get('template')
+        try:
+            params = self.templates.validate(template_id, message_data.get('params'))
+        except TemplateError as e:
+            logger.warning(f"Rejected template alert from client {sender_id}: {e}")
+            return
+        alert = {'type': 'TEMPLATE_ALERT', 'template': template_id}
+        if params:
+            alert['params'] = params
+        # What clients without the templates feature get instead: built-in
+        # alerts they know as LEGACY_ALERT, anything else rendered
+        if not params and self.templates.is_builtin(template_id):
+            fallback = {'type': 'LEGACY_ALERT', 'alert_type': template_id}
+        else:
+            fallback = {'type': 'CUSTOM'}
+            fallback.update(self.templates.render(template_id, params))
+        self.broadcast_alert(sender_id, alert, target_id, fallback, targets)
+    
+    def broadcast_alert(self, sender_id, message_data, target_id=None, fallback=None, targets=None):
+        # fallback: the same alert for clients that didn't negotiate templates
+        sender = self.clients.get(sender_id)
+        if not sender:
+            return
+        sender_username = sender.username
+        for data in (message_data, fallback):
+            if data is not None:
+                data['sender_id'] = sender_id
+                data['sender_username'] = sender_username
+                # Routing is ours; recipients don't need to see who else got it
+                data.pop('target_id', None)
+                data.pop('targets', None)
+        
+        if targets is not None:
+            self.multicast_alert(sender, message_data, targets, fallback)
+            return
+        if target_id:
+            self.metrics.incr('alerts_targeted')
+        else:
+            self.metrics.incr('alerts_broadcast')
         
         if target_id and target_id in self.clients:
             # Send to specific client
-            self.send_to_client(target_id, message_data)
-            print(f"[{self.get_timestamp()}] Alert sent from {sender_username} to Client {target_id}")
+            self.log_alert(message_data, fallback, sender.identity, self.clients.get(target_id))
+            self.send_alert_to(target_id, message_data, fallback)
+            logger.debug("Alert sent from %s to Client %s", sender_username, target_id)
+        elif target_id and target_id in self.remote_clients:
+            # Connected to another worker: relay to its owner only
+            self.bus.publish({'kind': 'alert', 'message': message_data, 'fallback': fallback,
+                              'target_id': target_id, 'sender_identity': sender.identity},
+                             self.owner_of(target_id))
+            logger.debug("Alert sent from %s to Client %s via worker %s",
+                         sender_username, target_id, self.owner_of(target_id))
+        elif target_id and self.log and target_id in self.departed:
+            # Gone for now: keep it for when that client comes back
+            self.log.append(self.log_record(message_data, fallback, sender.identity, self.departed[target_id]))
+            logger.debug("Alert from %s to Client %s kept for offline delivery", sender_username, target_id)
         else:
-            # Broadcast to all other clients
-            recipients = 0
-            for client_id, client_info in self.clients.items():
-                if client_id != sender_id:  # Don't send back to sender
-                    if self.send_to_client(client_id, message_data):
-                        recipients += 1
-            
-            print(f"[{self.get_timestamp()}] Alert from {sender_username} broadcasted to {recipients} clients")
+            if self.bus:
+                self.bus.publish({'kind': 'alert', 'message': message_data, 'fallback': fallback,
+                                  'sender_identity': sender.identity})
+            self.log_alert(message_data, fallback, sender.identity)
+            recipients = self.fan_out(message_data, sender_id, fallback)
+            logger.debug("Alert from %s broadcasted to %s clients", sender_username, recipients)
     
-    def send_to_client(self, client_id, data):
-        try:
-            client_socket = self.clients[client_id]['socket']
-            message = json.dumps(data)
-            client_socket.send(message.encode('utf-8'))
-            return True
-        except Exception as e:
-            print(f"[{self.get_timestamp()}] Failed to send to client {client_id}: {e}")
-            # Client might be disconnected, remove it
-            if client_id in self.clients:
-                self.disconnect_client(client_id)
+    def multicast_alert(self, sender, message_data, targets, fallback=None):
+        # One alert to a list of client IDs and topics. Other workers expand
+        # the topics and remote IDs for their own clients.
+        client_ids, topics = split_targets(targets)
+        self.metrics.incr('alerts_multicast')
+        remote = [client_id for client_id in client_ids
+                  if client_id not in self.clients and client_id in self.remote_clients]
+        if self.bus and (topics or remote):
+            self.bus.publish({'kind': 'alert', 'message': message_data, 'fallback': fallback,
+                              'targets': remote + topics, 'sender_identity': sender.identity})
+        recipients = self.deliver_multicast(message_data, fallback, client_ids, topics, sender.client_id,
+                                            sender.identity)
+        logger.debug("Alert from %s sent to %s clients of %s", sender.username, recipients, targets)
+    
+    def deliver_multicast(self, message_data, fallback, client_ids, topics, sender_id, sender_identity):
+        # Local recipients, each once however many targets it matches, and
+        # never the sender. Only the named topics' subscribers are visited.
+        recipients = {}
+        offline = []
+        for client_id in client_ids:
+            client = self.clients.get(client_id)
+            if client:
+                recipients[client_id] = client
+            elif self.log and client_id in self.departed:
+                offline.append(self.departed[client_id])
+        for topic in topics:
+            for client in self.clients.subscribers(topic):
+                recipients[client.client_id] = client
+        if self.log:
+            # Replayed to these identities, and to subscribers of the topics
+            to = offline + [recipients[client_id].identity for client_id in client_ids
+                            if client_id in recipients and recipients[client_id].identity]
+            if to or topics:
+                record = self.log_record(message_data, fallback, sender_identity, to)
+                record['topics'] = topics
+                self.log.append(record)
+        return self.fan_out(message_data, sender_id, fallback, recipients.values())
+    
+    def log_record(self, message_data, fallback, sender_identity, to_identity=None):
+        record = {'from': sender_identity, 'to': to_identity, 'message': message_data}
+        if fallback:
+            record['fallback'] = fallback
+        return record
+    
+    def log_alert(self, message_data, fallback, sender_identity, target=None):
+        # Broadcast when target is None; targeted alerts are only worth
+        # logging if the target can come back under the same identity
+        if not self.log:
+            return
+        if target is not None:
+            if not target.identity:
+                return
+            self.log.append(self.log_record(message_data, fallback, sender_identity, target.identity))
+        else:
+            self.log.append(self.log_record(message_data, fallback, sender_identity))
+    
+    def replay_missed(self, client):
+        # Alerts logged between this identity's last disconnect and this
+        # connection, read off the log's reader thread
+        cursor = self.log.cursor(client.identity)
+        if cursor is None or cursor >= client.connected_seq:
+            return
+        identity = client.identity
+        client_id = client.client_id
+        
+        def match(record):
+            to = record.get('to')
+            topics = record.get('topics')
+            if to is None and topics is None:
+                return record.get('from') != identity  # Not its own broadcasts
+            if to == identity or (isinstance(to, list) and identity in to):
+                return True
+            # Multicast to topics it's subscribed to now (from HELLO)
+            return bool(topics) and not client.topics.isdisjoint(topics) and record.get('from') != identity
+        
+        self.log.replay(cursor, client.connected_seq, match,
+                        lambda records: self.call_soon(self.deliver_replay, client_id, records))
+    
+    def deliver_replay(self, client_id, records):
+        client = self.clients.get(client_id)
+        if not client:
+            return
+        for _, record in records:
+            data = record['message'] if client.templates or not record.get('fallback') else record['fallback']
+            self.send_to_client(client_id, dict(data, replayed=True))
+        if records:
+            logger.info(f"Replayed {len(records)} missed alerts to client {client_id}")
+    
+    def alert_key(self, message_data):
+        # Repeats of the same alert from the same sender may be coalesced
+        # for slow consumers
+        what = message_data.get('alert_type') or message_data.get('message')
+        if what is None and 'template' in message_data:
+            what = (message_data['template'], tuple(sorted((message_data.get('params') or {}).items())))
+        return ('alert', message_data['sender_id'], what)
+    
+    def fan_out(self, message_data, sender_id=None, fallback=None, clients=None):
+        # Queue an alert for every local client (or those given) but the
+        # sender: encode once per framing (and per variant), queue the same bytes
+        start = time.perf_counter()
+        message = EncodedMessage(message_data)
+        rendered = EncodedMessage(fallback) if fallback else message
+        key = self.alert_key(message_data)
+        recipients = 0
+        for client in self.clients if clients is None else clients:
+            if client.client_id != sender_id:  # Don't send back to sender
+                if self.enqueue(client.client_id, message if client.templates else rendered, key):
+                    recipients += 1
+        self.metrics.observe('fan_out', time.perf_counter() - start)
+        self.metrics.incr('fan_out_recipients', recipients)
+        return recipients
+    
+    def send_alert_to(self, client_id, message_data, fallback=None):
+        client = self.clients.get(client_id)
+        if not client:
             return False
+        data = message_data if client.templates or not fallback else fallback
+        return self.send_to_client(client_id, data, self.alert_key(message_data))
+    
+    def send_to_client(self, client_id, data, key=None):
+        # Encoded in the client's framing once queued. ndjson is always
+        # newline-terminated: framed clients need it, and legacy clients'
+        # json.loads ignores the trailing whitespace
+        return self.enqueue(client_id, EncodedMessage(data), key)
+    
+    def enqueue(self, client_id, payload, key=None):
+        # Hand bytes or an EncodedMessage to the client's writer; never blocks
+        client = self.clients.get(client_id)
+        if not client:
+            return False
+        if client.queue.put(payload, key):
+            return True
+        logger.warning(f"Client {client_id} is not keeping up, disconnecting")
+        self.metrics.incr('slow_consumer_disconnects')
+        self.disconnect_client(client_id)
+        return False
     
     def send_client_list(self, client_id):
         client_list = []
-        for cid, info in self.clients.items():
-            if cid != client_id:  # Don't include requesting client
+        for client in self.clients:
+            if client.client_id != client_id:  # Don't include requesting client
                 client_list.append({
-                    'id': cid,
-                    'username': info['username'],
-                    'address': str(info['address'])
+                    'id': client.client_id,
+                    'username': client.username,
+                    'address': str(client.address)
                 })
+        with self.roster_lock:
+            client_list.extend(self.remote_clients.values())
         
         response = {
             'type': 'CLIENT_LIST_RESPONSE',
+            'version': self.roster_version,
             'clients': client_list
         }
-        self.send_to_client(client_id, response)
+        # Only the newest roster matters to a client that is behind
+        self.send_to_client(client_id, response, 'CLIENT_LIST_RESPONSE')
+    
+    def roster_changed(self, change_type, client):
+        # Record a CLIENT_JOINED/LEFT/RENAMED and make sure a flush is
+        # scheduled. Later changes to the same client replace earlier ones;
+        # the client side applies them idempotently.
+        if change_type == 'CLIENT_LEFT':
+            change = {'type': 'CLIENT_LEFT', 'id': client.client_id}
+        else:
+            change = {
+                'type': change_type,
+                'id': client.client_id,
+                'username': client.username,
+                'address': str(client.address)
+            }
+        self.queue_roster_change(change)
+    
+    def queue_roster_change(self, change):
+        # Local changes come from roster_changed, remote ones from the bus
+        client_id = change['id']
+        with self.roster_lock:
+            pending = self.roster_changes.get(client_id)
+            if change['type'] == 'CLIENT_RENAMED' and pending and pending['type'] == 'CLIENT_JOINED':
+                # Not announced yet: just join with the new name
+                pending['username'] = change['username']
+            else:
+                self.roster_changes[client_id] = change
+            
+            if self.roster_flush_pending:
+                return
+            self.roster_flush_pending = True
+        self.call_later(self.roster_debounce, self.send_client_list_update)
     
     def send_client_list_update(self):
-        # Send updated client list to all clients
-        for client_id in list(self.clients.keys()):
-            self.send_client_list(client_id)
+        # Debounced: everything that changed since the last flush goes out as
+        # one CLIENT_ROSTER_DELTA, encoded once for all clients. Full lists
+        # are only sent on CLIENT_LIST_REQUEST, and to legacy clients.
+        with self.roster_lock:
+            self.roster_flush_pending = False
+            if not self.roster_changes:
+                return
+            changes = list(self.roster_changes.values())
+            self.roster_changes = {}
+            base_version = self.roster_version
+            self.roster_version += 1
+        
+        if self.bus:
+            # Other workers only need to hear about our own clients
+            own = [change for change in changes if self.owner_of(change['id']) == self.worker_index]
+            if own:
+                self.bus.publish({'kind': 'roster', 'changes': own})
+        
+        delta = {
+            'type': 'CLIENT_ROSTER_DELTA',
+            'base_version': base_version,
+            'version': base_version + 1,
+            'changes': changes
+        }
+        message = EncodedMessage(delta)
+        for client in self.clients:
+            if client.roster_deltas:
+                self.enqueue(client.client_id, message)
+            else:
+                self.send_client_list(client.client_id)
+    
+    def start_heartbeats(self):
+        if self.wheel is not None:
+            self.call_later(HEARTBEAT_TICK, self.heartbeat_tick)
+    
+    def heartbeat_tick(self):
+        try:
+            now = time.monotonic()
+            for client_id in self.wheel.advance(now):
+                self.check_heartbeat(client_id, now)
+        finally:
+            self.call_later(HEARTBEAT_TICK, self.heartbeat_tick)
+    
+    def check_heartbeat(self, client_id, now):
+        # The client's slot came due: ping it, reap it, or (it talked in the
+        # meantime) put it back for the rest of its interval
+        client = self.clients.get(client_id)
+        if not client:
+            return
+        if client.ping_sent and client.last_seen < client.ping_sent:
+            remaining = client.ping_sent + self.heartbeat_timeout - now
+            if remaining > 0:
+                self.wheel.schedule(client_id, remaining)
+                return
+            logger.info(f"Client {client.address} (ID: {client_id}) stopped answering heartbeats, disconnecting")
+            self.metrics.incr('zombies_reaped')
+            self.disconnect_client(client_id)
+            return
+        client.ping_sent = 0.0
+        remaining = client.last_seen + self.heartbeat_interval - now
+        if remaining > 0:
+            self.wheel.schedule(client_id, remaining)
+            return
+        client.ping_sent = now
+        self.enqueue(client_id, PING)
+        self.metrics.incr('pings_sent')
+        self.wheel.schedule(client_id, self.heartbeat_timeout)
+    
+    def call_later(self, delay, callback):
+        timer = threading.Timer(delay, callback)
+        timer.daemon = True
+        timer.start()
+    
+    def call_soon(self, callback, *args):
+        # Run on the server's own thread(s); bus messages arrive on a bus thread
+        callback(*args)
+    
+    def owner_of(self, client_id):
+        return client_id % self.cluster_size
+    
+    def connect_bus(self):
+        if self.bus_factory is None:
+            return
+        self.bus = self.bus_factory(self.worker_index,
+                                    lambda message: self.call_soon(self.handle_bus_message, message))
+        # Ask the workers already running for their clients
+        self.bus.publish({'kind': 'roster_request', 'worker': self.worker_index})
+        logger.info(f"Worker {self.worker_index} of {self.cluster_size} joined the bus")
+    
+    def handle_bus_message(self, message):
+        kind = message.get('kind')
+        if kind == 'alert':
+            message_data = message['message']
+            fallback = message.get('fallback')
+            target_id = message.get('target_id')
+            if message.get('targets') is not None:
+                client_ids, topics = split_targets(message['targets'])
+                self.deliver_multicast(message_data, fallback, client_ids, topics, None,
+                                       message.get('sender_identity'))
+            elif target_id is not None:
+                target = self.clients.get(target_id)
+                if target:
+                    self.log_alert(message_data, fallback, message.get('sender_identity'), target)
+                self.send_alert_to(target_id, message_data, fallback)
+            else:
+                self.log_alert(message_data, fallback, message.get('sender_identity'))
+                self.fan_out(message_data, None, fallback)
+        elif kind == 'roster':
+            with self.roster_lock:
+                for change in message['changes']:
+                    if change['type'] == 'CLIENT_LEFT':
+                        self.remote_clients.pop(change['id'], None)
+                    else:
+                        self.remote_clients[change['id']] = {
+                            'id': change['id'], 'username': change['username'], 'address': change['address']
+                        }
+            for change in message['changes']:
+                self.queue_roster_change(dict(change))
+        elif kind == 'roster_request':
+            # A worker (re)started: tell it who is connected here
+            changes = [{'type': 'CLIENT_JOINED', 'id': client.client_id, 'username': client.username,
+                        'address': str(client.address)} for client in self.clients]
+            if changes:
+                self.bus.publish({'kind': 'roster', 'changes': changes}, message['worker'])
+        elif kind == 'worker_left':
+            # Its clients lost their connection along with it
+            worker = message['worker']
+            with self.roster_lock:
+                gone = [client_id for client_id in self.remote_clients if self.owner_of(client_id) == worker]
+                for client_id in gone:
+                    del self.remote_clients[client_id]
+            for client_id in gone:
+                self.queue_roster_change({'type': 'CLIENT_LEFT', 'id': client_id})
+            logger.info(f"Worker {worker} left, dropped {len(gone)} of its clients")
     
     def disconnect_client(self, client_id):
-        if client_id in self.clients:
-            client_info = self.clients[client_id]
+        # Only one of several racing callers (reader, writer, a broadcast
+        # giving up on a slow client) gets the record back and tears down
+        client = self.clients.remove(client_id)
+        if client:
+            client.queue.close()
+            if self.wheel is not None:
+                self.wheel.cancel(client_id)
             try:
-                client_info['socket'].close()
+                # Wakes up a writer thread blocked in sendall()
+                client.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            try:
+                client.socket.close()
             except:
                 pass
             
-            print(f"[{self.get_timestamp()}] Client {client_info['address']} (ID: {client_id}) disconnected")
-            del self.clients[client_id]
-            print(f"[{self.get_timestamp()}] Total clients: {len(self.clients)}")
+            self.metrics.incr('disconnects')
+            self.metrics.incr('queue_dropped', client.queue.dropped)
+            self.metrics.incr('queue_coalesced', client.queue.coalesced)
+            
+            if self.log and client.identity:
+                # Everything logged so far went out live; replay starts after it
+                self.log.set_cursor(client.identity, self.log.last_seq)
+                self.departed[client_id] = client.identity
+                if len(self.departed) > DEPARTED_IDENTITIES:
+                    self.departed.popitem(last=False)
+            
+            logger.info(f"Client {client.address} (ID: {client_id}) disconnected, {len(self.clients)} total")
             
             # Update client list for remaining clients
-            if self.clients:
-                self.send_client_list_update()
-    
-    def get_timestamp(self):
-        return datetime.now().strftime("%H:%M:%S")
+            self.roster_changed('CLIENT_LEFT', client)
     
     def shutdown(self):
-        print(f"[{self.get_timestamp()}] Closing all client connections...")
-        for client_id in list(self.clients.keys()):
-            self.disconnect_client(client_id)
+        logger.info("Closing all client connections...")
+        for client in self.clients:
+            self.disconnect_client(client.client_id)
         
         if self.server_socket:
             self.server_socket.close()
-        print(f"[{self.get_timestamp()}] Server shutdown complete")
+        if self.bus:
+            self.bus.close()
+        if self.log:
+            self.log.close()
+        if self.admin:
+            self.admin.close()
+        if self.media_server:
+            self.media_server.close()
+        logger.info("Server shutdown complete")
+
+
+class AsyncClientConnection(asyncio.Protocol):
+    # One of these per client instead of a thread. It also stands in for the
+    # client socket (shutdown/send/close), so process_message and friends are shared with
+    # the threaded server as-is.
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.client_id = None
+        self.queue = None
+        self.paused = False
+        self.flush_scheduled = False
+        # Reasons not to read: a message held for its rate limit, and the
+        # outbound queue full (read-side backpressure)
+        self.throttled = False
+        self.backpressure = False
+    
+    def connection_made(self, transport):
+        self.transport = transport
+        client_address = transport.get_extra_info('peername')
+        reason = self.server.admission(client_address)
+        if reason:
+            self.server.reject(self, client_address, reason)
+            return
+        # Keep the transport's own buffer small so a slow client backs up
+        # into its bounded outbound queue, where the slow consumer policy
+        # applies, instead of growing without limit
+        transport.set_write_buffer_limits(high=self.server.write_buffer_high)
+        set_keepalive(transport.get_extra_info('socket'), self.server.keepalive_idle)
+        set_nodelay(transport.get_extra_info('socket'), self.server.tcp_nodelay)
+        self.client_id = self.server.register_client(self, client_address, self.schedule_flush)
+        self.queue = self.server.clients.get(self.client_id).queue
+    
+    def data_received(self, data):
+        if self.client_id is None:
+            return  # Rejected
+        try:
+            delay = self.server.handle_data(self.client_id, data)
+        except FramingError as e:
+            logger.warning(f"Dropping client {self.client_id}: {e}")
+            self.server.disconnect_client(self.client_id)
+            return
+        except Exception as e:
+            logger.warning(f"Error handling client {self.client_id}: {e}")
+            return
+        self.hold(delay)
+    
+    def hold(self, delay):
+        # handle_data() held a message back: stop reading until it can go,
+        # after its rate limit's delay or once flush() has drained the queue
+        if delay == DRAIN:
+            self.backpressure = True
+        elif delay:
+            self.throttled = True
+            self.server.loop.call_later(delay, self.resume_data)
+        self.update_reading()
+    
+    def resume_data(self):
+        self.throttled = self.backpressure = False
+        try:
+            delay = self.server.resume_data(self.client_id)
+        except Exception as e:
+            logger.warning(f"Error handling client {self.client_id}: {e}")
+            delay = 0
+        self.hold(delay)
+    
+    def update_reading(self):
+        # Pause or resume reading, whichever the flags call for
+        reading = not (self.throttled or self.backpressure)
+        if reading != self.transport.is_reading():
+            if reading:
+                self.transport.resume_reading()
+            else:
+                self.transport.pause_reading()
+    
+    def connection_lost(self, exc):
+        if self.client_id is None:
+            return  # Rejected
+        if exc is not None:
+            logger.info(f"Client (ID: {self.client_id}) disconnected abruptly")
+        self.server.disconnect_client(self.client_id)
+    
+    def schedule_flush(self):
+        # The queue went non-empty: flush at the end of this loop iteration,
+        # so everything the current callback queues (a HELLO's ACK, roster,
+        # templates and replay; a burst of alerts) goes out in one write
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.server.loop.call_soon(self.flush)
+    
+    def flush(self):
+        # Runs on the loop thread after the outbound queue goes non-empty,
+        # and again once the transport drains. Messages only stay queued
+        # while the client is too slow to take them.
+        self.flush_scheduled = False
+        metrics = self.server.metrics
+        while not self.paused:
+            batch = self.queue.pop_batch(self.server.write_batch)
+            if not batch:
+                break
+            size = sum(len(payload) for payload in batch)
+            start = time.perf_counter()
+            if len(batch) == 1:
+                self.transport.write(batch[0])
+            else:
+                self.transport.writelines(batch)
+            metrics.observe('send', time.perf_counter() - start)
+            metrics.incr('send_calls')
+            metrics.incr('messages_sent', len(batch))
+            metrics.incr('bytes_sent', size)
+        if self.backpressure and self.queue.drained():
+            self.resume_data()
+    
+    def pause_writing(self):
+        self.paused = True
+    
+    def resume_writing(self):
+        self.paused = False
+        self.flush()
+    
+    def shutdown(self, how):
+        # Disconnecting: don't bother flushing what the client hasn't read
+        try:
+            self.transport.abort()
+        except RuntimeError:
+            pass  # Server shutdown after the loop closed; the socket goes with the process
+    
+    def send(self, data):
+        # For reject(): the only write that bypasses the outbound queue
+        self.transport.write(data)
+    
+    def close(self):
+        try:
+            self.transport.close()
+        except RuntimeError:
+            pass
+
+
+class AsyncAlertServer(AlertServer):
+    # Single-threaded event loop mode: holds thousands of idle connections
+    # without a thread (and its stack) per client
+    def __init__(self, port=PORT, write_buffer_high=64 * 1024, **kwargs):
+        super().__init__(port, **kwargs)
+        self.write_buffer_high = write_buffer_high
+        self.loop = None
+    
+    def start_server(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            logger.info("Server shutting down...")
+            self.shutdown()
+        except Exception as e:
+            logger.error(f"Server error: {e}")
+            self.shutdown()
+    
+    def call_later(self, delay, callback):
+        # Everything runs on the loop thread in this mode
+        if self.loop and not self.loop.is_closed():
+            self.loop.call_later(delay, callback)
+    
+    def call_soon(self, callback, *args):
+        if self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(callback, *args)
+    
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.server_socket = await self.loop.create_server(
+            lambda: AsyncClientConnection(self), '', self.port,
+            reuse_address=True, reuse_port=self.reuse_port or None, backlog=self.backlog
+        )
+        self.connect_bus()
+        self.start_admin()
+        self.start_media()
+        self.start_heartbeats()
+        
+        logger.info(f"Server started on port {self.port} (asyncio mode)")
+        self.log_backlog()
+        logger.info("Waiting for clients to connect...")
+        
+        async with self.server_socket:
+            await self.server_socket.serve_forever()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Alert App server")
+    parser.add_argument('--mode', choices=['threaded', 'async'], default='threaded',
+                        help="threaded: one thread per client; async: single asyncio event loop")
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE,
+                        help="max queued outbound messages per client")
+    parser.add_argument('--slow-policy', choices=SLOW_CONSUMER_POLICIES, default=POLICY_DROP_OLDEST,
+                        help="what to do when a client's outbound queue is full")
+    parser.add_argument('--roster-debounce', type=float, default=ROSTER_DEBOUNCE,
+                        help="seconds of connect/disconnect/rename churn batched per roster update")
+    parser.add_argument('--framings', nargs='+', choices=SUPPORTED_FRAMINGS, default=SUPPORTED_FRAMINGS,
+                        help="wire framings clients may negotiate (JSON clients always work)")
+    parser.add_argument('--templates', help="JSON file of alert templates (id -> message/bg/gif_url) "
+                                            "added to the built-in alerts")
+    parser.add_argument('--log-dir', help="keep a durable alert log here and replay missed alerts "
+                                          "to clients when they reconnect")
+    parser.add_argument('--log-retention-mb', type=int, default=LOG_RETENTION_BYTES // (1024 * 1024),
+                        help="alert log size kept on disk")
+    parser.add_argument('--media-dir', help="host alert GIFs here: senders upload once, alerts carry the "
+                                            "content hash and clients fetch from --media-port")
+    parser.add_argument('--media-port', type=int, default=MEDIA_PORT, help="HTTP port of the media store")
+    parser.add_argument('--media-retention-mb', type=int, default=MEDIA_RETENTION_BYTES // (1024 * 1024),
+                        help="media store size kept on disk")
+    parser.add_argument('--media-max-file-mb', type=int, default=MAX_MEDIA_BYTES // (1024 * 1024),
+                        help="largest upload accepted")
+    parser.add_argument('--admin-port', type=int,
+                        help="serve metrics as JSON on http://127.0.0.1:PORT/metrics (workers use PORT + index)")
+    parser.add_argument('--log-level', choices=['debug', 'info', 'warning', 'error'], default='info',
+                        help="debug logs every message and alert")
+    parser.add_argument('--log-rate', type=int, default=LOG_RATE, help="max log lines per second")
+    parser.add_argument('--resume-secret-file',
+                        help="key for signing resume tokens, created if missing; keeps sessions valid "
+                             "across restarts (default: a new key per run)")
+    parser.add_argument('--heartbeat-interval', type=float, default=HEARTBEAT_INTERVAL,
+                        help="ping clients quiet for this many seconds (0: rely on TCP keepalive only)")
+    parser.add_argument('--heartbeat-timeout', type=float, default=HEARTBEAT_TIMEOUT,
+                        help="disconnect clients that don't answer a ping within this many seconds")
+    parser.add_argument('--keepalive-idle', type=int, default=KEEPALIVE_IDLE,
+                        help="seconds of silence before TCP keepalive probes start")
+    parser.add_argument('--write-batch', type=int, default=MAX_WRITE_BATCH,
+                        help="max queued messages per client written in one syscall (1: one send per message)")
+    parser.add_argument('--tcp-nodelay', action=argparse.BooleanOptionalAction, default=True,
+                        help="disable Nagle's algorithm on client sockets (writes are batched already)")
+    parser.add_argument('--tcp-cork', action='store_true',
+                        help="cork client sockets while a batch is written (Linux, threaded mode)")
+    parser.add_argument('--backlog', type=int, default=LISTEN_BACKLOG,
+                        help="pending connections the kernel queues (a whole office reconnecting at once)")
+    parser.add_argument('--max-clients', type=int, default=0,
+                        help="refuse connections beyond this many clients per process (0: no limit)")
+    parser.add_argument('--max-per-ip', type=int, default=0,
+                        help="refuse connections beyond this many from one address (0: no limit; "
+                             "mind offices behind NAT)")
+    defaults = ', '.join(f"{kind}={rate:g}/{burst:g}" for kind, (rate, burst) in RATE_LIMITS.items())
+    parser.add_argument('--rate-limit', type=parse_rate_limit, action='append', default=[],
+                        metavar='KIND=RATE[/BURST]',
+                        help=f"per-client limit on alerts or a message type, messages/sec with bursts of BURST, "
+                             f"or KIND=off; repeat for each (defaults: {defaults})")
+    parser.add_argument('--rate-limit-policy', choices=RATE_POLICIES, default=RATE_POLICY_THROTTLE,
+                        help="throttle: make the client wait (no messages lost); drop: discard what's over")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="run this many worker processes sharing the port (SO_REUSEPORT) and a local bus")
+    parser.add_argument('--bus', help="join a cluster through the broker at this address "
+                                      "(unix:/path or tcp:host:port, see cluster.py)")
+    parser.add_argument('--worker-index', type=int, default=0, help="this worker's index in the cluster")
+    parser.add_argument('--cluster-size', type=int, default=1, help="number of workers in the cluster")
+    return parser.parse_args()
+
+
+def run_workers(args):
+    # Supervisor: a broker on a Unix socket plus one server process per
+    # worker, all listening on the same port
+    bus_address = f"unix:/tmp/alert-bus-{args.port}.sock"
+    broker = BusBroker(bus_address)
+    broker.start()
+    worker_args = sys.argv[1:]
+    # Workers share one resume token key, since a client may reconnect to any of them
+    env = dict(os.environ)
+    env.setdefault(SECRET_ENV, load_secret(args.resume_secret_file).hex())
+    workers = []
+    for index in range(args.workers):
+        cmd = [sys.executable, os.path.abspath(__file__), *worker_args, '--workers', '1',
+               '--bus', bus_address, '--worker-index', str(index), '--cluster-size', str(args.workers)]
+        workers.append(subprocess.Popen(cmd, env=env))
+    logger.info(f"Started {args.workers} workers on port {args.port}")
+    
+    # Stopping the supervisor stops the workers too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for worker in workers:
+            worker.wait()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.wait()
+        broker.close()
+
 
 if __name__ == "__main__":
-    server = AlertServer()
-    server.start_server()
\ No newline at end of file
+    args = parse_args()
+    async_log = AsyncLog(level=getattr(logging, args.log_level.upper()), rate=args.log_rate)
+    if args.workers > 1:
+        run_workers(args)
+        async_log.close()
+        sys.exit(0)
+    options = {'port': args.port, 'queue_size': args.queue_size, 'slow_consumer_policy': args.slow_policy,
+               'roster_debounce': args.roster_debounce, 'framings': args.framings,
+               'heartbeat_interval': args.heartbeat_interval, 'heartbeat_timeout': args.heartbeat_timeout,
+               'keepalive_idle': args.keepalive_idle, 'write_batch': args.write_batch,
+               'tcp_nodelay': args.tcp_nodelay, 'tcp_cork': args.tcp_cork, 'backlog': args.backlog,
+               'max_clients': args.max_clients, 'max_per_ip': args.max_per_ip,
+               'rate_limit_policy': args.rate_limit_policy}
+    rate_limits = dict(RATE_LIMITS)
+    for kind, limit in args.rate_limit:
+        if limit is None:
+            rate_limits.pop(kind, None)
+        else:
+            rate_limits[kind] = limit
+    options['rate_limits'] = rate_limits
+    if args.admin_port is not None:
+        options['admin_port'] = args.admin_port + args.worker_index
+    options['resume_secret'] = load_secret(args.resume_secret_file)
+    if args.templates:
+        options['templates'] = TemplateRegistry.load(args.templates)
+    if args.log_dir:
+        # One log per worker; sequence numbers and cursors are per log
+        log_dir = os.path.join(args.log_dir, f"worker{args.worker_index}") if args.bus else args.log_dir
+        options['log'] = AlertLog(log_dir, retention_bytes=args.log_retention_mb * 1024 * 1024)
+    if args.media_dir:
+        # Shared by the workers of a cluster; content-addressed, so they never disagree
+        options['media'] = MediaStore(args.media_dir, retention_bytes=args.media_retention_mb * 1024 * 1024,
+                                      max_file_bytes=args.media_max_file_mb * 1024 * 1024)
+        options['media_port'] = args.media_port
+    if args.bus:
+        options.update(worker_index=args.worker_index, cluster_size=args.cluster_size,
+                       bus=functools.partial(SocketBus, args.bus), reuse_port=True)
+    
+    def interrupt(signum, frame):
+        raise KeyboardInterrupt
+    # Stopped by a supervisor (or kill): shut down like Ctrl+C, so the alert
+    # log gets to save its cursors
+    signal.signal(signal.SIGTERM, interrupt)
+    if args.mode == 'async':
+        server = AsyncAlertServer(**options)
+    else:
+        server = AlertServer(**options)
+    server.metrics.gauge('log_lines_suppressed', lambda: async_log.suppressed)
+    server.start_server()
+    async_log.close()
\ No newline at end of file
@@ -0,0 +1,77 @@
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+# Server logging that stays off the hot path:
+#   - level-filtered, so per-message lines (DEBUG) cost one comparison when
+#     they're off
+#   - rate-limited: a token bucket lets through `rate` lines per second with
+#     bursts of `burst`; the rest are counted and the count is prepended to
+#     the next line that gets through. ERROR and above always pass.
+#   - asynchronous: records go onto a queue and a listener thread does the
+#     formatting and the (possibly slow, blocking) write to stdout
+# Lines keep the "[HH:MM:SS] message" look of the old prints.
+
+LOGGER_NAME = 'alert_server'
+LOG_RATE = 200   # Lines per second
+LOG_BURST = 1000
+
+logger = logging.getLogger(LOGGER_NAME)
+
+
+class RateLimitFilter(logging.Filter):
+    def __init__(self, rate=LOG_RATE, burst=LOG_BURST):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.pending = 0     # Suppressed since the last line let through
+        self.suppressed = 0  # Total, for metrics
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                self.pending += 1
+                self.suppressed += 1
+                return False
+            self.tokens -= 1
+            pending, self.pending = self.pending, 0
+        if pending:
+            record.msg = f"({pending} log lines suppressed) {record.msg}"
+        return True
+
+
+class AsyncLog:
+    # Wires the 'alert_server' logger to a queue drained by a listener thread
+    def __init__(self, level=logging.INFO, rate=LOG_RATE, burst=LOG_BURST, stream=None):
+        self.queue = queue.SimpleQueue()
+        self.rate_limit = RateLimitFilter(rate, burst)
+        self.handler = logging.handlers.QueueHandler(self.queue)
+        self.handler.addFilter(self.rate_limit)
+        output = logging.StreamHandler(stream or sys.stdout)
+        output.setFormatter(logging.Formatter('[%(asctime)s] %(message)s', '%H:%M:%S'))
+        self.listener = logging.handlers.QueueListener(self.queue, output)
+
+        logger.setLevel(level)
+        logger.addHandler(self.handler)
+        logger.propagate = False
+        self.listener.start()
+
+    @property
+    def suppressed(self):
+        return self.rate_limit.suppressed
+
+    def close(self):
+        # Flushes whatever is still queued
+        self.listener.stop()
+        logger.removeHandler(self.handler)
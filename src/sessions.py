@@ -0,0 +1,83 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+
+# Resume tokens. With the 'resume' feature the server hands each client a
+# token in HELLO_ACK (and a fresh one after every rename); a client that
+# reconnects sends it back in HELLO and gets its username back, plus the
+# roster only if its copy is out of date, without SET_USERNAME and
+# CLIENT_LIST_REQUEST round trips.
+#
+# Tokens are signed, not stored: {username, roster epoch, issue time} plus an
+# HMAC, so any worker with the same secret can verify them and they survive
+# a server restart when the secret does (--resume-secret-file). With a
+# random per-process secret a restart just means a normal reconnect.
+
+RESUME_MAX_AGE = 7 * 24 * 3600  # Seconds a token stays valid
+SECRET_BYTES = 32
+SECRET_ENV = 'ALERT_RESUME_SECRET'  # Hex secret shared by the workers of a cluster
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def load_secret(path=None):
+    # From the environment (cluster workers), a file kept across restarts
+    # (created on first use), or random for this process only
+    if os.environ.get(SECRET_ENV):
+        return bytes.fromhex(os.environ[SECRET_ENV])
+    if path:
+        try:
+            with open(path, 'rb') as f:
+                secret = f.read()
+            if len(secret) >= SECRET_BYTES:
+                return secret
+        except OSError:
+            pass
+        secret = os.urandom(SECRET_BYTES)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(secret)
+        return secret
+    return os.urandom(SECRET_BYTES)
+
+
+class ResumeTokens:
+    def __init__(self, secret, max_age=RESUME_MAX_AGE):
+        self.secret = secret
+        self.max_age = max_age
+
+    def issue(self, username, epoch):
+        payload = json.dumps({'u': username, 'e': epoch, 't': int(time.time())},
+                             separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        signature = hmac.new(self.secret, payload, hashlib.sha256).digest()[:16]
+        return f"{_b64encode(payload)}.{_b64encode(signature)}"
+
+    def verify(self, token):
+        # -> {'u': username, 'e': epoch, 't': issued} or None
+        if not isinstance(token, str) or len(token) > 1024:
+            return None
+        try:
+            payload_text, _, signature_text = token.partition('.')
+            payload = _b64decode(payload_text)
+            signature = _b64decode(signature_text)
+        except ValueError:
+            return None
+        expected = hmac.new(self.secret, payload, hashlib.sha256).digest()[:16]
+        if not hmac.compare_digest(signature, expected):
+            return None
+        try:
+            session = json.loads(payload)
+        except ValueError:
+            return None
+        if time.time() - session.get('t', 0) > self.max_age:
+            return None
+        return session
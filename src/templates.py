@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+import string
+
+# Alert templates. The server hosts a registry of named alerts (message,
+# background colour, GIF) that clients sync once and cache on disk by
+# version; after that an alert on the wire is only
+#   {'type': 'TEMPLATE_ALERT', 'template': 'COLD', 'params': {...}}
+# Messages may contain {placeholders} filled from params. Clients that
+# didn't ask for the 'templates' feature get unchanged built-in alerts as
+# LEGACY_ALERT and everything else rendered, as CUSTOM.
+
+# The alerts the app always had; the server starts from these and a
+# --templates file can add to or override them
+BUILTIN_ALERTS = {
+    'STOP': {
+        'message': "Stop Scrolling! 😊",
+        'bg': "#ff4500",
+        'gif_url': 'https://media1.tenor.com/m/DafLbvYgt50AAAAC/trump-donald-trump.gif'
+    },
+    'COLD': {
+        'message': "Turning off the AC, it's freezing! ❄️🥶❄️",
+        'bg': "#1e90ff",
+        'gif_url': 'https://media1.tenor.com/m/ShXWuFDDZ8wAAAAd/vtactor007-rwmartin.gif'
+    },
+    'ALERT1': {
+        'message': "Working hard!",
+        'bg': "#00ff00",
+        'gif_url': 'https://media1.tenor.com/m/yHhqdtTladoAAAAC/cat-typing-typing.gif'
+    },
+    'ALERT2': {
+        'message': "Hardly working!",
+        'bg': "#ffff00",
+        'gif_url': 'https://media1.tenor.com/m/3pwRCgEnqN8AAAAC/sleeping-at-work-fail.gif'
+    },
+    'ALERT3': {
+        'message': "Ansys!",
+        'bg': "#ff00ff",
+        'gif_url': 'https://media1.tenor.com/m/7zrtEDHtArcAAAAC/ronswanson-parksandrec.gif'
+    },
+}
+
+TEMPLATE_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.alert_app_cache', 'templates.json')
+MAX_PARAMS = 8
+MAX_PARAM_LENGTH = 200
+
+
+class TemplateError(Exception):
+    pass
+
+
+class _Params(dict):
+    # Placeholders without a param stay visible instead of failing
+    def __missing__(self, key):
+        return '{' + key + '}'
+
+
+def template_params(template):
+    # Placeholder names in a template's message, in order of appearance
+    names = []
+    for _, name, _, _ in string.Formatter().parse(template['message']):
+        if name and name not in names:
+            names.append(name)
+    return names
+
+
+def render_template(template, params=None):
+    # -> (message, bg, gif_url)
+    try:
+        message = template['message'].format_map(_Params(params or {}))
+    except (ValueError, IndexError, AttributeError):
+        message = template['message']
+    return message, template.get('bg', '#ff4500'), template.get('gif_url')
+
+
+class TemplateRegistry:
+    def __init__(self, templates=None):
+        self.templates = dict(BUILTIN_ALERTS)
+        self.templates.update(templates or {})
+        # A hash of the content, so every server worker started from the
+        # same file agrees on the version and restarts don't bust caches
+        canonical = json.dumps(self.templates, sort_keys=True, ensure_ascii=False).encode('utf-8')
+        self.version = hashlib.sha256(canonical).hexdigest()[:16]
+
+    @classmethod
+    def load(cls, path):
+        # JSON object of id -> {"message": ..., "bg": ..., "gif_url": ...}
+        with open(path, encoding='utf-8') as f:
+            templates = json.load(f)
+        for template_id, template in templates.items():
+            if not isinstance(template, dict) or not isinstance(template.get('message'), str):
+                raise TemplateError(f"Template {template_id} needs a message")
+        return cls(templates)
+
+    def __contains__(self, template_id):
+        return template_id in self.templates
+
+    def is_builtin(self, template_id):
+        # Unchanged from BUILTIN_ALERTS, so even old clients have it
+        return template_id in BUILTIN_ALERTS and self.templates[template_id] == BUILTIN_ALERTS[template_id]
+
+    def listing(self):
+        return {'type': 'TEMPLATE_LIST', 'version': self.version, 'templates': self.templates}
+
+    def validate(self, template_id, params):
+        # Returns the params to forward, or raises TemplateError
+        template = self.templates.get(template_id)
+        if template is None:
+            raise TemplateError(f"Unknown template: {template_id}")
+        if not params:
+            return {}
+        if not isinstance(params, dict) or len(params) > MAX_PARAMS:
+            raise TemplateError(f"Bad params for template {template_id}")
+        names = template_params(template)
+        clean = {}
+        for name, value in params.items():
+            if name not in names:
+                continue  # Not used by this template; don't relay it
+            if not isinstance(value, (str, int, float)):
+                raise TemplateError(f"Bad value for param {name}")
+            clean[name] = str(value)[:MAX_PARAM_LENGTH]
+        return clean
+
+    def render(self, template_id, params=None):
+        message, bg, gif_url = render_template(self.templates[template_id], params)
+        return {'message': message, 'bg': bg, 'gif_url': gif_url}
+
+
+def load_cached_templates(path=TEMPLATE_CACHE_PATH):
+    # Client side: (version, templates) from the last sync, or (None, {})
+    try:
+        with open(path, encoding='utf-8') as f:
+            cached = json.load(f)
+        return cached['version'], cached['templates']
+    except (OSError, ValueError, KeyError):
+        return None, {}
+
+
+def save_cached_templates(version, templates, path=TEMPLATE_CACHE_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'version': version, 'templates': templates}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
@@ -0,0 +1,95 @@
+from collections import OrderedDict
+from tkinter import font
+
+# Popup text layout. Wrapping used to measure every growing prefix of each
+# line with Font.measure(), one Tk round trip each, so a long custom message
+# cost O(words²) of them every time a popup opened. Instead:
+#   - popup fonts are made once (shared_font) and reused by every popup
+#   - each distinct word is measured once per font and lines are filled by
+#     adding up word and space widths, linear in the number of words (Tk
+#     doesn't kern across a space, so the sums match measuring the line)
+#   - the wrapped lines are kept by (message, font, width), so an alert
+#     that arrives again is laid out with a dict lookup
+# Tk thread only.
+
+LAYOUT_CACHE_SIZE = 256  # Wrapped messages kept
+WORD_CACHE_SIZE = 4096   # Word widths kept per font
+
+_fonts = {}
+
+
+def shared_font(family, size, weight='normal'):
+    # One Font per (family, size, weight) for the life of the Tk root
+    key = (family, size, weight)
+    shared = _fonts.get(key)
+    if shared is None:
+        shared = _fonts[key] = font.Font(family=family, size=size, weight=weight)
+    return shared
+
+
+def wrap_words(text, measure, max_width):
+    # Greedy fill: as many words per line as fit in max_width. A word wider
+    # than the line gets a line of its own.
+    lines = []
+    line = []
+    used = 0
+    space = measure(' ')
+    for word in text.split():
+        width = measure(word)
+        if line and used + space + width > max_width:
+            lines.append(' '.join(line))
+            line = [word]
+            used = width
+        else:
+            used += space + width if line else width
+            line.append(word)
+    if line:
+        lines.append(' '.join(line))
+    return lines
+
+
+class TextLayout:
+    def __init__(self, size=LAYOUT_CACHE_SIZE):
+        self.size = size
+        self.layouts = OrderedDict()  # (text, font name, width) -> lines, least recently used first
+        self.word_widths = {}         # font name -> {word: pixels}
+        self.linespaces = {}          # font name -> pixels
+        self.hits = 0
+        self.misses = 0
+        self.measured = 0             # Font.measure() calls made
+
+    def wrap(self, text, font_obj, max_width):
+        # -> tuple of lines
+        name = str(font_obj)
+        key = (text, name, max_width)
+        lines = self.layouts.get(key)
+        if lines is not None:
+            self.layouts.move_to_end(key)
+            self.hits += 1
+            return lines
+        self.misses += 1
+        widths = self.word_widths.get(name)
+        if widths is None or len(widths) > WORD_CACHE_SIZE:
+            widths = self.word_widths[name] = {}
+
+        def measure(word):
+            width = widths.get(word)
+            if width is None:
+                width = widths[word] = font_obj.measure(word)
+                self.measured += 1
+            return width
+
+        lines = self.layouts[key] = tuple(wrap_words(text, measure, max_width))
+        if len(self.layouts) > self.size:
+            self.layouts.popitem(last=False)
+        return lines
+
+    def linespace(self, font_obj):
+        name = str(font_obj)
+        pixels = self.linespaces.get(name)
+        if pixels is None:
+            pixels = self.linespaces[name] = font_obj.metrics('linespace')
+        return pixels
+
+    def stats(self):
+        return {'layouts': len(self.layouts), 'hits': self.hits, 'misses': self.misses, 'measured': self.measured}
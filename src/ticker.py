@@ -0,0 +1,161 @@
+import time
+from collections import deque
+
+# One animation clock for all popups. Instead of every popup keeping its own
+# after() loops, animations register a step function with the ticker on the
+# root window, and a single after() callback runs whichever steps are due:
+#   - step() returns the delay in ms until it wants to run again, or None
+#     when it's finished
+#   - steps due within min_interval of each other share a tick, so several
+#     popups cost one wakeup instead of one each
+#   - popups that are unmapped (minimized) or fully obscured are skipped, and
+#     with nothing visible left the ticker stops until one is mapped again
+#   - if the ticks take more than cpu_budget of wall time, min_interval is
+#     stretched (up to MAX_TICK_INTERVAL) so animations slow down rather than
+#     starve the rest of the UI
+# Tk thread only.
+
+MIN_TICK_INTERVAL = 15  # ms
+MAX_TICK_INTERVAL = 200  # ms
+CPU_BUDGET = 0.25  # Share of wall time the ticks may use
+FRAME_TIME_SAMPLES = 256
+
+
+class Animation:
+    __slots__ = ('toplevel', 'step', 'due', 'mapped', 'obscured', 'finished')
+
+    def __init__(self, toplevel, step, due):
+        self.toplevel = toplevel
+        self.step = step
+        self.due = due
+        self.mapped = True
+        self.obscured = False
+        self.finished = False
+
+
+class AnimationTicker:
+    def __init__(self, root, min_interval=MIN_TICK_INTERVAL, cpu_budget=CPU_BUDGET):
+        self.root = root
+        self.base_interval = min_interval
+        self.min_interval = min_interval
+        self.cpu_budget = cpu_budget
+        self.animations = []
+        self.after_id = None
+        self.window_start = time.perf_counter()
+        self.window_work = 0.0
+
+        # Stats
+        self.started = time.perf_counter()
+        self.ticks = 0
+        self.steps = 0
+        self.skipped = 0
+        self.work_time = 0.0
+        self.frame_times = deque(maxlen=FRAME_TIME_SAMPLES)
+
+        # Restoring the main window resumes a ticker paused by minimizing it
+        root.bind('<Map>', lambda event: self._wake() if event.widget is root else None, add='+')
+
+    def add(self, widget, step):
+        # Runs step() on the next tick and then as often as it asks. widget is
+        # the canvas being animated; the animation ends with its window.
+        toplevel = widget.winfo_toplevel()
+        animation = Animation(toplevel, step, time.monotonic())
+        self.animations.append(animation)
+
+        def on_map(event, mapped):
+            if event.widget is toplevel:
+                animation.mapped = mapped
+                self._wake()
+
+        def on_visibility(event):
+            animation.obscured = event.state == 'VisibilityFullyObscured'
+            self._wake()
+
+        def on_destroy(event):
+            if event.widget is toplevel:
+                animation.finished = True
+
+        toplevel.bind('<Map>', lambda event: on_map(event, True), add='+')
+        toplevel.bind('<Unmap>', lambda event: on_map(event, False), add='+')
+        toplevel.bind('<Destroy>', on_destroy, add='+')
+        widget.bind('<Visibility>', on_visibility, add='+')
+        self._wake()
+        return animation
+
+    def _wake(self):
+        if self.after_id is None:
+            self.after_id = self.root.after(0, self._tick)
+
+    def _tick(self):
+        self.after_id = None
+        start = time.perf_counter()
+        now = time.monotonic()
+        next_due = None
+        root_hidden = self.root.state() in ('iconic', 'withdrawn')
+        live = []
+        for animation in self.animations:
+            if animation.finished:
+                continue
+            live.append(animation)
+            if root_hidden or not animation.mapped or animation.obscured:
+                self.skipped += 1
+                continue
+            if animation.due <= now:
+                try:
+                    delay = animation.step()
+                except Exception as e:
+                    print(f"Animation error: {e}")
+                    delay = None
+                self.steps += 1
+                if delay is None:
+                    animation.finished = True
+                    live.pop()
+                    continue
+                animation.due = now + delay / 1000
+            if next_due is None or animation.due < next_due:
+                next_due = animation.due
+        self.animations = live
+
+        elapsed = time.perf_counter() - start
+        self.ticks += 1
+        self.work_time += elapsed
+        self.frame_times.append(elapsed)
+        self._adapt(elapsed)
+
+        # Nothing visible: stay idle until a <Map>/<Visibility> event wakes us
+        if next_due is not None:
+            delay = max(self.min_interval, int((next_due - time.monotonic()) * 1000))
+            self.after_id = self.root.after(delay, self._tick)
+
+    def _adapt(self, elapsed):
+        # Compare work to wall time over roughly one-second windows
+        self.window_work += elapsed
+        window = time.perf_counter() - self.window_start
+        if window < 1.0:
+            return
+        share = self.window_work / window
+        if share > self.cpu_budget:
+            self.min_interval = min(MAX_TICK_INTERVAL, self.min_interval * 2)
+        elif share < self.cpu_budget / 2 and self.min_interval > self.base_interval:
+            self.min_interval = max(self.base_interval, self.min_interval // 2)
+        self.window_start = time.perf_counter()
+        self.window_work = 0.0
+
+    def stats(self):
+        frame_times = sorted(self.frame_times)
+        wall = time.perf_counter() - self.started
+        stats = {
+            'ticks': self.ticks,
+            'steps': self.steps,
+            'skipped_hidden': self.skipped,
+            'animations': len(self.animations),
+            'tick_interval_ms': self.min_interval,
+            'cpu_share': round(self.work_time / wall, 4) if wall else 0.0,
+        }
+        if frame_times:
+            stats.update({
+                'frame_ms_mean': round(sum(frame_times) / len(frame_times) * 1000, 3),
+                'frame_ms_p95': round(frame_times[int(len(frame_times) * 0.95)] * 1000, 3),
+                'frame_ms_max': round(frame_times[-1] * 1000, 3),
+            })
+        return stats
@@ -0,0 +1,150 @@
+import json
+
+import pytest
+
+from framing import (MessageDecoder, FramingError, EncodedMessage, encode_message, parse_message, decode_value,
+                     choose_framing, write_varint, BINARY_STRINGS, BINARY_TABLES, FRAMING_BINARY, FRAMING_BINARY_1,
+                     FRAMING_NDJSON, SUPPORTED_FRAMINGS, TAG_DICT, TAG_LIST, TAG_NONE, TAG_INTERNED,
+                     TAG_SHORT_INTERNED, MAX_DEPTH)
+
+MESSAGES = [
+    {'type': 'CUSTOM', 'message': 'Lunch is here', 'bg': '#ff4500', 'gif_url': None, 'sender_id': 7,
+     'sender_username': 'Zoë', 'targets': [3, 'ops'], 'media': 'a' * 64},
+    {'type': 'CLIENT_ROSTER_DELTA', 'base_version': 300, 'version': 301,
+     'changes': [{'type': 'CLIENT_JOINED', 'id': 1000000, 'username': 'x', 'address': "('10.0.0.1', 5)"}]},
+    {'type': 'PING'},
+    {'n': -5, 'big': -(2 ** 40), 'f': 1.5, 't': True, 'no': False, 'empty': {}, 'list': []},
+    'STOP',
+]
+
+
+def feed(framing, payload, chunk=None):
+    decoder = MessageDecoder(framed=True)
+    decoder.set_framing(framing)
+    if chunk is None:
+        return list(decoder.feed(payload))
+    return [message for offset in range(0, len(payload), chunk) for message in decoder.feed(payload[offset:offset + chunk])]
+
+
+@pytest.mark.parametrize('framing', SUPPORTED_FRAMINGS)
+def test_round_trip(framing):
+    payload = b''.join(encode_message(message, framing) for message in MESSAGES)
+    decoded = feed(framing, payload)
+    assert [parse_message(message) for message in decoded[:-1]] == MESSAGES[:-1]
+    assert decoded[-1] == 'STOP'  # Legacy alert strings pass through as strings
+
+
+@pytest.mark.parametrize('framing', SUPPORTED_FRAMINGS)
+def test_split_anywhere(framing):
+    # One byte per recv(): partial frames and UTF-8 sequences stay buffered
+    payload = b''.join(encode_message(message, framing) for message in MESSAGES)
+    assert feed(framing, payload, chunk=1) == feed(framing, payload)
+
+
+def test_binary_is_smaller_than_ndjson():
+    for message in MESSAGES[:3]:
+        assert len(encode_message(message, FRAMING_BINARY)) < len(encode_message(message, FRAMING_NDJSON))
+
+
+def test_tables_are_prefixes():
+    assert BINARY_TABLES[FRAMING_BINARY] == len(BINARY_STRINGS)
+    assert BINARY_TABLES[FRAMING_BINARY_1] < BINARY_TABLES[FRAMING_BINARY]
+    assert BINARY_STRINGS[:4] == ('type', 'message', 'bg', 'gif_url')  # On the wire since the first table
+
+
+def test_older_table_gets_newer_strings_spelled_out():
+    newer = BINARY_STRINGS[BINARY_TABLES[FRAMING_BINARY_1]:]
+    message = {'type': 'CUSTOM', 'targets': list(newer)}
+    payload = encode_message(message, FRAMING_BINARY_1)
+    for string in newer:
+        assert string.encode('utf-8') in payload
+    assert feed(FRAMING_BINARY_1, payload) == [message]
+
+
+def test_older_table_rejects_newer_index():
+    body = bytes([TAG_SHORT_INTERNED | BINARY_TABLES[FRAMING_BINARY_1]])
+    with pytest.raises(FramingError):
+        decode_value(body, 0, BINARY_TABLES[FRAMING_BINARY_1])
+    assert decode_value(body, 0)[0] == BINARY_STRINGS[BINARY_TABLES[FRAMING_BINARY_1]]
+
+
+def test_encoded_message_per_framing():
+    message = EncodedMessage(MESSAGES[0])
+    assert message.encode(FRAMING_BINARY) is message.encode(FRAMING_BINARY)
+    assert message.encode(FRAMING_BINARY) != message.encode(FRAMING_BINARY_1)
+    assert json.loads(message.encode(FRAMING_NDJSON)) == MESSAGES[0]
+
+
+def test_choose_framing():
+    assert choose_framing(SUPPORTED_FRAMINGS) == FRAMING_BINARY
+    assert choose_framing([FRAMING_BINARY_1, FRAMING_NDJSON]) == FRAMING_BINARY_1
+    assert choose_framing(['binary/99', FRAMING_NDJSON]) == FRAMING_BINARY  # Newer peer: our newest
+    assert choose_framing(['binary/99'], [FRAMING_BINARY_1, FRAMING_NDJSON]) is None
+    assert choose_framing(['msgpack', FRAMING_NDJSON]) == FRAMING_NDJSON
+    assert choose_framing(None) is None
+    assert choose_framing('binary') is None
+    assert choose_framing([['binary'], {}, FRAMING_NDJSON]) == FRAMING_NDJSON
+
+
+def frame(body):
+    out = bytearray()
+    write_varint(len(body), out)
+    return bytes(out + body)
+
+
+@pytest.mark.parametrize('body', [
+    b'',                                                  # Nothing at all
+    bytes([TAG_LIST, 2, TAG_NONE]),                       # Fewer items than announced
+    bytes([TAG_DICT, 1, TAG_NONE]),                       # Key without a value
+    bytes([TAG_INTERNED, 0xff, 0x7f]),                    # Interned index past the table
+    bytes([0x3f]),                                        # Unknown tag
+    bytes([TAG_DICT, 1, TAG_LIST, 0, TAG_NONE]),          # Unhashable key
+    bytes([TAG_DICT, 1, TAG_DICT, 0, TAG_NONE]),
+    bytes([TAG_LIST, 1]) * (MAX_DEPTH + 1) + bytes([TAG_NONE]),
+    bytes([TAG_LIST, 1]) * 10000 + bytes([TAG_NONE]),     # Deeper than the recursion limit
+    bytes([TAG_NONE, TAG_NONE]),                          # Trailing bytes
+])
+def test_malformed_binary_raises_framing_error(body):
+    with pytest.raises(FramingError):
+        feed(FRAMING_BINARY, frame(body))
+
+
+def test_nesting_up_to_the_limit():
+    body = bytes([TAG_LIST, 1]) * MAX_DEPTH + bytes([TAG_NONE])
+    value = feed(FRAMING_BINARY, frame(body))[0]
+    for _ in range(MAX_DEPTH):
+        value = value[0]
+    assert value is None
+
+
+def test_oversized_messages():
+    decoder = MessageDecoder(framed=True, max_size=100)
+    decoder.set_framing(FRAMING_BINARY)
+    out = bytearray()
+    write_varint(101, out)
+    with pytest.raises(FramingError):
+        list(decoder.feed(bytes(out)))
+
+    decoder = MessageDecoder(framed=True, max_size=100)
+    with pytest.raises(FramingError):
+        list(decoder.feed(b'x' * 101))  # ndjson without a newline
+
+
+def test_legacy_peer_unterminated():
+    decoder = MessageDecoder()
+    assert list(decoder.feed(b'STOP')) == ['STOP']
+    assert list(decoder.feed(b'{"type": "PING"}\n')) == ['{"type": "PING"}']
+
+
+def test_switch_framing_mid_feed():
+    # HELLO_ACK in ndjson, then binary in the same recv()
+    payload = encode_message({'type': 'HELLO_ACK', 'framing': FRAMING_BINARY}) + \
+        encode_message({'type': 'PING'}, FRAMING_BINARY)
+    decoder = MessageDecoder(framed=True)
+    decoded = []
+    for message in decoder.feed(payload):
+        message = parse_message(message)
+        if message['type'] == 'HELLO_ACK':
+            decoder.set_framing(message['framing'])
+        decoded.append(message)
+    assert decoded == [{'type': 'HELLO_ACK', 'framing': FRAMING_BINARY}, {'type': 'PING'}]
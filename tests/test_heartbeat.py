@@ -0,0 +1,62 @@
+from heartbeat import TimerWheel
+
+
+def run(wheel, start, until, step):
+    # -> {key: time it expired}
+    expired = {}
+    now = start
+    while now <= until:
+        for key in wheel.advance(now):
+            expired[key] = now
+        now += step
+    return expired
+
+
+def test_expiry_within_a_tick():
+    wheel = TimerWheel(tick=1.0, horizon=30.0, now=0.0)
+    for key, delay in (('a', 0.0), ('b', 2.5), ('c', 10.0), ('d', 30.0)):
+        wheel.schedule(key, delay)
+    assert len(wheel) == 4
+    expired = run(wheel, 0.0, 40.0, 0.25)
+    for key, delay in (('a', 0.0), ('b', 2.5), ('c', 10.0), ('d', 30.0)):
+        assert delay <= expired[key] <= delay + 1.0 + 0.25, key
+    assert len(wheel) == 0
+
+
+def test_cancel_and_reschedule():
+    wheel = TimerWheel(tick=1.0, horizon=30.0, now=0.0)
+    wheel.schedule('gone', 2.0)
+    wheel.schedule('later', 2.0)
+    wheel.schedule('sooner', 20.0)
+    wheel.cancel('gone')
+    wheel.cancel('never scheduled')
+    wheel.schedule('later', 10.0)
+    wheel.schedule('sooner', 1.0)
+    expired = run(wheel, 0.0, 15.0, 1.0)
+    assert 'gone' not in expired
+    assert 10.0 <= expired['later'] <= 11.0
+    assert 1.0 <= expired['sooner'] <= 2.0
+    assert len(wheel) == 0
+
+
+def test_expires_once():
+    wheel = TimerWheel(tick=1.0, horizon=5.0, now=0.0)
+    wheel.schedule('k', 1.0)
+    wheel.schedule('k', 1.0)  # Same slot twice
+    expired = [key for now in range(20) for key in wheel.advance(float(now))]
+    assert expired == ['k']
+
+
+def test_longer_than_horizon_is_clamped():
+    wheel = TimerWheel(tick=1.0, horizon=5.0, now=0.0)
+    wheel.schedule('k', 100.0)
+    expired = run(wheel, 0.0, 20.0, 1.0)
+    assert expired['k'] <= 7.0
+
+
+def test_catches_up_after_a_stall():
+    wheel = TimerWheel(tick=1.0, horizon=30.0, now=0.0)
+    wheel.schedule('a', 3.0)
+    wheel.schedule('b', 8.0)
+    assert sorted(wheel.advance(20.0)) == ['a', 'b']
+    assert wheel.advance(21.0) == []
@@ -0,0 +1,125 @@
+import socket
+import threading
+
+import pytest
+
+from framing import EncodedMessage, FRAMING_BINARY, FRAMING_NDJSON, encode_message
+from outbound import (OutboundQueue, write_batch, POLICY_DROP_OLDEST, POLICY_DISCONNECT, POLICY_COALESCE)
+
+
+def test_drop_oldest():
+    queue = OutboundQueue(maxsize=3, policy=POLICY_DROP_OLDEST)
+    for n in range(5):
+        assert queue.put(b'%d' % n)
+    assert queue.dropped == 2
+    assert queue.pop_batch() == [b'2', b'3', b'4']
+
+
+def test_disconnect():
+    queue = OutboundQueue(maxsize=2, policy=POLICY_DISCONNECT)
+    assert queue.put(b'a') and queue.put(b'b')
+    assert not queue.put(b'c')
+    assert queue.pop_batch() == [b'a', b'b']
+
+
+def test_coalesce():
+    queue = OutboundQueue(maxsize=3, policy=POLICY_COALESCE)
+    queue.put(b'roster 1', key='roster')
+    queue.put(b'alert')
+    queue.put(b'roster 2', key='roster')  # Replaces the queued one in place
+    assert queue.coalesced == 1
+    assert queue.pop() == b'roster 2'
+    queue.put(b'roster 3', key='roster')  # The last one was sent: queued anew
+    assert queue.pop_batch() == [b'alert', b'roster 3']
+
+
+def test_coalesce_key_dropped_when_full():
+    queue = OutboundQueue(maxsize=2, policy=POLICY_COALESCE)
+    queue.put(b'old', key='k')
+    queue.put(b'x')
+    queue.put(b'y')  # Full: 'old' goes, and its key with it
+    queue.put(b'new', key='k')
+    assert queue.pop_batch() == [b'y', b'new']
+    assert queue.keyed == {}
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        OutboundQueue(policy='shrug')
+
+
+def test_batch_limit():
+    queue = OutboundQueue(maxsize=10)
+    for n in range(5):
+        queue.put(b'%d' % n)
+    assert queue.get_batch(limit=2) == [b'0', b'1']
+    assert queue.pop_batch(limit=10) == [b'2', b'3', b'4']
+    assert queue.pop_batch() == [] and queue.pop() is None
+    assert queue.get_batch(timeout=0.01) is None
+
+
+def test_on_ready_when_empty_queue_fills():
+    ready = []
+    queue = OutboundQueue(on_ready=lambda: ready.append(len(ready)))
+    queue.put(b'a')
+    queue.put(b'b')
+    assert ready == [0]
+    queue.pop_batch()
+    queue.put(b'c')
+    assert ready == [0, 1]
+
+
+def test_framing_switch():
+    # HELLO_ACK goes out in the old framing, everything after in the new one
+    queue = OutboundQueue()
+    message = {'type': 'PING'}
+    queue.put(EncodedMessage(message))
+    ack = encode_message({'type': 'HELLO_ACK', 'framing': FRAMING_BINARY}, FRAMING_NDJSON)
+    assert queue.set_framing(FRAMING_BINARY, ack)
+    queue.put(EncodedMessage(message))
+    assert queue.pop_batch() == [encode_message(message, None), ack, encode_message(message, FRAMING_BINARY)]
+
+
+def test_wait_drained():
+    queue = OutboundQueue(maxsize=4)
+    for n in range(4):
+        queue.put(b'%d' % n)
+    assert queue.full() and not queue.drained()
+    assert not queue.wait_drained(timeout=0.01)
+    threading.Timer(0.05, lambda: queue.pop_batch(limit=2)).start()
+    assert queue.wait_drained(timeout=5)
+    assert queue.draining == 0
+
+
+def test_close():
+    queue = OutboundQueue()
+    queue.put(b'a')
+    waiter = threading.Thread(target=lambda: queue.wait_drained())
+    queue.close()
+    waiter.start()
+    waiter.join(timeout=5)
+    assert not waiter.is_alive()
+    assert queue.get() is None and queue.get_batch() is None
+    assert not queue.put(b'b')
+    assert len(queue) == 0
+
+
+def test_write_batch_short_writes():
+    # A small send buffer makes sendmsg() take part of the batch at a time
+    left, right = socket.socketpair()
+    left.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    payloads = [bytes([n]) * 10000 for n in range(8)]
+    received = bytearray()
+
+    def read():
+        while len(received) < 80000:
+            received.extend(right.recv(65536))
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    calls = write_batch(left, list(payloads))
+    reader.join(timeout=5)
+    left.close()
+    right.close()
+    assert bytes(received) == b''.join(payloads)
+    assert calls >= 1
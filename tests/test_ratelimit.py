@@ -0,0 +1,58 @@
+import argparse
+
+import pytest
+
+from ratelimit import TokenBucket, ClientLimits, parse_rate_limit, limit_kind, ALERT, INVALID, RATE_LIMITS
+
+
+def test_bucket_burst_then_rate():
+    bucket = TokenBucket(rate=2.0, burst=3, now=0.0)
+    assert [bucket.take(0.0) for _ in range(3)] == [0, 0, 0]
+    assert bucket.take(0.0) == pytest.approx(0.5)
+    assert bucket.take(0.5) == 0  # Refilled one token
+    assert bucket.take(100.0) == 0
+    assert bucket.tokens == pytest.approx(2)  # Capped at burst
+
+
+def test_bucket_borrow():
+    # Throttling takes the token now; the next message waits for the one after
+    bucket = TokenBucket(rate=1.0, burst=1, now=0.0)
+    assert bucket.take(0.0) == 0
+    assert bucket.take(0.0, borrow=True) == pytest.approx(1.0)
+    assert bucket.take(0.0, borrow=True) == pytest.approx(2.0)
+    assert bucket.take(2.0) == pytest.approx(1.0)
+    assert bucket.take(3.0) == 0
+
+
+def test_alert_types_share_a_bucket():
+    limits = ClientLimits({ALERT: (1.0, 2)})
+    assert limits.take('CUSTOM', 0.0) == (ALERT, 0)
+    assert limits.take('legacy', 0.0) == (ALERT, 0)
+    kind, wait = limits.take('TEMPLATE_ALERT', 0.0)
+    assert kind == ALERT and wait > 0
+
+
+def test_unlisted_types_are_unlimited():
+    limits = ClientLimits({ALERT: (1.0, 1)})
+    for _ in range(100):
+        assert limits.take('PING', 0.0) == ('PING', 0)
+    assert limits.buckets == {}
+
+
+@pytest.mark.parametrize('message_type', [['x'], {'a': 1}, None, 5])
+def test_invalid_types(message_type):
+    assert limit_kind(message_type) == INVALID
+    limits = ClientLimits(RATE_LIMITS)
+    rate, burst = RATE_LIMITS[INVALID]
+    waits = [limits.take(message_type, 0.0)[1] for _ in range(int(burst) + 1)]
+    assert waits[:-1] == [0] * int(burst) and waits[-1] > 0
+
+
+def test_parse_rate_limit():
+    assert parse_rate_limit('alert=10/50') == ('alert', (10.0, 50.0))
+    assert parse_rate_limit('SUBSCRIBE=2') == ('SUBSCRIBE', (2.0, 2.0))
+    assert parse_rate_limit('SUBSCRIBE=0.5') == ('SUBSCRIBE', (0.5, 1.0))
+    assert parse_rate_limit('alert=off') == ('alert', None)
+    for text in ('alert', '=5', 'alert=fast', 'alert=0', 'alert=5/0.5', 'CUSTOM=5'):
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_rate_limit(text)
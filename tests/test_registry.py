@@ -0,0 +1,138 @@
+import pytest
+
+from registry import ClientRegistry, ClientRecord, MAX_TOPICS
+
+
+class FakeSocket:
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        pass
+
+
+def record(client_id, host='10.0.0.1', username=None):
+    return ClientRecord(client_id, FakeSocket(), (host, 40000 + client_id), username or f"Client_{client_id}",
+                        None, None)
+
+
+def assert_consistent(registry):
+    # Every index holds exactly the records in by_id
+    records = list(registry.by_id.values())
+    assert set(registry.snapshot()) == set(records)
+    assert sorted(r.client_id for rs in registry.by_username.values() for r in rs) == \
+        sorted(r.client_id for r in records)
+    for username, same_name in registry.by_username.items():
+        assert same_name and all(r.username == username for r in same_name)
+    assert registry.by_address == {r.address: r for r in records}
+    hosts = {}
+    for r in records:
+        hosts[r.address[0]] = hosts.get(r.address[0], 0) + 1
+    assert registry.by_host == hosts
+    subscribed = {}
+    for r in records:
+        for topic in r.topics:
+            subscribed.setdefault(topic, {})[r.client_id] = r
+    assert registry.by_topic == subscribed
+    for topic in subscribed:
+        assert set(registry.subscribers(topic)) == set(subscribed[topic].values())
+
+
+def test_add_rename_remove():
+    registry = ClientRegistry()
+    a, b, c = record(1), record(2), record(3, host='10.0.0.2')
+    for r in (a, b, c):
+        registry.add(r)
+    assert len(registry) == 3 and 2 in registry
+    assert registry.host_count('10.0.0.1') == 2
+    assert_consistent(registry)
+
+    registry.rename(1, 'desk')
+    registry.rename(2, 'desk')
+    assert set(registry.find_by_username('desk')) == {a, b}
+    assert registry.find_by_username('Client_1') == []
+    assert_consistent(registry)
+
+    registry.rename(1, 'desk')  # Same name again
+    assert set(registry.find_by_username('desk')) == {a, b}
+    assert_consistent(registry)
+
+    assert registry.remove(1) is a
+    assert registry.remove(1) is None  # Only one caller gets the record
+    assert registry.find_by_username('desk') == [b]
+    assert registry.find_by_address(a.address) is None
+    assert registry.host_count('10.0.0.1') == 1
+    assert_consistent(registry)
+
+    assert registry.rename(1, 'gone') is None
+    registry.remove(2)
+    registry.remove(3)
+    assert len(registry) == 0 and registry.snapshot() == ()
+    assert_consistent(registry)
+
+
+def test_unhashable_username_leaves_indexes_alone():
+    registry = ClientRegistry()
+    a = record(1)
+    registry.add(a)
+    registry.subscribe(1, ['ops'])
+    with pytest.raises(TypeError):
+        registry.rename(1, ['x'])
+    assert a.username == 'Client_1'
+    assert_consistent(registry)
+    assert registry.remove(1) is a
+    assert_consistent(registry)
+    assert registry.host_count('10.0.0.1') == 0
+
+
+def test_snapshot_is_stable():
+    registry = ClientRegistry()
+    registry.add(record(1))
+    snapshot = registry.snapshot()
+    assert registry.snapshot() is snapshot
+    registry.add(record(2))
+    assert len(snapshot) == 1 and len(registry.snapshot()) == 2
+
+
+def test_topics():
+    registry = ClientRegistry()
+    a, b = record(1), record(2)
+    registry.add(a)
+    registry.add(b)
+    assert registry.subscribe(1, ['ops', 'dev']) == {'ops', 'dev'}
+    registry.subscribe(2, ['ops'])
+    assert set(registry.subscribers('ops')) == {a, b}
+    assert registry.topic_count() == 2
+    assert_consistent(registry)
+
+    assert registry.unsubscribe(1, ['ops', 'never']) == {'dev'}
+    assert registry.subscribers('ops') == (b,)
+    assert_consistent(registry)
+
+    registry.remove(1)
+    assert registry.subscribers('dev') == ()
+    assert registry.topic_count() == 1
+    assert_consistent(registry)
+    assert registry.subscribe(1, ['dev']) is None
+
+
+def test_subscription_limit():
+    registry = ClientRegistry()
+    registry.add(record(1))
+    topics = [f"t{n}" for n in range(MAX_TOPICS + 10)]
+    assert len(registry.subscribe(1, topics)) == MAX_TOPICS
+    assert len(registry.subscribe(1, ['one more'])) == MAX_TOPICS
+    assert_consistent(registry)
+
+
+def test_same_address_reconnect():
+    # A new record on the same address replaces the old one in by_address;
+    # removing the old one afterwards mustn't drop the new one
+    registry = ClientRegistry()
+    old, new = record(1), record(1)
+    new.client_id = 2
+    registry.add(old)
+    registry.add(new)
+    registry.remove(1)
+    assert registry.find_by_address(new.address) is new
+    assert registry.host_count('10.0.0.1') == 1